@@ -18,13 +18,17 @@ TODO: Automatically deploy new Windows backends when the csharp code
 import json
 import os
 import pprint
+import time
 import unittest
 import urllib
 import urllib2
 import urlparse
 
-HOST = 'https://{0}-dot-{1}.appspot.com'.format(
-    os.environ['GOOGLE_APP_VERSION'], os.environ['GOOGLE_APP_ID'])
+
+def default_host():
+    """Returns the url of the deployed app version under test."""
+    return 'https://{0}-dot-{1}.appspot.com'.format(
+        os.environ['GOOGLE_APP_VERSION'], os.environ['GOOGLE_APP_ID'])
 
 
 class Failure(Exception):
@@ -39,12 +43,23 @@ class Failure(Exception):
 
 class BrowserState(object):
     """Behaves like the browser.  Invokes our JSON API."""
-    def __init__(self, host):
-        """host should include the scheme; ex: https://www.google.com"""
+    def __init__(self, host, verbose=True, max_retries=10):
+        """host should include the scheme; ex: https://www.google.com
+
+        When verbose is False, requests and replies are not printed.
+        When the app is too busy to take a shout, shout() follows its
+        retryLink up to max_retries times.
+        """
+        self.max_retries = max_retries
         self.shout_id = 0
         self.final_link = None
         self.shout_link = None
         self.host = host
+        self.verbose = verbose
+        # How many nextLinks the last call to shout() followed.
+        self.round_trips = 0
+        # How many retryLinks the last call to shout() followed.
+        self.retries = 0
         self.urlopen("{}/connect".format(host), '')
 
     def __enter__(self):
@@ -65,7 +80,8 @@ class BrowserState(object):
         assert response.getcode() >= 200
         assert response.getcode() < 300
         reply = json.load(response)
-        pprint.pprint(reply)
+        if self.verbose:
+            pprint.pprint(reply)
         self.shout_link = reply.get('shoutLink', self.shout_link)
         self.final_link = reply.get('finalLink', self.final_link)
         return reply
@@ -77,11 +93,27 @@ class BrowserState(object):
         :returns a decoded json dict.
         """
         url = urlparse.urljoin(self.host, target)
-        print url
-        pprint.pprint(keyval)
+        if self.verbose:
+            print url
+            pprint.pprint(keyval)
         response = urllib2.urlopen(url, urllib.urlencode(keyval))
         return self.handle_response(response)
 
+    def retry_link(self, error):
+        """Returns the retryLink of a 429 or 503 response, or None.
+
+        :arg error: a urllib2.HTTPError.
+        """
+        if error.code not in (429, 503):
+            return None
+        try:
+            reply = json.load(error)
+        except ValueError:
+            return None  # Not from us.
+        if self.verbose:
+            pprint.pprint(reply)
+        return reply.get('retryLink')
+
     def shout(self, text):
         """Invokes shout on the text."""
         shout_id = self.shout_id
@@ -93,7 +125,22 @@ class BrowserState(object):
         }
         result = None
         errors = []
-        reply = self.urlopen(self.shout_link['target'], payload)
+        self.round_trips = 0
+        self.retries = 0
+        target = self.shout_link['target']
+        while True:
+            try:
+                reply = self.urlopen(target, payload)
+                break
+            except urllib2.HTTPError as e:
+                retry_link = self.retry_link(e)
+                if not retry_link or self.retries >= self.max_retries:
+                    raise
+            # Too busy.  Shout again when the app says to.
+            self.retries += 1
+            time.sleep(retry_link['delaySeconds'])
+            target = retry_link['target']
+            payload = dict(payload, token=retry_link['token'])
         while True:
             result = reply.get('result', result)
             if reply.get('error'):
@@ -105,6 +152,7 @@ class BrowserState(object):
                     'shoutId': shout_id,
                 }
                 reply = self.urlopen(next_link['target'], payload)
+                self.round_trips += 1
             else:
                 break
         if reply['status'] == 'success':
@@ -115,7 +163,7 @@ class BrowserState(object):
 
 class Test(unittest.TestCase):
     def test_all(self):
-        with BrowserState(HOST) as state:
+        with BrowserState(default_host()) as state:
             self.assertEqual('HELLO', state.shout('hello'))
             self.assertEqual('JEFF', state.shout('jeff'))
             with self.assertRaises(Failure):
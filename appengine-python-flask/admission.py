@@ -0,0 +1,208 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Turns shouts away when they would time out before a worker got to them.
+
+During overload, accepting every shout only makes things worse: shout
+requests pile up in the subscriptions, outlive their deadlines, and keep
+the workers busy with answers nobody will read.  It's kinder to tell the
+browser right away to try again later.  An AdmissionController admits a
+shout only if:
+  - this instance has fewer than max_instance_shouts shouts open,
+  - fewer than max_backlog shout requests are published but not finished,
+    across every instance and lane, and
+  - at the rate shout requests in the shout's lane recently finished, the
+    lane's backlog would drain before the shout's deadline.  Lanes are
+    judged apart, because workers favor short lanes, so a deep long lane
+    needn't hold up a short one.
+
+The backlog comes from counters that only grow, and that lose a count now
+and then, so published minus finished drifts upwards.  But a request
+published longer ago than the longest deadline has either finished or been
+lost, so the backlog is never taken to be more than what was published
+since then.
+"""
+import collections
+import contextlib
+import threading
+import time
+
+import metrics
+
+# code: int, the HTTP status code to respond with.
+# reason: string, why the shout was turned away, for people.
+# retry_after_seconds: int, when it's worth trying again.
+Rejection = collections.namedtuple(
+    'Rejection', ['code', 'reason', 'retry_after_seconds'])
+
+
+class AdmissionController(object):
+    """Decides whether to admit each shout.  Thread-safe."""
+
+    def __init__(self, counts, max_instance_shouts=None, max_backlog=None,
+                 min_backlog=100, refresh_seconds=1, window_seconds=60,
+                 min_rate_seconds=10, expire_seconds=150,
+                 max_retry_after_seconds=60):
+        """Args:
+          counts: a function that returns a dict mapping each lane's name
+            to a tuple (published, finished) of how many shout requests
+            have been published to and finished from it, across every
+            instance.  Or None if it doesn't know.
+          max_instance_shouts: int, most shouts this instance may have open.
+            None means no limit.
+          max_backlog: int, most shout requests published but not finished,
+            in every lane together.  None means no limit.
+          min_backlog: int, always admit while a lane's backlog is smaller
+            than this, because the finish rate of a few shouts means little.
+          refresh_seconds: float, how often to call counts().
+          window_seconds: float, how far back to measure the finish rate.
+          min_rate_seconds: float, the shortest time to measure the finish
+            rate over.  Shouts take a while, so a short one looks stalled.
+          expire_seconds: float, how long after a shout request is published
+            it must have finished, or been lost.  At least the longest
+            deadline.
+          max_retry_after_seconds: int, the longest a browser is told to
+            wait before trying again.
+        """
+        self._counts = counts
+        self._max_instance_shouts = max_instance_shouts
+        self._max_backlog = max_backlog
+        self._min_backlog = min_backlog
+        self._refresh_seconds = refresh_seconds
+        self._window_seconds = window_seconds
+        self._min_rate_seconds = min_rate_seconds
+        self._expire_seconds = expire_seconds
+        self._max_retry_after_seconds = max_retry_after_seconds
+        self._lock = threading.Lock()
+        self._open = 0
+        # Tuples of (time, what counts() returned), oldest first.
+        self._samples = collections.deque()
+        self._refreshed = 0
+
+    def check(self, lane, deadline_seconds):
+        """Decides whether to admit a shout.
+
+        Args:
+          lane: string, the name of the shout's lane.
+          deadline_seconds: float, how long a worker has to finish the
+            shout.
+        Returns:
+          A Rejection, or None to admit the shout.
+        """
+        rejection = self._check(lane, deadline_seconds)
+        metrics.ADMISSIONS.inc(
+            result=rejection.reason if rejection else 'admitted')
+        return rejection
+
+    def _check(self, lane, deadline_seconds):
+        if (self._max_instance_shouts is not None and
+                self._open >= self._max_instance_shouts):
+            # Another instance may have room.
+            return Rejection(429, 'instance busy', 1)
+        samples = self._refresh()
+        if self._max_backlog is not None and samples:
+            measures = [self._measure(samples, name)
+                        for name in samples[-1][1]]
+            backlog = sum(measure[0] for measure in measures)
+            rate = sum(measure[1] or 0 for measure in measures)
+            if backlog >= self._max_backlog:
+                wait = ((backlog - self._max_backlog) / rate if rate
+                        else self._max_retry_after_seconds)
+                return Rejection(503, 'backlog full', self._retry_after(wait))
+        backlog, rate, arriving = self._measure(samples, lane)
+        if backlog is None or backlog < self._min_backlog:
+            return None
+        if rate is None:
+            return None
+        if not rate:
+            if not arriving:
+                # Nothing new to do, so the backlog is counts gone astray.
+                return None
+            # Work arrived lately, but nothing finished.
+            return Rejection(503, 'workers stalled',
+                             self._max_retry_after_seconds)
+        wait = backlog / rate
+        if wait > deadline_seconds:
+            return Rejection(503, 'queue too slow',
+                             self._retry_after(wait - deadline_seconds))
+        return None
+
+    @contextlib.contextmanager
+    def holding(self):
+        """Counts an admitted shout as open in this instance for the
+        duration of a with block.
+        """
+        with self._lock:
+            self._open += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._open -= 1
+
+    def _retry_after(self, seconds):
+        return max(1, min(self._max_retry_after_seconds, int(seconds + 1)))
+
+    def _refresh(self):
+        """Calls counts() if it's time.  Returns the samples."""
+        now = time.time()
+        with self._lock:
+            refresh = now - self._refreshed >= self._refresh_seconds
+            if refresh:
+                # Let one thread refresh while the rest use what's known.
+                self._refreshed = now
+        if refresh:
+            counts = self._counts()
+            with self._lock:
+                if counts is None:
+                    self._samples.clear()
+                else:
+                    self._samples.append((now, counts))
+                # Keep one sample older than both the rate window and the
+                # expiry.
+                keep_seconds = max(self._window_seconds, self._expire_seconds)
+                while (len(self._samples) > 1 and
+                       self._samples[1][0] <= now - keep_seconds):
+                    self._samples.popleft()
+        with self._lock:
+            return list(self._samples)
+
+    def _measure(self, samples, lane):
+        """Returns a tuple (backlog, rate, arriving) for a lane: how many
+        shout requests are published but not finished, how many finish per
+        second, and whether any were published lately.
+
+        backlog and rate are None when unknown.
+        """
+        # Tuples of (time, published, finished).
+        samples = [(sample[0],) + tuple(sample[1][lane])
+                   for sample in samples if lane in sample[1]]
+        if not samples:
+            return None, None, False
+        last = samples[-1]
+        backlog = max(0, last[1] - last[2])
+        for sample in reversed(samples):
+            if sample[0] <= last[0] - self._expire_seconds:
+                if sample[1] <= last[1]:
+                    backlog = min(backlog, last[1] - sample[1])
+                break
+        first = next(sample for sample in samples
+                     if sample[0] >= last[0] - self._window_seconds)
+        span = last[0] - first[0]
+        if (span <= 0 or span < self._min_rate_seconds or
+                last[1] < first[1] or last[2] < first[2]):
+            # Too soon to tell, or the counts were reset.
+            return backlog, None, False
+        return (backlog, float(last[2] - first[2]) / span,
+                last[1] > first[1])
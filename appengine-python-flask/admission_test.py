@@ -0,0 +1,135 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import admission
+
+
+class FakeTime(object):
+    """Stands in for the time module, so tests needn't sleep."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeTime()
+        self.real_time, admission.time = admission.time, self.clock
+        self.counts = {'long': (0, 0)}
+
+    def tearDown(self):
+        admission.time = self.real_time
+
+    def controller(self, **kwargs):
+        return admission.AdmissionController(lambda: self.counts, **kwargs)
+
+    def advance(self, controller, seconds, counts, deadline_seconds=90,
+                lane='long'):
+        """Lets seconds pass, then checks a shout.
+
+        Args:
+          counts: a tuple (published, finished) of the long lane, or a dict
+            of every lane's.
+        """
+        self.clock.now += seconds
+        self.counts = counts if isinstance(counts, dict) else {'long': counts}
+        return controller.check(lane, deadline_seconds)
+
+    def test_admits_when_idle(self):
+        self.assertIsNone(self.controller().check('long', 90))
+
+    def test_instance_limit(self):
+        controller = self.controller(max_instance_shouts=1)
+        with controller.holding():
+            self.assertEqual(429, controller.check('long', 90).code)
+        self.assertIsNone(controller.check('long', 90))
+
+    def test_admits_when_counts_unknown(self):
+        controller = admission.AdmissionController(lambda: None,
+                                                   max_backlog=1)
+        self.assertIsNone(controller.check('long', 90))
+
+    def test_backlog_limit(self):
+        controller = self.controller(max_backlog=500)
+        self.assertIsNone(self.advance(controller, 1, (400, 0)))
+        self.assertEqual(503, self.advance(controller, 1, (600, 0)).code)
+
+    def test_backlog_limit_counts_every_lane(self):
+        controller = self.controller(max_backlog=500)
+        rejection = self.advance(
+            controller, 1, {'short': (300, 0), 'long': (300, 0)}, 30,
+            lane='short')
+        self.assertEqual('backlog full', rejection.reason)
+
+    def test_queue_too_slow(self):
+        controller = self.controller()
+        self.advance(controller, 1, (1000, 0))
+        # 10 finish per second, so the backlog of 900 takes 90 seconds.
+        self.assertIsNone(self.advance(controller, 10, (1000, 100), 120))
+        rejection = self.advance(controller, 1, (1010, 110), 30)
+        self.assertEqual(503, rejection.code)
+        self.assertEqual('queue too slow', rejection.reason)
+        self.assertTrue(1 <= rejection.retry_after_seconds <= 60)
+
+    def test_lanes_judged_apart(self):
+        controller = self.controller()
+        self.advance(controller, 1, {'short': (100, 0), 'long': (1000, 0)})
+        # The long lane's backlog of 900 takes 90 seconds at 10 a second,
+        # while the short lane's of 110 takes 6 seconds at 19 a second.
+        counts = {'short': (300, 190), 'long': (1000, 100)}
+        self.assertEqual('queue too slow',
+                         self.advance(controller, 10, counts, 30).reason)
+        self.assertIsNone(self.advance(controller, 1, counts, 30,
+                                       lane='short'))
+
+    def test_small_backlog_always_admitted(self):
+        controller = self.controller(min_backlog=100)
+        self.advance(controller, 1, (50, 0))
+        self.assertIsNone(self.advance(controller, 30, (99, 0), 1))
+
+    def test_workers_stalled(self):
+        controller = self.controller()
+        self.advance(controller, 1, (200, 0))
+        rejection = self.advance(controller, 20, (300, 0))
+        self.assertEqual('workers stalled', rejection.reason)
+
+    def test_lost_counts_dont_lock_out_an_idle_system(self):
+        # 150 finishes were never counted, and nothing is happening.
+        controller = self.controller()
+        for i in range(120):
+            self.assertIsNone(self.advance(controller, 1, (150, 0)))
+
+    def test_lost_counts_expire(self):
+        controller = self.controller(expire_seconds=100)
+        # 300 finishes were never counted.  One shout request arrives and
+        # finishes each second.
+        counts = lambda i: (1300 + i, 1000 + i)
+        self.advance(controller, 1, counts(0))
+        for i in range(1, 50):
+            rejection = self.advance(controller, 1, counts(i), 120)
+        # It looks like 300 requests at 1 a second.
+        self.assertEqual('queue too slow', rejection.reason)
+        for i in range(50, 120):
+            rejection = self.advance(controller, 1, counts(i), 120)
+        # But only 100 were published in the last 100 seconds.
+        self.assertIsNone(rejection)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """`appengine_config` gets loaded when starting a new application instance."""
+import os
+
 from google.appengine.ext import vendor
-# Add any libraries installed in the "lib" folder.
-vendor.add('lib')
+# Add any libraries installed in the "lib" folder, wherever we're run from.
+vendor.add(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib'))
@@ -15,12 +15,20 @@
 
 
 """Utility for caching the discovery doc.
+
+Usage:
+  discovery_doc.py SERVICE_NAME VERSION
+writes a snapshot of the discovery doc to the discovery directory, to be
+bundled with the app.  See get_discovery_doc().
 """
 
 
 import datetime
 import json
+import logging
 import os
+import sys
+import threading
 
 # Libraries used by or included with Google API Client Library for Python
 from apiclient.discovery import _add_query_parameter
@@ -35,6 +43,9 @@ import uritemplate
 
 
 DISCOVERY_DOC_MAX_AGE = datetime.timedelta(hours=24)
+# Where snapshots of discovery docs are bundled with the app.
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'discovery')
 
 
 class DiscoveryDoc(ndb.Model):
@@ -48,13 +59,18 @@ class DiscoveryDoc(ndb.Model):
         now = datetime.datetime.utcnow()
         return now - self.updated > DISCOVERY_DOC_MAX_AGE
 
+    @classmethod
+    def make_key(cls, service_name, version,
+                 discovery_service_url=DISCOVERY_URI):
+        return ndb.Key(cls, service_name, cls, version, cls,
+                       discovery_service_url)
+
     @classmethod
     def build(cls, service_name, version, **kwargs):
         """Builds the client object."""
         discovery_service_url = kwargs.pop('discovery_service_url',
                                            DISCOVERY_URI)
-        key = ndb.Key(cls, service_name, cls, version, cls,
-                      discovery_service_url)
+        key = cls.make_key(service_name, version, discovery_service_url)
         discovery_doc = key.get()
 
         if discovery_doc is None or discovery_doc.expired:
@@ -96,4 +112,109 @@ def retrieve_discovery_doc(service_name, version, http=None,
 
     # we return content instead of the JSON deserialized service because
     # build_from_document() consumes a string rather than a dictionary
-    return content
\ No newline at end of file
+    return content
+
+
+# Discovery docs we've already loaded, keyed by (service_name, version).
+_docs = {}
+_docs_lock = threading.Lock()
+# Keys of the docs being refreshed in the background right now.
+_refreshing = set()
+
+
+def get_discovery_doc(service_name, version):
+    """Returns the discovery doc, from the fastest place that has it.
+
+    Looks in process memory, then the DiscoveryDoc entity in datastore, then
+    the snapshot bundled in SNAPSHOT_DIR, and only then the network.  When
+    the doc comes from an expired entity or from the snapshot, returns it
+    right away and refreshes the entity in the background.
+    """
+    key = (service_name, version)
+    document = _docs.get(key)
+    if document:
+        return document
+    stale = False
+    try:
+        entity = DiscoveryDoc.make_key(service_name, version).get()
+    except Exception:
+        # No datastore, like when running a worker outside App Engine.
+        logging.debug('Could not read the discovery doc from datastore.',
+                      exc_info=True)
+        entity = None
+    if entity:
+        document = entity.document
+        stale = entity.expired
+    else:
+        document = _read_snapshot(service_name, version)
+        stale = document is not None
+    if document is None:
+        document = _refresh(service_name, version)
+    elif stale:
+        _refresh_in_background(service_name, version)
+    with _docs_lock:
+        return _docs.setdefault(key, document)
+
+
+def _snapshot_path(service_name, version):
+    return os.path.join(SNAPSHOT_DIR, '%s.%s.json' % (service_name, version))
+
+
+def _read_snapshot(service_name, version):
+    try:
+        with open(_snapshot_path(service_name, version)) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def _refresh(service_name, version):
+    """Fetches the doc from the network and saves it everywhere we look."""
+    document = retrieve_discovery_doc(service_name, version)
+    try:
+        DiscoveryDoc(key=DiscoveryDoc.make_key(service_name, version),
+                     document=document).put()
+    except Exception:
+        logging.debug('Could not save the discovery doc to datastore.',
+                      exc_info=True)
+    with _docs_lock:
+        _docs[(service_name, version)] = document
+    return document
+
+
+def _refresh_in_background(service_name, version):
+    key = (service_name, version)
+    with _docs_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def refresh():
+        try:
+            _refresh(service_name, version)
+        except Exception:
+            logging.exception('Failed to refresh the %s %s discovery doc.',
+                              service_name, version)
+        finally:
+            with _docs_lock:
+                _refreshing.discard(key)
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
+
+def main(argv):
+    if len(argv) != 3:
+        sys.stderr.write(__doc__)
+        return 1
+    service_name, version = argv[1:]
+    if not os.path.isdir(SNAPSHOT_DIR):
+        os.makedirs(SNAPSHOT_DIR)
+    with open(_snapshot_path(service_name, version), 'w') as f:
+        f.write(retrieve_discovery_doc(service_name, version))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,113 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Needs the App Engine SDK on PYTHONPATH, for the datastore."""
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext import testbed
+    import discovery_doc
+except ImportError:
+    testbed = None
+
+
+@unittest.skipIf(testbed is None, 'needs the App Engine SDK on PYTHONPATH')
+class GetDiscoveryDocTest(unittest.TestCase):
+    def setUp(self):
+        self.bed = testbed.Testbed()
+        self.bed.activate()
+        self.bed.init_datastore_v3_stub()
+        self.bed.init_memcache_stub()
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.fetched = []
+        self.real = (discovery_doc.retrieve_discovery_doc,
+                     discovery_doc.SNAPSHOT_DIR)
+        discovery_doc.retrieve_discovery_doc = self.fetch
+        discovery_doc.SNAPSHOT_DIR = self.snapshot_dir
+        discovery_doc._docs.clear()
+
+    def tearDown(self):
+        (discovery_doc.retrieve_discovery_doc,
+         discovery_doc.SNAPSHOT_DIR) = self.real
+        discovery_doc._docs.clear()
+        shutil.rmtree(self.snapshot_dir)
+        self.bed.deactivate()
+
+    def fetch(self, service_name, version):
+        self.fetched.append((service_name, version))
+        return '{"fetched": true}'
+
+    def wait_for_refresh(self):
+        deadline = time.time() + 5
+        while discovery_doc._refreshing and time.time() < deadline:
+            time.sleep(0.01)
+
+    def saved(self):
+        # Skips this thread's context cache, which misses background writes.
+        entity = discovery_doc.DiscoveryDoc.make_key('pubsub', 'v1').get(
+            use_cache=False)
+        return entity.document if entity else None
+
+    def test_fetches_only_when_nothing_else_has_it(self):
+        self.assertEqual('{"fetched": true}',
+                         discovery_doc.get_discovery_doc('pubsub', 'v1'))
+        self.assertEqual('{"fetched": true}', self.saved())
+        discovery_doc.get_discovery_doc('pubsub', 'v1')
+        self.assertEqual([('pubsub', 'v1')], self.fetched)
+
+    def test_reads_fresh_entity(self):
+        discovery_doc.DiscoveryDoc(
+            key=discovery_doc.DiscoveryDoc.make_key('pubsub', 'v1'),
+            document='{"saved": true}').put()
+        self.assertEqual('{"saved": true}',
+                         discovery_doc.get_discovery_doc('pubsub', 'v1'))
+        self.wait_for_refresh()
+        self.assertEqual([], self.fetched)
+
+    def test_refreshes_expired_entity_in_the_background(self):
+        entity = discovery_doc.DiscoveryDoc(
+            key=discovery_doc.DiscoveryDoc.make_key('pubsub', 'v1'),
+            document='{"saved": true}')
+        entity.put()
+        real_max_age = discovery_doc.DISCOVERY_DOC_MAX_AGE
+        discovery_doc.DISCOVERY_DOC_MAX_AGE = datetime.timedelta(0)
+        try:
+            self.assertEqual('{"saved": true}',
+                             discovery_doc.get_discovery_doc('pubsub', 'v1'))
+            self.wait_for_refresh()
+        finally:
+            discovery_doc.DISCOVERY_DOC_MAX_AGE = real_max_age
+        self.assertEqual([('pubsub', 'v1')], self.fetched)
+        self.assertEqual('{"fetched": true}', self.saved())
+
+    def test_serves_snapshot_while_refreshing(self):
+        with open(os.path.join(self.snapshot_dir, 'pubsub.v1.json'),
+                  'w') as f:
+            f.write('{"snapshot": true}')
+        self.assertEqual('{"snapshot": true}',
+                         discovery_doc.get_discovery_doc('pubsub', 'v1'))
+        self.wait_for_refresh()
+        self.assertEqual([('pubsub', 'v1')], self.fetched)
+        self.assertEqual('{"fetched": true}', self.saved())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Separates short shout requests from long ones.
+
+Shouting takes time proportional to len * log(len) of the text, so when
+every request shares one subscription, a burst of long texts keeps the
+workers busy while short ones wait, and time out.  With lanes, main.py
+publishes each shout request to the topic of the first lane whose max_size
+fits its text, with that lane's deadline, and workers take from the lanes'
+subscriptions in proportion to their weights.
+
+Lanes are described by a string like 'short:1000:30:4,long::90:1', a comma
+separated list of name:max_size:timeout_seconds:weight, smallest first.
+The last lane must take every size, so its max_size is empty.  Names are
+unique, and made of words of letters, digits and underscores joined by
+hyphens, where each word starts with a letter, so a lane's topic, like
+shout-requests-short, can't be mistaken for a shard's, like
+shout-requests-2.  The last lane keeps the original names, like shard 0
+does in shards.py, so a single lane is the original setup, and the C#
+workers serve the last lane.  The app and its workers must be given the
+same description.
+Imports nothing from App Engine, so workers can use it too.
+"""
+import collections
+import re
+
+import shards
+
+# Words that start with a letter, so no part of a name looks like a shard.
+_NAME_RE = re.compile(r'[A-Za-z][A-Za-z0-9_]*(-[A-Za-z][A-Za-z0-9_]*)*$')
+
+Lane = collections.namedtuple(
+    'Lane', ['name', 'max_size', 'timeout_seconds', 'weight'])
+
+
+def parse_lanes(text, timeout_seconds=90):
+    """Parses a description of lanes, like the module docstring shows.
+
+    Args:
+      text: string, the description.  Empty means one lane for everything.
+      timeout_seconds: int, the deadline of the lane when text is empty.
+    Returns:
+      A list of Lanes, smallest first.
+    Raises:
+      ValueError if text doesn't describe lanes.
+    """
+    if not text:
+        return [Lane('default', None, timeout_seconds, 1)]
+    lanes = []
+    for part in text.split(','):
+        name, max_size, timeout, weight = part.strip().split(':')
+        lanes.append(Lane(name, int(max_size) if max_size else None,
+                          int(timeout), int(weight)))
+    sizes = [lane.max_size for lane in lanes[:-1]]
+    if (None in sizes or sizes != sorted(sizes) or
+            lanes[-1].max_size is not None):
+        raise ValueError('Lanes must grow, and the last must fit any size: '
+                         + text)
+    if min(lane.weight for lane in lanes) < 1:
+        raise ValueError('Lane weights must be at least 1: ' + text)
+    names = [lane.name for lane in lanes]
+    if len(set(names)) < len(names):
+        raise ValueError('Lane names must be unique: ' + text)
+    for name in names:
+        if not _NAME_RE.match(name):
+            raise ValueError('Bad lane name %r: %s' % (name, text))
+    return lanes
+
+
+def lane_for(lanes, size):
+    """Returns the lane for a text of length size."""
+    for lane in lanes:
+        if lane.max_size is None or size <= lane.max_size:
+            return lane
+
+
+def _base(lanes, lane, base):
+    return base if lane == lanes[-1] else '%s-%s' % (base, lane.name)
+
+
+def topic_name(lanes, lane, shard, base=shards.TOPIC):
+    """Returns the name of the topic of a lane and shard."""
+    return shards.topic_name(shard, _base(lanes, lane, base))
+
+
+def subscription_name(lanes, lane, shard, base=shards.SUBSCRIPTION):
+    """Returns the name of the subscription of a lane and shard."""
+    return shards.subscription_name(shard, _base(lanes, lane, base))
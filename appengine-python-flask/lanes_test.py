@@ -0,0 +1,67 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import lanes
+
+
+class ParseLanesTest(unittest.TestCase):
+    def test_empty_means_one_lane(self):
+        for text in ('', None):
+            self.assertEqual([lanes.Lane('default', None, 45, 1)],
+                             lanes.parse_lanes(text, 45))
+
+    def test_parse(self):
+        self.assertEqual([lanes.Lane('short', 1000, 30, 4),
+                          lanes.Lane('long', None, 90, 1)],
+                         lanes.parse_lanes('short:1000:30:4, long::90:1'))
+        self.assertEqual(['extra-long_2', 'x'], [
+            lane.name
+            for lane in lanes.parse_lanes('extra-long_2:9:1:1,x::1:1')])
+
+    def test_bad_lanes(self):
+        for text in ('a::1:1,b::1:1',  # Only the last may fit any size.
+                     'a:10:1:1',  # The last must fit any size.
+                     'a:100:1:1,b:10:1:1,c::1:1',  # Sizes must grow.
+                     'a:10:1:0,b::1:1',  # Weights must be positive.
+                     'a:10:1',
+                     'a:10:1:1,a::1:1',  # Names must be unique.
+                     '2:10:1:1,b::1:1',  # Would be the topic of shard 2.
+                     'a-2:10:1:1,b::1:1',  # Or lane a's shard 2.
+                     'a b:10:1:1,b::1:1',
+                     ':10:1:1,b::1:1'):
+            self.assertRaises(ValueError, lanes.parse_lanes, text)
+
+    def test_lane_for(self):
+        all_lanes = lanes.parse_lanes(
+            'short:10:30:4,medium:100:60:2,long::90:1')
+        self.assertEqual('short', lanes.lane_for(all_lanes, 0).name)
+        self.assertEqual('short', lanes.lane_for(all_lanes, 10).name)
+        self.assertEqual('medium', lanes.lane_for(all_lanes, 11).name)
+        self.assertEqual('long', lanes.lane_for(all_lanes, 10 ** 6).name)
+
+    def test_last_lane_keeps_original_names(self):
+        all_lanes = lanes.parse_lanes('short:10:30:4,long::90:1')
+        short, long_lane = all_lanes
+        self.assertEqual('shout-requests',
+                         lanes.topic_name(all_lanes, long_lane, 0))
+        self.assertEqual('shout-request-workers-2',
+                         lanes.subscription_name(all_lanes, long_lane, 2))
+        self.assertEqual('shout-requests-short-2',
+                         lanes.topic_name(all_lanes, short, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
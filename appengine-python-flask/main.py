@@ -33,30 +33,48 @@ This means it will be easy to implement new clients besides the javascript
 client contained in form.html, and that major changes to the server will not
 require changes in clients.
 """
+import admission
+import calendar
+import functools
 import json
+import logging
 import os
 import random
 import string
 import time
 import datetime
+import lanes
+import metrics
+import notify
+import poll_schedule
 import pubsub
+import pubsub_emulator
+import result_cache
 import traceback
 import werkzeug.urls
 import socket
 import rotoken
+import shards
+import status_cache
+import status_store
 
 import flask
 from flask import Flask, request
 import jinja2
 
 from google.appengine.api import app_identity
+from google.appengine.api import memcache
 from google.appengine.api import modules
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 app = Flask(__name__)
 app.config['DEBUG'] = True
+metrics.instrument_app(app)
 # Where my rotating tokens are kept.
-purse = rotoken.Rotoken(modules.get_current_version_name())
+purse = metrics.instrument(
+    rotoken.Rotoken(modules.get_current_version_name()), 'rotoken',
+    ['init', 'rotate_token', 'get_tokens', 'is_valid'])
 
 JINJA_ENVIRONMENT = jinja2.Environment(
     loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(__file__),
@@ -64,16 +82,53 @@ JINJA_ENVIRONMENT = jinja2.Environment(
     extensions=['jinja2.ext.autoescape'],
     autoescape=True)
 
-TOPIC = "shout-requests"
-SUBSCRIPTION = "shout-request-workers"
+# Wakes up status_changes() when post_shout_status() writes a status.
+# Set SHOUT_NOTIFY_BACKEND=local in app.yaml's env_variables to keep
+# notifications inside one instance.
+if os.environ.get('SHOUT_NOTIFY_BACKEND') == 'local':
+    hub = notify.NotificationHub(notify.LocalBackend())
+else:
+    hub = notify.NotificationHub(notify.MemcacheBackend())
+
+TOPIC = shards.TOPIC
+SUBSCRIPTION = shards.SUBSCRIPTION
 TIMEOUT_SECONDS = 90
+# How many topic and subscription pairs shout requests are spread across.
+# See shards.py before changing it.
+SHARD_COUNT = int(os.environ.get('SHOUT_SHARDS', 1))
+# Separates short shout requests from long ones, so long ones can't starve
+# them.  See lanes.py for the format of SHOUT_LANES.  Workers must be given
+# the same lanes with worker.py --lanes.
+LANES = lanes.parse_lanes(os.environ.get('SHOUT_LANES'), TIMEOUT_SECONDS)
+# By this long after it's published, a shout request has finished, or been
+# lost.  The worker reports it fatal once its deadline passes.
+MAX_SHOUT_SECONDS = max(lane.timeout_seconds for lane in LANES) + 60
 APP_ID = app_identity.get_application_id()
 RANDOM_ID_LEN = 43  # Equivalent to 256 bits of randomness.
+# How many entities purge() deletes with one RPC.
+PURGE_BATCH_SIZE = 500
+# When purge() has run this long, it continues in a new task.
+PURGE_TIME_BUDGET_SECONDS = 60
+# Longest status_changes() waits for a signal before checking datastore.
+MAX_RECHECK_SECONDS = 15
+# Decides when status_changes() re-checks datastore without a signal.  Set
+# SHOUT_POLL_SCHEDULE=backoff in app.yaml's env_variables to back off
+# exponentially instead of learning when shouts finish.
+poll_scheduler = poll_schedule.new_schedule(
+    os.environ.get('SHOUT_POLL_SCHEDULE'), MAX_RECHECK_SECONDS)
+# Most shouts one shout_status_multi() request may watch.
+MAX_WATCHED_SHOUTS = 100
+# How long the result cache remembers the result of shouting a text.
+RESULT_TTL_SECONDS = 24 * 60 * 60
+# shard_stats() also reports removed shards below this number.
+MAX_REPORTED_SHARDS = 64
 
 ###############################################################################
 # Data model.
-STATUSES = ('a-new', 'b-shouting', 'c-error', 'd-fatal', 'e-success')
-STATUS_MAP = dict((status.split('-')[1], status) for status in STATUSES)
+STATUSES = status_store.STATUSES
+STATUS_MAP = status_store.STATUS_MAP
+# A shout request's status never changes after it reaches one of these.
+FINAL_STATUSES = ('success', 'fatal')
 ID_CHARS = string.ascii_letters + string.digits
 assert pow(len(ID_CHARS), RANDOM_ID_LEN) > pow(2, 256)
 
@@ -139,6 +194,338 @@ class ShoutStatusLog(ndb.Model):
         return self.status.split('-')[1] if self.status else ''
 
 
+class NdbStatusStore(status_store.StatusStore):
+    """Keeps the status log in datastore, as ShoutStatusLog entities."""
+
+    def put_multi_async(self, records):
+        return ndb.put_multi_async([ShoutStatusLog(
+            combined_shout_id=record.combined_shout_id, status=record.status,
+            error=record.error, result=record.result, host=record.host)
+            for record in records])
+
+    def get_current(self, combined_shout_id):
+        ndb.get_context().set_cache_policy(False)
+        entities = self._current_query(combined_shout_id).fetch(1)
+        return entities[0] if entities else None
+
+    def get_current_multi(self, combined_shout_ids):
+        """Runs the queries for every shout in parallel."""
+        ndb.get_context().set_cache_policy(False)
+        futures = [(combined_shout_id,
+                    self._current_query(combined_shout_id).fetch_async(1))
+                   for combined_shout_id in combined_shout_ids]
+        current = {}
+        for combined_shout_id, future in futures:
+            entities = future.get_result()
+            current[combined_shout_id] = entities[0] if entities else None
+        return current
+
+    def get_submitted(self, combined_shout_id):
+        entities = (ShoutStatusLog.query()
+                    .filter(ShoutStatusLog.combined_shout_id ==
+                            combined_shout_id)
+                    .filter(ShoutStatusLog.status == STATUSES[0])
+                    .fetch(1))
+        return entities[0].timestamp if entities else None
+
+    @staticmethod
+    def _current_query(combined_shout_id):
+        return (ShoutStatusLog.query()
+                .filter(ShoutStatusLog.combined_shout_id == combined_shout_id)
+                .order(-ShoutStatusLog.status))
+
+    def purge(self, too_old, cursor=None, time_budget_seconds=None):
+        return self._purge(ShoutStatusLog, too_old, cursor,
+                           time_budget_seconds)
+
+    @staticmethod
+    def _purge(model, too_old, cursor, time_budget_seconds):
+        """Walks the keys of old entities a page at a time, and deletes each
+        page with one batch RPC while fetching the next page.
+
+        Always purges at least one page, so every call makes progress.
+        """
+        start_timestamp = time.time()
+        if cursor:
+            cursor = ndb.Cursor(urlsafe=cursor)
+        q = model.query(model.timestamp < too_old)
+        deleted = 0
+        deletes = []
+        more = True
+        while more:
+            keys, cursor, more = q.fetch_page(
+                PURGE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+            # Let the previous page's delete finish before starting the next,
+            # so only one delete RPC is in flight at a time.
+            for future in deletes:
+                future.get_result()
+            deletes = ndb.delete_multi_async(keys)
+            deleted += len(keys)
+            if (time_budget_seconds is not None and
+                    time.time() - start_timestamp >= time_budget_seconds):
+                break
+        for future in deletes:
+            future.get_result()
+        return deleted, cursor.urlsafe() if more and cursor else None
+
+
+class CurrentShoutStatus(ndb.Model):
+    """The current status of a shout request.  Its key id is the combined
+    shout id.
+
+    A copy of the highest priority ShoutStatusLog entity, so the current
+    status is a strongly consistent key lookup instead of a query.  Has the
+    same properties as ShoutStatusLog, except that timestamp is when the
+    status was last written.
+    """
+    status = ndb.StringProperty(choices=STATUSES, indexed=False)
+    timestamp = ndb.DateTimeProperty(auto_now=True)
+    error = ndb.StringProperty(indexed=False)
+    result = ndb.StringProperty(indexed=False)
+    host = ndb.StringProperty(indexed=False)
+
+    @property
+    def combined_shout_id(self):
+        return self.key.id()
+
+    @property
+    def status_name(self):
+        """Strips the status code and returns the status name."""
+        return self.status.split('-')[1] if self.status else ''
+
+
+class CurrentStatusStore(NdbStatusStore):
+    """Keeps the status log in datastore, plus a CurrentShoutStatus entity
+    per shout, and reads the current status from that.
+
+    Every write appends to the log, and updates the CurrentShoutStatus in a
+    transaction unless it already holds a higher priority status.  Among
+    equal statuses, the last write wins, like in the log.
+    """
+
+    def put_multi_async(self, records):
+        return [self._put_async(record) for record in records]
+
+    @ndb.tasklet
+    def _put_async(self, record):
+        yield (ShoutStatusLog(
+            combined_shout_id=record.combined_shout_id, status=record.status,
+            error=record.error, result=record.result,
+            host=record.host).put_async(),
+            self._update_current_async(record))
+
+    @ndb.transactional_tasklet
+    def _update_current_async(self, record):
+        key = ndb.Key(CurrentShoutStatus, record.combined_shout_id)
+        current = yield key.get_async()
+        if current and current.status > record.status:
+            return
+        yield CurrentShoutStatus(
+            key=key, status=record.status, error=record.error,
+            result=record.result, host=record.host).put_async()
+
+    def get_current(self, combined_shout_id):
+        # Skip the in-context cache, which would hide other requests'
+        # writes while we poll.  Memcache is kept in sync by ndb.
+        return ndb.Key(CurrentShoutStatus, combined_shout_id).get(
+            use_cache=False)
+
+    def get_current_multi(self, combined_shout_ids):
+        combined_shout_ids = list(combined_shout_ids)
+        entities = ndb.get_multi(
+            [ndb.Key(CurrentShoutStatus, combined_shout_id)
+             for combined_shout_id in combined_shout_ids], use_cache=False)
+        return dict(zip(combined_shout_ids, entities))
+
+    def purge(self, too_old, cursor=None, time_budget_seconds=None):
+        """Purges the log, then the CurrentShoutStatus entities."""
+        start_timestamp = time.time()
+        kind, _, cursor = (cursor or 'log:').partition(':')
+        deleted = 0
+        if kind == 'log':
+            deleted, cursor = self._purge(ShoutStatusLog, too_old,
+                                          cursor or None, time_budget_seconds)
+            if cursor:
+                return deleted, 'log:' + cursor
+            if time_budget_seconds is not None:
+                time_budget_seconds -= time.time() - start_timestamp
+                if time_budget_seconds <= 0:
+                    return deleted, 'current:'
+        more, cursor = self._purge(CurrentShoutStatus, too_old,
+                                   cursor or None, time_budget_seconds)
+        return deleted + more, 'current:' + cursor if cursor else None
+
+
+def new_status_store():
+    """Returns the StatusStore named by the SHOUT_STATUS_STORE environment
+    variable.
+
+    'memory' and 'sqlite' keep the status log on this machine, for running
+    and measuring the web tier without datastore.  SHOUT_SQLITE_PATH names
+    the SQLite database file.  'current' means datastore, reading the
+    current status from CurrentShoutStatus entities.  Anything else means
+    datastore, querying the status log.
+    """
+    kind = os.environ.get('SHOUT_STATUS_STORE')
+    if kind == 'current':
+        return CurrentStatusStore()
+    if kind == 'memory':
+        return status_store.MemoryStatusStore()
+    if kind == 'sqlite':
+        return status_store.SqliteStatusStore(
+            os.environ.get('SHOUT_SQLITE_PATH', ':memory:'))
+    return NdbStatusStore()
+
+
+def new_pubsub():
+    """Returns the PubSub named by the SHOUT_PUBSUB environment variable.
+
+    'local' means the in-process pubsub_emulator, for running the web app and
+    the workers together on one machine.  Anything else means Cloud Pub/Sub.
+    """
+    if os.environ.get('SHOUT_PUBSUB') == 'local':
+        return pubsub_emulator.LocalPubSub(APP_ID, payload_codec)
+    return pubsub.PubSub(APP_ID, payload_codec)
+
+
+def new_payload_codec():
+    """Returns the PayloadCodec for shout request messages.
+
+    By default, texts are published as they are.  When the
+    SHOUT_COMPRESS_BYTES environment variable is set, texts longer than that
+    many bytes are compressed.  Only worker.py understands compressed
+    messages, so leave it unset while the C# workers serve any subscription.
+
+    When the app and its workers run on one machine, and SHOUT_BLOB_DIR
+    names a directory they share, texts still over 1MB are kept there
+    instead of in the message.  On App Engine, the file system is read-only
+    and not shared with the workers, so SHOUT_BLOB_DIR is ignored.
+    """
+    compress_bytes = os.environ.get('SHOUT_COMPRESS_BYTES')
+    blob_dir = os.environ.get('SHOUT_BLOB_DIR')
+    if blob_dir and os.environ.get('SERVER_SOFTWARE', '').startswith(
+            'Google App Engine'):
+        logging.warning('Ignoring SHOUT_BLOB_DIR on App Engine.')
+        blob_dir = None
+    return pubsub.PayloadCodec(
+        compress_bytes=int(compress_bytes) if compress_bytes else None,
+        blob_store=pubsub.FileBlobStore(blob_dir) if blob_dir else None)
+
+
+payload_codec = new_payload_codec()
+
+
+def status_host_url():
+    """Returns the scheme and host workers should post statuses to."""
+    if os.environ.get('SHOUT_PUBSUB') == 'local':
+        # The workers run in this process, so they can reach us at whatever
+        # address the browser used.
+        return request.host_url.rstrip('/')
+    return 'https://%s' % socket.getfqdn(socket.gethostname())
+
+
+# Where the status log is kept.
+def cache_status_store(store):
+    """Wraps store with the status cache named by the SHOUT_STATUS_CACHE
+    environment variable.
+
+    'local' keeps the cache in this instance.  'none' turns it off.
+    Anything else means memcache.
+    """
+    kind = os.environ.get('SHOUT_STATUS_CACHE')
+    if kind == 'none':
+        return store
+    if kind == 'local':
+        return status_cache.CachingStatusStore(store, status_cache.LruCache())
+    return status_cache.CachingStatusStore(store,
+                                           status_cache.MemcacheCache())
+
+
+def new_result_cache():
+    """Returns the ResultCache and Flights named by the SHOUT_RESULT_CACHE
+    environment variable.
+
+    'local' keeps both in this instance.  'none' turns both off, and returns
+    (None, None).  Anything else keeps results in this instance in front of
+    memcache, and flights in memcache, so every instance shares them.
+    """
+    kind = os.environ.get('SHOUT_RESULT_CACHE')
+    if kind == 'none':
+        return None, None
+    local_results = status_cache.LruCache(max_entries=1000,
+                                          ttl_seconds=RESULT_TTL_SECONDS)
+    # A flight lasts as long as its shout may.
+    flight_ttl_seconds = MAX_SHOUT_SECONDS
+    if kind == 'local':
+        return (result_cache.ResultCache(local_results),
+                result_cache.Flights(status_cache.LruCache(
+                    ttl_seconds=flight_ttl_seconds)))
+    return (result_cache.ResultCache(local_results, status_cache.MemcacheCache(
+                'results', RESULT_TTL_SECONDS)),
+            result_cache.Flights(status_cache.MemcacheCache(
+                'flights', flight_ttl_seconds)))
+
+
+shout_results, flights = new_result_cache()
+# Where count_shard_event() counts, in the 'shards' namespace.
+shard_counts = metrics.instrument(memcache.Client(), 'memcache',
+                                  ['add', 'get_multi', 'incr'])
+
+
+def shard_event_key(event, shard, lane):
+    """Returns the memcache key that count_shard_event() counts in."""
+    return '%s-%d-%s' % (event, shard, lane)
+
+
+def lane_totals():
+    """Returns a dict mapping each lane's name to a tuple (published,
+    finished) of how many shout requests every shard has published to and
+    finished from the lane, counted by count_shard_event().
+
+    A finished count is missing until the first shout request in its shard
+    and lane finishes, so it counts as 0.  Returns None if memcache forgot a
+    published count but not its finished count, because then the
+    difference means nothing.
+    """
+    keys = [shard_event_key(event, shard, lane.name)
+            for shard in range(SHARD_COUNT) for lane in LANES
+            for event in ('published', 'finished')]
+    counts = shard_counts.get_multi(keys, namespace='shards')
+    totals = {}
+    for lane in LANES:
+        published = finished = 0
+        for shard in range(SHARD_COUNT):
+            shard_published = counts.get(
+                shard_event_key('published', shard, lane.name))
+            shard_finished = counts.get(
+                shard_event_key('finished', shard, lane.name))
+            if shard_published is None and shard_finished is not None:
+                return None
+            published += shard_published or 0
+            finished += shard_finished or 0
+        totals[lane.name] = (published, finished)
+    return totals
+
+
+def new_admission_controller():
+    """Returns an AdmissionController limited by the environment variables
+    SHOUT_MAX_INSTANCE_SHOUTS, most shouts one instance may have open, and
+    SHOUT_MAX_BACKLOG, most shout requests waiting for workers.  Without
+    them, it only turns shouts away that would time out in the queue.
+    """
+    limits = [int(os.environ[name]) if os.environ.get(name) else None
+              for name in ('SHOUT_MAX_INSTANCE_SHOUTS', 'SHOUT_MAX_BACKLOG')]
+    return admission.AdmissionController(
+        lane_totals, *limits, expire_seconds=MAX_SHOUT_SECONDS)
+
+
+admission_control = new_admission_controller()
+store = cache_status_store(metrics.instrument(
+    new_status_store(), 'datastore',
+    ['put_async', 'put_multi_async', 'get_current', 'get_current_multi',
+     'get_submitted', 'purge']))
+
+
 ###############################################################################
 # HTTP handlers.
 
@@ -162,6 +549,12 @@ def connect():
             'method': 'POST',
             'token': token,
         },
+        # And how to watch many of them at once.
+        'shoutStatusMultiLink': {
+            'target': 'shout_status_multi',
+            'method': 'POST',
+            'token': token,
+        },
     })
 
 
@@ -169,30 +562,118 @@ def connect():
 def shout():
     """Creates a new shout request.  Returns status of the pending request."""
     token = werkzeug.urls.url_decode(request.form['token'])
-    # Insert a status log entity into data store.
-    entity = ShoutStatusLog()
-    entity.combined_shout_id = combine_ids(token['browserId'],
-                                           request.form['shoutId'])
-    entity.status = STATUS_MAP['new']
-    entity.host = socket.gethostname()
-    async_put = entity.put_async()
-
-    # Publish a shout request message to the Pub/Sub topic.
-    deadline = utctimestamp() + TIMEOUT_SECONDS
-    ps = pubsub.PubSub(APP_ID)
-    query = werkzeug.urls.url_encode({
-        'browserId': token['browserId'],
-        'shoutId': request.form['shoutId'],
-    })
-    ps.publish(TOPIC, request.form['text'], {
+    browser_id = token['browserId']
+    shout_id = request.form['shoutId']
+    text = request.form['text']
+    combined_id = combine_ids(browser_id, shout_id)
+    text_key = result_cache.text_key(text)
+    result = shout_results.get(text_key) if shout_results else None
+    if result is not None:
+        # This text was shouted before, so don't bother a worker.
+        store.put_async(status_store.StatusRecord(
+            combined_id, STATUS_MAP['success'], result=result,
+            host=socket.gethostname())).get_result()
+        return poll_shout_status(browser_id, shout_id, 'new')
+
+    # Turn the shout away now if it would time out waiting for a worker.
+    lane = lanes.lane_for(LANES, len(text))
+    rejection = admission_control.check(lane.name, lane.timeout_seconds)
+    if rejection:
+        return overloaded_response(shout_id, rejection)
+    with admission_control.holding():
+        # Insert a status into the status log.
+        async_put = store.put_async(status_store.StatusRecord(
+            combined_id, STATUS_MAP['new'], host=socket.gethostname()))
+        timing = {'submitted': time.time(), 'size': len(text)}
+        # When the same text is already being shouted, wait for its result
+        # instead of publishing another request.
+        flight_id, leader = None, True
+        if flights:
+            flight_id, leader = flights.join(text_key, combined_id)
+        if leader:
+            publish_shout_request(browser_id, shout_id, text, flight_id)
+        async_put.get_result()
+        # Wait for a result.
+        return poll_shout_status(browser_id, shout_id, 'new', timing)
+
+
+def overloaded_response(shout_id, rejection):
+    """Tells the browser to shout again later.
+
+    Returns:
+      A flask http response, with a retryLink that says when to post the
+      same form to /shout again.
+    """
+    response = {
+        'shoutId': shout_id,
+        'error': 'Too busy (%s).  Trying again in %d seconds.' % (
+            rejection.reason, rejection.retry_after_seconds),
+        'retryLink': {
+            'target': 'shout',
+            'method': 'POST',
+            'token': request.form['token'],
+            'delaySeconds': rejection.retry_after_seconds,
+        },
+    }
+    return json.dumps(response), rejection.code, {
+        'Retry-After': str(rejection.retry_after_seconds)}
+
+
+def publish_shout_request(browser_id, shout_id, text, flight_id=None):
+    """Queues a shout request message for the Pub/Sub topic.
+
+    It's published in a batch with other shout requests, so doesn't wait
+    for it.
+
+    Args:
+      flight_id: string, the id of the flight the shout leads, or None.
+    """
+    lane = lanes.lane_for(LANES, len(text))
+    deadline = utctimestamp() + lane.timeout_seconds
+    ps = new_pubsub()
+    shard = shards.shard_for(browser_id, SHARD_COUNT)
+    params = {
+        'browserId': browser_id,
+        'shoutId': shout_id,
+        'shard': shard,
+        'lane': lane.name,
+    }
+    if flight_id:
+        params['flightId'] = flight_id
+    query = werkzeug.urls.url_encode(params)
+    status_url = status_host_url()
+    count_shard_event(shard, lane.name, 'published')
+    topic = lanes.topic_name(LANES, lane, shard)
+    future = ps.publish_async(topic, text, {
         'deadline': str(deadline),
-        'postStatusUrl': 'https://%s/post_shout_status?%s' %
-                         (socket.getfqdn(socket.gethostname()), query),
+        'lane': lane.name,
+        'shard': str(shard),
+        'postStatusUrl': '%s/post_shout_status?%s' % (status_url, query),
+        'postStatusBatchUrl': '%s/post_shout_status_batch' % status_url,
         'postStatusToken': purse.get_tokens()[0],
     })
-    async_put.get_result()
-    # Wait for a result.
-    return poll_shout_status(token['browserId'], request.form['shoutId'], 'new')
+    future.add_done_callback(functools.partial(
+        report_publish_failure, browser_id, shout_id, shard, lane.name,
+        flight_id))
+
+
+def report_publish_failure(browser_id, shout_id, shard, lane, flight_id,
+                           future):
+    """Marks the shout fatal if its request message could not be published.
+
+    Otherwise, the browser would wait for a worker that will never come.
+    """
+    if not future.exception():
+        return
+    logging.error('Failed to publish shout request %s: %s', shout_id,
+                  future.exception())
+    record = new_status_record(browser_id, shout_id, 'fatal',
+                               'Failed to queue the shout request.',
+                               socket.gethostname())
+    store.put_async(record).get_result()
+    hub.signal(record.combined_shout_id)
+    count_shard_event(shard, lane, 'finished')
+    copy_to_followers(flight_id, record)
 
 
 @app.route('/shout_status', methods=['POST'])
@@ -200,11 +681,14 @@ def shout_status():
     """Check on the status of a pending shout request."""
     token = werkzeug.urls.url_decode(request.form['token'])
     return poll_shout_status(token['browserId'], token['shoutId'],
-                             token['status'])
+                             token['status'], shout_timing(token))
+
 
+def poll_shout_status(browser_id, shout_id, last_status, timing=None):
+    """Wait for the shout request to complete.
 
-def poll_shout_status(browser_id, shout_id, last_status):
-    """Poll datastore waiting for the shout request to complete.
+    Rather than polling datastore in a loop, we sleep until
+    post_shout_status() signals the notification hub that the status changed.
 
     Why not return the status immediately?
     That would work too, but then the browser would be constantly sending new
@@ -219,51 +703,262 @@ def poll_shout_status(browser_id, shout_id, last_status):
     Args:
         name: string, the name of the request.
         last_status: string, the last status observed by the user.
-        deadline: datetime.datetime, when this request should time out.
+        timing: dict, what the poll schedule knows about the shout.  See
+          shout_timing().
     Returns:
         A flask http response.
     """
-    response = {'shoutId': shout_id, 'status': last_status}
+    for response in status_changes(browser_id, shout_id, last_status,
+                                   timing):
+        if response['status'] in FINAL_STATUSES:
+            return json.dumps(response)
+        # State changed, notify user.
+        break
+    else:
+        response = {'shoutId': shout_id, 'status': last_status}
+    response['nextLink'] = status_link('shout_status', browser_id, shout_id,
+                                       response['status'], timing)
+    response['streamLink'] = status_link('shout_status_stream', browser_id,
+                                         shout_id, response['status'], timing)
+    return json.dumps(response), 202
+
+
+@app.route('/shout_status_stream', methods=['POST'])
+def shout_status_stream():
+    """Streams every status change of a pending shout request.
+
+    Takes the same token as shout_status(), but keeps the response open and
+    writes each change as a server-sent event whose data is the JSON object
+    shout_status() would have returned.  The stream ends after the success
+    or fatal event, or, when the 45 second window runs out, after an event
+    whose nextLink resumes the stream.
+
+    Only saves requests where responses really stream.  App Engine standard
+    buffers the whole response, so there the events arrive all at once when
+    the stream ends, like one long poll.  EventSource can only GET, so
+    browsers must read the stream with fetch() instead.
+    """
+    token = werkzeug.urls.url_decode(request.form['token'])
+    browser_id = token['browserId']
+    shout_id = token['shoutId']
+    timing = shout_timing(token)
+
+    def events():
+        status = token['status']
+        for response in status_changes(browser_id, shout_id, status, timing):
+            status = response['status']
+            yield 'data: %s\n\n' % json.dumps(response)
+        if status not in FINAL_STATUSES:
+            yield 'data: %s\n\n' % json.dumps({
+                'shoutId': shout_id,
+                'status': status,
+                'nextLink': status_link('shout_status_stream', browser_id,
+                                        shout_id, status, timing),
+            })
+
+    return flask.Response(flask.stream_with_context(events()),
+                          mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache'})
+
+
+def status_changes(browser_id, shout_id, last_status, timing=None,
+                   window_seconds=45):
+    """Yields the status each time it changes, for up to window_seconds.
+
+    Stops after yielding success or fatal.  Each status is a dict with
+    members shoutId, status, and result or error.
+    """
     start_timestamp = time.time()
-    ndb.get_context().set_cache_policy(False)
-    sleep_seconds = 0.1
+    combined_id = combine_ids(browser_id, shout_id)
+    timing = timing or {}
+    submitted = timing.get('submitted')
+    deadline = None
+    if submitted is not None:
+        deadline = submitted + TIMEOUT_SECONDS
+        if 'size' in timing:
+            deadline = (submitted +
+                        lanes.lane_for(LANES, timing['size']).timeout_seconds)
+    plan = poll_scheduler.start(submitted, timing.get('size'), deadline)
+    rechecked = False
     while True:
-        # Look up the current status in datastore.
-        q = (ShoutStatusLog.query()
-             .filter(ShoutStatusLog.combined_shout_id == combine_ids(
-                     browser_id, shout_id))
-             .order(-ShoutStatusLog.status))
-        entities = q.fetch(1)
-        if entities:
-            entity = entities[0]
-            status = response['status'] = entity.status_name
-            if status == 'success':
-                response['result'] = entity.result
-                return json.dumps(response)
-            if status == 'fatal':
-                response['error'] = entity.error
-                return json.dumps(response)
-            if last_status != status:
-                # State changed, notify user.
-                response['error'] = entity.error
-                break
+        # Read the version before looking at datastore, so we can't miss a
+        # signal sent while we're looking.
+        version = hub.version(combined_id)
+        # Look up the current status in the status log.
+        metrics.POLL_ITERATIONS.inc()
+        entity = store.get_current(combined_id)
+        changed = bool(entity) and entity.status_name != last_status
+        if rechecked:
+            poll_scheduler.record_check(changed)
+        if entity and (changed or entity.status_name in FINAL_STATUSES):
+            if changed:
+                observe_delivery(entity)
+                if entity.status_name == 'success':
+                    observe_completion(entity)
+            last_status = entity.status_name
+            yield status_response(shout_id, entity)
+            if last_status in FINAL_STATUSES:
+                return
+
+        # Wait for post_shout_status() to signal a change.  Re-check
+        # datastore when the poll schedule says to anyway, in case a signal
+        # was lost.
+        remaining = window_seconds - (time.time() - start_timestamp)
+        if remaining <= 0:
+            return
+        with metrics.POLL_WAIT_SECONDS.time():
+            signaled = hub.wait(combined_id, version,
+                                min(remaining, plan.next_wait()))
+        if signaled:
+            plan.signaled()
+        rechecked = not signaled
 
-        # Retry with exponential backoff, for a maximum of 45 seconds.
-        if time.time() - start_timestamp >= 45:
-            break
-        else:
-            time.sleep(sleep_seconds)  # Retry after small wait.
-            sleep_seconds = min(5, sleep_seconds * 2)
 
-    response['nextLink'] = {
-        'target': 'shout_status',
+def status_response(shout_id, entity):
+    """Returns the JSON-ready status of a shout request, from its current
+    status log entity.
+    """
+    response = {'shoutId': shout_id, 'status': entity.status_name}
+    if entity.status_name == 'success':
+        response['result'] = entity.result
+    else:
+        response['error'] = entity.error
+    return response
+
+
+@app.route('/shout_status_multi', methods=['POST'])
+def shout_status_multi():
+    """Waits for any of a browser's pending shout requests to change.
+
+    Lets a browser with many shouts in flight hold one long poll instead of
+    one per shout.  The form contains:
+      token:  the token from the shoutStatusMultiLink returned by connect().
+      statuses:  a JSON object mapping each shout id to watch to the last
+        status the browser saw.
+    Returns:
+      A JSON object whose 'shouts' member maps the shout id of every shout
+      whose status changed to what shout_status() would have returned.  If
+      nothing changed in 45 seconds, 'shouts' is empty and the HTTP status
+      is 202.  Either way, 'nextLink' lets the browser keep watching.
+    """
+    token = werkzeug.urls.url_decode(request.form['token'])
+    try:
+        last_statuses = json.loads(request.form['statuses'])
+    except ValueError:
+        flask.abort(400)
+    if (not isinstance(last_statuses, dict) or
+            len(last_statuses) > MAX_WATCHED_SHOUTS):
+        flask.abort(400)
+    changes = poll_many_shout_statuses(token['browserId'], last_statuses)
+    response = {
+        'shouts': changes,
+        'nextLink': {
+            'target': 'shout_status_multi',
+            'method': 'POST',
+            'token': request.form['token'],
+        },
+    }
+    return json.dumps(response), 200 if changes else 202
+
+
+def poll_many_shout_statuses(browser_id, last_statuses, window_seconds=45):
+    """Waits up to window_seconds for any of a browser's shouts to change.
+
+    Like status_changes(), but looks up every shout with one batched call to
+    the status log per iteration, and sleeps until any of them is signaled.
+
+    Args:
+      browser_id: string.
+      last_statuses: dict, maps shout ids to the last status the browser
+        saw.
+    Returns:
+      A dict mapping the id of every shout whose status changed to its
+      status_response().  Empty if none changed.
+    """
+    start_timestamp = time.time()
+    shout_ids = dict((combine_ids(browser_id, shout_id), shout_id)
+                     for shout_id in last_statuses)
+    plan = poll_scheduler.start()
+    while True:
+        versions = hub.versions(shout_ids)
+        metrics.POLL_ITERATIONS.inc()
+        changes = {}
+        for combined_id, entity in store.get_current_multi(
+                shout_ids).iteritems():
+            shout_id = shout_ids[combined_id]
+            if entity and entity.status_name != last_statuses[shout_id]:
+                observe_delivery(entity)
+                changes[shout_id] = status_response(shout_id, entity)
+        if changes:
+            return changes
+
+        remaining = window_seconds - (time.time() - start_timestamp)
+        if remaining <= 0 or not shout_ids:
+            return changes
+        with metrics.POLL_WAIT_SECONDS.time():
+            signaled = hub.wait_any(versions,
+                                    min(remaining, plan.next_wait()))
+        if signaled:
+            plan.signaled()
+
+
+def status_link(target, browser_id, shout_id, status, timing=None):
+    """Returns a link that continues watching a shout request's status."""
+    token = dict(timing or {})
+    token.update({
+        'browserId': browser_id,
+        'shoutId': shout_id,
+        'status': status
+    })
+    return {
+        'target': target,
         'method': 'POST',
-        'token': werkzeug.urls.url_encode({
-            'browserId': browser_id,
-            'shoutId': shout_id,
-            'status': response['status']
-        })}
-    return json.dumps(response), 202
+        'token': werkzeug.urls.url_encode(token)}
+
+
+def shout_timing(token):
+    """Returns what the poll schedule knows about a shout, from a token made
+    by status_link().
+
+    Returns:
+      A dict with members submitted, when the shout was submitted in seconds
+      since the epoch, and size, the length of its text.  Empty if the token
+      doesn't say.
+    """
+    try:
+        return {'submitted': float(token['submitted']),
+                'size': int(token['size'])}
+    except (KeyError, ValueError):
+        return {}
+
+
+def observe_completion(entity):
+    """Teaches the poll schedule how long a successful shout took.
+
+    Trusts only what the app wrote itself: the times of the shout's new and
+    success statuses, and the length of the result, which is the length of
+    the text.  Never the browser's token, which may be forged.  Shouts
+    answered from the result cache have no new status, so teach nothing.
+    """
+    if not entity.timestamp or entity.result is None:
+        return
+    submitted = store.get_submitted(entity.combined_shout_id)
+    if not submitted:
+        return
+    seconds = (entity.timestamp - submitted).total_seconds()
+    size = len(entity.result)
+    if 0 <= seconds <= lanes.lane_for(LANES, size).timeout_seconds:
+        poll_scheduler.observe_completion(size, seconds)
+
+
+def observe_delivery(entity):
+    """Records how long a status took to get from the status log to a
+    browser.
+    """
+    if entity.timestamp:
+        delay = datetime.datetime.utcnow() - entity.timestamp
+        metrics.STATUS_DELIVERY_SECONDS.observe(
+            delay.total_seconds(), status=entity.status_name)
 
 
 @app.route('/post_shout_status', methods=['POST'])
@@ -272,34 +967,157 @@ def post_shout_status():
 
     Called by our Windows worker processes.
     """
-    if request.form.get('token') not in purse.get_tokens():
+    if not purse.is_valid(request.form.get('token')):
         flask.abort(403)
-    entity = ShoutStatusLog()
-    entity.combined_shout_id = combine_ids(request.args['browserId'],
-                                           request.args['shoutId'])
-    entity.status = STATUS_MAP[request.form['status']]
-    if request.form['status'] in ('error', 'fatal'):
-        entity.error = request.form.get('result')
-    else:
-        entity.result = request.form.get('result')
-    entity.host = request.form.get('host')
-    entity.put()
+    record = new_status_record(
+        request.args['browserId'], request.args['shoutId'],
+        request.form['status'], request.form.get('result'),
+        request.form.get('host'))
+    store.put_async(record).get_result()
+    hub.signal(record.combined_shout_id)
+    if request.form['status'] in FINAL_STATUSES:
+        count_shard_event(request.args.get('shard'),
+                          request.args.get('lane'), 'finished')
+    copy_to_followers(request.args.get('flightId'), record)
     return '{}'
 
 
+@app.route('/post_shout_status_batch', methods=['POST'])
+def post_shout_status_batch():
+    """Stores many shout statuses at once.
+
+    Lets a busy worker report a batch of status changes with one HTTP request
+    and one datastore RPC.  The form contains:
+      token:  the same token post_shout_status() expects.
+      statuses:  a JSON array of objects with members
+        browserId, shoutId, status, result, host, and the shard, lane and
+        flightId from the postStatusUrl, if it has them.
+    Returns:
+      A JSON object whose 'results' member has one object per status, in the
+      same order.  Each is {'ok': true} or {'error': <message>}.
+    """
+    if not purse.is_valid(request.form.get('token')):
+        flask.abort(403)
+    try:
+        records = json.loads(request.form['statuses'])
+    except ValueError:
+        flask.abort(400)
+    if not isinstance(records, list):
+        flask.abort(400)
+    results = [None] * len(records)
+    status_records = []
+    indexes = []
+    for i, record in enumerate(records):
+        try:
+            status_records.append(new_status_record(
+                record['browserId'], record['shoutId'], record['status'],
+                record.get('result'), record.get('host')))
+            indexes.append(i)
+        except (KeyError, TypeError, AttributeError):
+            results[i] = {'error': 'Bad status record.'}
+    futures = store.put_multi_async(status_records)
+    for i, record, future in zip(indexes, status_records, futures):
+        try:
+            future.get_result()
+        except Exception as e:
+            logging.exception('Failed to store status.')
+            results[i] = {'error': str(e)}
+            continue
+        hub.signal(record.combined_shout_id)
+        results[i] = {'ok': True}
+        if records[i]['status'] in FINAL_STATUSES:
+            count_shard_event(records[i].get('shard'),
+                              records[i].get('lane'), 'finished')
+        copy_to_followers(records[i].get('flightId'), record)
+    return json.dumps({'results': results})
+
+
+def copy_to_followers(flight_id, record):
+    """Copies a status of a flight's leader to the shouts that joined it.
+
+    Once the status is final, lands the flight, and remembers a successful
+    result for the next shout of the same text.
+
+    Args:
+      flight_id: string, the flightId from the postStatusUrl, or None.
+      record: the StatusRecord just stored for the leader.
+    """
+    if not flight_id or not flights:
+        return
+    flight = flights.get(flight_id)
+    if not flight:
+        return
+    if record.status_name in FINAL_STATUSES:
+        if record.status_name == 'success':
+            # Before landing, so a shout that finds the flight landed finds
+            # the result.
+            shout_results.put(flight.text_key, record.result)
+        followers = flights.land(flight_id)
+    else:
+        followers = flight.followers
+    copies = [status_store.StatusRecord(
+        combined_id, record.status, record.error, record.result, record.host)
+        for combined_id in followers]
+    for copy, future in zip(copies, store.put_multi_async(copies)):
+        future.get_result()
+        hub.signal(copy.combined_shout_id)
+
+
+def new_status_record(browser_id, shout_id, status, result=None, host=None):
+    """Returns a new StatusRecord for a status reported by a worker.
+
+    Args:
+      status: string, a status name like 'success'.  See STATUS_MAP.
+      result: string, the shouted text, or the error message when status is
+        'error' or 'fatal'.
+      host: string, the name of the machine reporting the status.
+    Raises:
+      KeyError if status is not a status name.
+    """
+    record = status_store.StatusRecord(combine_ids(browser_id, shout_id),
+                                       STATUS_MAP[status], host=host)
+    if status in ('error', 'fatal'):
+        record.error = result
+    else:
+        record.result = result
+    return record
+
+
 def combine_ids(browser_id, shout_id):
     return '%s-%s' % (browser_id, shout_id)
 
 
 @app.route('/purge')
 def purge():
-    """Removes old entries from the datastore."""
-    too_old = datetime.datetime.utcnow() - datetime.timedelta(days=1)
-    q = ShoutStatusLog.query(ShoutStatusLog.timestamp < too_old)
-    keys = list(q.iter(keys_only=True))
-    for key in keys:
-        key.delete()
-    return "purged."
+    """Removes old entries from the status log.
+
+    When it runs low on time, it queues a task to continue from where it
+    left off.
+    """
+    start_timestamp = time.time()
+    if 'cutoff' in request.args:
+        too_old = datetime.datetime.utcfromtimestamp(
+            float(request.args['cutoff']))
+    else:
+        too_old = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    deleted, cursor = store.purge(too_old, request.args.get('cursor'),
+                                  PURGE_TIME_BUDGET_SECONDS)
+
+    elapsed = time.time() - start_timestamp
+    total = int(request.args.get('total', 0)) + deleted
+    message = 'purged %d entities in %.1f seconds (%.1f/second).' % (
+        deleted, elapsed, deleted / elapsed if elapsed else 0)
+    if cursor:
+        taskqueue.add(url='/purge', method='GET', params={
+            'cursor': cursor,
+            'cutoff': calendar.timegm(too_old.utctimetuple()),
+            'total': total,
+        })
+        message += '  Continuing in a new task.'
+    else:
+        message += '  %d entities purged in total.' % total
+    logging.info(message)
+    return message
 
 
 @app.route('/rotate_token')
@@ -313,15 +1131,27 @@ def rotate_token():
 
 @app.route('/init')
 def init():
-    """Called once by an admin to create pubsub topics and subscriptions."""
-    ps = pubsub.PubSub(APP_ID)
+    """Called by an admin to create pubsub topics and subscriptions.
+
+    Creates a topic and subscription for every lane of every shard.  Safe to
+    call again, for example after raising SHOUT_SHARDS or adding lanes.
+    """
+    ps = new_pubsub()
     errors = []
-    for lam in (
-            lambda: ps.create_topic(TOPIC),
-            lambda: ps.subscribe(TOPIC, SUBSCRIPTION),
-            lambda: purse.init(new_random_id())):
+    steps = []
+    for lane in LANES:
+        for shard in range(SHARD_COUNT):
+            topic = lanes.topic_name(LANES, lane, shard)
+            subscription = lanes.subscription_name(LANES, lane, shard)
+            steps.append(functools.partial(ps.create_topic, topic))
+            steps.append(functools.partial(ps.subscribe, topic,
+                                           subscription))
+    steps.append(lambda: purse.init(new_random_id()))
+    for lam in steps:
         try:
             lam()
+        except pubsub.AlreadyExists:
+            pass
         except:
             errors.append(traceback.format_exc())
     if errors:
@@ -329,6 +1159,77 @@ def init():
     return "ok"
 
 
+def count_shard_event(shard, lane, event):
+    """Counts a shout request published to or finished from a shard's lane.
+
+    The counts live in memcache, so they're shared by every instance, and
+    may be lost.  They're for watching backlogs, not for accounting.
+
+    Args:
+      shard: int, or a string from a query, or None if the worker that
+        reported the status didn't say.
+      lane: string, the name of the lane, or None if the worker didn't say.
+      event: string, 'published' or 'finished'.
+    """
+    try:
+        shard = int(shard)
+    except (TypeError, ValueError):
+        return
+    if lane not in [known.name for known in LANES]:
+        return
+    metrics.SHARD_MESSAGES.inc(shard=str(shard), lane=lane, event=event)
+    count = shard_counts.incr(shard_event_key(event, shard, lane),
+                              namespace='shards', initial_value=0)
+    if event == 'published' and count == 1:
+        # Start the finished count too, so lane_totals() sees both.
+        shard_counts.add(shard_event_key('finished', shard, lane), 0,
+                         namespace='shards')
+
+
+@app.route('/shards')
+def shard_stats():
+    """Reports how many shout requests each shard has published and
+    finished, and the difference, its backlog, in all and in each lane.
+
+    Shows every shard that has ever counted anything, so shards removed by
+    lowering SHOUT_SHARDS show up until their backlog drains.  Counts
+    since memcache last forgot them.
+    """
+    shard_range = range(max(SHARD_COUNT, MAX_REPORTED_SHARDS))
+    counts = shard_counts.get_multi(
+        [shard_event_key(event, shard, lane.name) for shard in shard_range
+         for lane in LANES for event in ('published', 'finished')],
+        namespace='shards')
+    report = []
+    for shard in shard_range:
+        lane_report = []
+        for lane in LANES:
+            published = counts.get(
+                shard_event_key('published', shard, lane.name))
+            finished = counts.get(
+                shard_event_key('finished', shard, lane.name))
+            if published is None and finished is None:
+                continue
+            published, finished = published or 0, finished or 0
+            lane_report.append({
+                'lane': lane.name,
+                'published': published,
+                'finished': finished,
+                'backlog': max(0, published - finished),
+            })
+        if shard >= SHARD_COUNT and not lane_report:
+            continue
+        report.append({
+            'shard': shard,
+            'active': shard < SHARD_COUNT,
+            'published': sum(item['published'] for item in lane_report),
+            'finished': sum(item['finished'] for item in lane_report),
+            'backlog': sum(item['backlog'] for item in lane_report),
+            'lanes': lane_report,
+        })
+    return json.dumps({'shards': report})
+
+
 def utctimestamp():
     """Returns seconds since the epoch in utc time."""
     return long(time.mktime(time.gmtime()))
@@ -0,0 +1,423 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Imports main.py against the App Engine testbed stubs.
+
+Needs the App Engine SDK on PYTHONPATH, like startup_benchmark.py.
+"""
+import calendar
+import datetime
+import functools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+
+import werkzeug.urls
+
+try:
+    import dev_appserver
+    # Puts the libraries bundled with the SDK, like yaml, on sys.path.
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext import testbed
+except ImportError:
+    testbed = None
+
+
+@unittest.skipIf(testbed is None, 'needs the App Engine SDK on PYTHONPATH')
+class AppTestCase(unittest.TestCase):
+    """Runs main.py against the testbed, with everything else in memory."""
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ.update({
+            'SHOUT_STATUS_STORE': 'memory',
+            'SHOUT_NOTIFY_BACKEND': 'local',
+            'SHOUT_PUBSUB': 'local',
+            'SHOUT_STATUS_CACHE': 'local',
+        })
+        self.bed = testbed.Testbed()
+        self.bed.activate()
+        self.bed.setup_env(overwrite=True, app_id='main-test',
+                           CURRENT_VERSION_ID='test.1')
+        self.bed.init_app_identity_stub()
+        self.bed.init_datastore_v3_stub()
+        self.bed.init_memcache_stub()
+        self.bed.init_modules_stub()
+        self.bed.init_taskqueue_stub()
+
+    def tearDown(self):
+        self.bed.deactivate()
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+
+class ImportTest(AppTestCase):
+    def test_import(self):
+        import main
+        self.assertEqual(main.TIMEOUT_SECONDS,
+                         main.LANES[-1].timeout_seconds)
+        response = main.app.test_client().get('/')
+        self.assertEqual(200, response.status_code)
+
+    def test_learns_completion_times_from_the_status_log(self):
+        import main
+        observed = []
+        real_scheduler = main.poll_scheduler
+        main.poll_scheduler = FakeScheduler(observed)
+        submitted = datetime.datetime.utcnow()
+
+        def put(shout_id, status, seconds, result=None):
+            record = main.new_status_record('b', shout_id, status, result)
+            record.timestamp = submitted + datetime.timedelta(
+                seconds=seconds)
+            main.store.put_async(record).get_result()
+            return main.store.get_current(record.combined_shout_id)
+
+        try:
+            put('timed', 'new', 0)
+            main.observe_completion(put('timed', 'success', 10, 'HELLO'))
+            # Answered from the result cache, so never submitted.
+            main.observe_completion(put('cached', 'success', 10, 'HELLO'))
+            # Finished before it was submitted.
+            put('early', 'new', 0)
+            main.observe_completion(put('early', 'success', -1, 'HELLO'))
+        finally:
+            main.poll_scheduler = real_scheduler
+        self.assertEqual([(5, 10)], observed)
+
+    def test_lane_totals_before_the_first_finish(self):
+        import main
+        from google.appengine.api import memcache
+        self.assertEqual({'default': (0, 0)}, main.lane_totals())
+        # Cold start: shout requests published, none finished yet.
+        memcache.set(main.shard_event_key('published', 0, 'default'), 1100,
+                     namespace='shards')
+        self.assertEqual({'default': (1100, 0)}, main.lane_totals())
+        # Memcache forgot the published count.
+        memcache.delete(main.shard_event_key('published', 0, 'default'),
+                        namespace='shards')
+        memcache.set(main.shard_event_key('finished', 0, 'default'), 5,
+                     namespace='shards')
+        self.assertIsNone(main.lane_totals())
+
+    def test_counting_a_publish_starts_the_finished_count(self):
+        import main
+        from google.appengine.api import memcache
+        main.count_shard_event(0, 'default', 'published')
+        self.assertEqual(0, memcache.get(
+            main.shard_event_key('finished', 0, 'default'),
+            namespace='shards'))
+        main.count_shard_event('0', 'default', 'finished')
+        main.count_shard_event(0, 'default', 'published')
+        self.assertEqual({'default': (2, 1)}, main.lane_totals())
+
+    def test_blob_dir_ignored_on_app_engine(self):
+        import main
+        directory = tempfile.mkdtemp()
+        try:
+            os.environ['SHOUT_BLOB_DIR'] = os.path.join(directory, 'blobs')
+            os.environ['SERVER_SOFTWARE'] = 'Google App Engine/1.9.30'
+            self.assertIsNone(main.new_payload_codec()._blob_store)
+            os.environ['SERVER_SOFTWARE'] = 'Development/2.0'
+            self.assertIsNotNone(main.new_payload_codec()._blob_store)
+        finally:
+            shutil.rmtree(directory)
+
+
+class PostStatusBatchTest(AppTestCase):
+    def setUp(self):
+        super(PostStatusBatchTest, self).setUp()
+        import main
+        self.main = main
+        main.purse.init('secret')
+        self.client = main.app.test_client()
+
+    def post(self, statuses, token='secret'):
+        return self.client.post('/post_shout_status_batch', data={
+            'token': token, 'statuses': json.dumps(statuses)})
+
+    def test_stores_each_status(self):
+        response = self.post([
+            {'browserId': 'b', 'shoutId': 'batch1', 'status': 'shouting'},
+            {'browserId': 'b', 'shoutId': 'batch2', 'status': 'nonsense'},
+            {'browserId': 'b', 'shoutId': 'batch3', 'status': 'success',
+             'result': 'HI'},
+            'not a record',
+        ])
+        self.assertEqual(200, response.status_code)
+        results = json.loads(response.data)['results']
+        self.assertEqual({'ok': True}, results[0])
+        self.assertIn('error', results[1])
+        self.assertEqual({'ok': True}, results[2])
+        self.assertIn('error', results[3])
+        current = self.main.store.get_current('b-batch3')
+        self.assertEqual(('success', 'HI'),
+                         (current.status_name, current.result))
+        self.assertEqual('shouting',
+                         self.main.store.get_current('b-batch1').status_name)
+        self.assertIsNone(self.main.store.get_current('b-batch2'))
+
+    def test_wakes_the_long_poll(self):
+        version = self.main.hub.version('b-batch4')
+        self.post([{'browserId': 'b', 'shoutId': 'batch4',
+                    'status': 'shouting'}])
+        self.assertTrue(self.main.hub.wait('b-batch4', version, 0))
+
+    def test_rejects_bad_requests(self):
+        self.assertEqual(403, self.post([], token='forged').status_code)
+        self.assertEqual(400, self.post({}).status_code)
+        response = self.client.post('/post_shout_status_batch', data={
+            'token': 'secret', 'statuses': 'not json'})
+        self.assertEqual(400, response.status_code)
+
+
+class PurgeTest(AppTestCase):
+    def setUp(self):
+        super(PurgeTest, self).setUp()
+        import main
+        self.main = main
+        self.real_batch_size, main.PURGE_BATCH_SIZE = (
+            main.PURGE_BATCH_SIZE, 2)
+        self.store = main.NdbStatusStore()
+        self.store.put_multi_async([
+            main.new_status_record('b', str(i), 'new')
+            for i in range(5)])[-1].get_result()
+        self.future = (datetime.datetime.utcnow() +
+                       datetime.timedelta(minutes=1))
+
+    def tearDown(self):
+        self.main.PURGE_BATCH_SIZE = self.real_batch_size
+        super(PurgeTest, self).tearDown()
+
+    def test_pages_through_with_a_cursor(self):
+        # A tiny time budget still purges one page per call.
+        deleted, cursor = self.store.purge(self.future, None, 1e-9)
+        self.assertEqual(2, deleted)
+        self.assertTrue(cursor)
+        total = deleted
+        while cursor:
+            deleted, cursor = self.store.purge(self.future, cursor, 1e-9)
+            total += deleted
+        self.assertEqual(5, total)
+        self.assertEqual(0, self.main.ShoutStatusLog.query().count())
+
+    def test_keeps_recent_statuses(self):
+        past = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+        self.assertEqual((0, None), self.store.purge(past))
+        self.assertEqual(5, self.main.ShoutStatusLog.query().count())
+
+    def test_continues_in_a_task(self):
+        real_store, self.main.store = self.main.store, self.store
+        real_budget, self.main.PURGE_TIME_BUDGET_SECONDS = (
+            self.main.PURGE_TIME_BUDGET_SECONDS, 1e-9)
+        try:
+            cutoff = calendar.timegm(self.future.utctimetuple())
+            response = self.main.app.test_client().get(
+                '/purge?cutoff=%d' % cutoff)
+        finally:
+            self.main.store = real_store
+            self.main.PURGE_TIME_BUDGET_SECONDS = real_budget
+        self.assertIn('Continuing in a new task.', response.data)
+        tasks = self.bed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME).get_filtered_tasks()
+        self.assertEqual(1, len(tasks))
+        params = urlparse.parse_qs(urlparse.urlparse(tasks[0].url).query)
+        self.assertEqual([str(cutoff)], params['cutoff'])
+        self.assertEqual(['2'], params['total'])
+        self.assertTrue(params['cursor'])
+
+
+class CurrentStatusStoreTest(AppTestCase):
+    def setUp(self):
+        super(CurrentStatusStoreTest, self).setUp()
+        import main
+        self.main = main
+        self.store = main.CurrentStatusStore()
+
+    def put(self, shout_id, *statuses):
+        for status in statuses:
+            self.store.put_async(self.main.new_status_record(
+                'b', shout_id, status[0], status[1])).get_result()
+
+    def test_keeps_the_highest_priority(self):
+        self.put('a', ('new', None), ('success', 'A'), ('shouting', None))
+        self.put('b', ('error', 'Moo.'), ('error', 'Moooo.'))
+        current = self.store.get_current_multi(['b-a', 'b-b', 'b-c'])
+        self.assertEqual(('success', 'A'), (current['b-a'].status_name,
+                                            current['b-a'].result))
+        self.assertEqual('Moooo.', current['b-b'].error)
+        self.assertIsNone(current['b-c'])
+        self.assertEqual('b-a', self.store.get_current('b-a')
+                         .combined_shout_id)
+        # The log still has every status.
+        self.assertEqual(5, self.main.ShoutStatusLog.query().count())
+
+    def test_get_submitted(self):
+        self.put('a', ('new', None), ('success', 'A'))
+        self.put('b', ('success', 'B'))
+        submitted = self.store.get_submitted('b-a')
+        self.assertLessEqual(submitted,
+                             self.store.get_current('b-a').timestamp)
+        self.assertIsNone(self.store.get_submitted('b-b'))
+
+    def test_purge_continues_from_the_log_to_current_statuses(self):
+        for shout_id in 'abc':
+            self.put(shout_id, ('new', None))
+        real_batch_size, self.main.PURGE_BATCH_SIZE = (
+            self.main.PURGE_BATCH_SIZE, 2)
+        future = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        cursors = []
+        total = 0
+        try:
+            cursor = None
+            while True:
+                deleted, cursor = self.store.purge(future, cursor, 1e-9)
+                total += deleted
+                if not cursor:
+                    break
+                cursors.append(cursor.partition(':')[0])
+        finally:
+            self.main.PURGE_BATCH_SIZE = real_batch_size
+        self.assertEqual(6, total)
+        self.assertEqual(['log', 'current', 'current'], cursors)
+        self.assertIsNone(self.store.get_current('b-a'))
+        self.assertEqual(0, self.main.ShoutStatusLog.query().count())
+
+
+class StatusStreamTest(AppTestCase):
+    def setUp(self):
+        super(StatusStreamTest, self).setUp()
+        import main
+        self.main = main
+        self.real_status_changes = main.status_changes
+        # Keeps the window short, so an unfinished shout doesn't take 45
+        # seconds.
+        main.status_changes = functools.partial(self.real_status_changes,
+                                                window_seconds=0.1)
+
+    def tearDown(self):
+        self.main.status_changes = self.real_status_changes
+        super(StatusStreamTest, self).tearDown()
+
+    def stream(self, shout_id, status, *records):
+        """Stores records for shout_id, then returns the events streamed to
+        a browser that last saw status.
+        """
+        for record in records:
+            self.main.store.put_async(self.main.new_status_record(
+                'b', shout_id, *record)).get_result()
+        link = self.main.status_link('shout_status_stream', 'b', shout_id,
+                                     status)
+        response = self.main.app.test_client().post(
+            '/shout_status_stream', data={'token': link['token']})
+        self.assertEqual('text/event-stream', response.mimetype)
+        self.assertTrue(response.data.endswith('\n\n'))
+        events = response.data[:-2].split('\n\n')
+        self.assertTrue(all(event.startswith('data: ') for event in events))
+        return [json.loads(event[len('data: '):]) for event in events]
+
+    def test_ends_with_the_result(self):
+        events = self.stream('stream1', 'new', ('shouting',),
+                             ('success', 'HELLO'))
+        self.assertEqual([{'shoutId': 'stream1', 'status': 'success',
+                           'result': 'HELLO'}], events)
+
+    def test_resumes_with_next_link(self):
+        events = self.stream('stream2', 'new', ('shouting',))
+        self.assertEqual(['shouting', 'shouting'],
+                         [event['status'] for event in events])
+        link = events[-1]['nextLink']
+        self.assertEqual('shout_status_stream', link['target'])
+        token = werkzeug.urls.url_decode(link['token'])
+        self.assertEqual(('b', 'stream2', 'shouting'), (
+            token['browserId'], token['shoutId'], token['status']))
+        # Nothing changed, so the next stream only says to keep waiting.
+        events = self.stream('stream2', 'shouting')
+        self.assertEqual(['shouting'], [event['status'] for event in events])
+        self.assertIn('nextLink', events[0])
+
+
+class StatusMultiTest(AppTestCase):
+    def setUp(self):
+        super(StatusMultiTest, self).setUp()
+        import main
+        self.main = main
+        self.real_poll = main.poll_many_shout_statuses
+        main.poll_many_shout_statuses = functools.partial(
+            self.real_poll, window_seconds=0.1)
+
+    def tearDown(self):
+        self.main.poll_many_shout_statuses = self.real_poll
+        super(StatusMultiTest, self).tearDown()
+
+    def put(self, shout_id, status, result=None):
+        self.main.store.put_async(self.main.new_status_record(
+            'b', shout_id, status, result)).get_result()
+        self.main.hub.signal(self.main.combine_ids('b', shout_id))
+
+    def post(self, statuses):
+        token = werkzeug.urls.url_encode({'browserId': 'b'})
+        return self.main.app.test_client().post('/shout_status_multi', data={
+            'token': token, 'statuses': statuses})
+
+    def test_reports_only_changes(self):
+        self.put('multi1', 'success', 'HI')
+        self.put('multi2', 'new')
+        response = self.post(json.dumps(
+            {'multi1': 'new', 'multi2': 'new', 'multi3': 'new'}))
+        self.assertEqual(200, response.status_code)
+        body = json.loads(response.data)
+        self.assertEqual({'multi1': {'shoutId': 'multi1', 'status': 'success',
+                                     'result': 'HI'}}, body['shouts'])
+        self.assertEqual('shout_status_multi', body['nextLink']['target'])
+
+    def test_nothing_changed(self):
+        self.put('multi4', 'shouting')
+        response = self.post(json.dumps({'multi4': 'shouting'}))
+        self.assertEqual(202, response.status_code)
+        self.assertEqual({}, json.loads(response.data)['shouts'])
+
+    def test_wakes_on_any_change(self):
+        self.put('multi5', 'new')
+        threading.Timer(0.05, self.put, ['multi6', 'shouting']).start()
+        start = time.time()
+        changes = self.real_poll('b', {'multi5': 'new', 'multi6': 'new'},
+                                 window_seconds=5)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(['multi6'], changes.keys())
+
+    def test_rejects_bad_statuses(self):
+        too_many = dict(('s%d' % i, 'new')
+                        for i in range(self.main.MAX_WATCHED_SHOUTS + 1))
+        for statuses in ('not json', '["new"]', json.dumps(too_many)):
+            self.assertEqual(400, self.post(statuses).status_code)
+
+
+class FakeScheduler(object):
+    """Records what a poll schedule would have learned."""
+
+    def __init__(self, observed):
+        self.observed = observed
+
+    def observe_completion(self, size, seconds):
+        self.observed.append((size, seconds))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,345 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Counters and latency histograms, rendered in the Prometheus text format.
+
+Cheap enough to leave on in production: recording a value takes a lock and
+a binary search over the bucket boundaries.  Every instance keeps its own
+numbers, and App Engine won't route a scraper to each one, so /metrics is
+for local load tests and spot checks.  See the README.
+"""
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+import flask
+
+# Bucket boundaries, in seconds, for latencies.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   25, 45, 60)
+
+
+class _Metric(object):
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        # Maps a tuple of label values to the numbers for those labels.
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def _format_labels(self, key, extra=()):
+        pairs = zip(self.label_names, key) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (name, value.replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in pairs)
+
+
+class Counter(_Metric):
+    """A number that only goes up."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['%s%s %s' % (self.name, self._format_labels(key), value)
+                for key, value in values]
+
+
+class Gauge(_Metric):
+    """Numbers measured each time the metrics are rendered."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, label_names, measure):
+        """Args:
+          measure: a function that returns a list of (labels, value) pairs,
+            where labels is a dict of label names to values.
+        """
+        _Metric.__init__(self, name, help_text, label_names)
+        self._measure = measure
+
+    def render(self):
+        values = sorted((self._key(labels), value)
+                        for labels, value in self._measure())
+        return ['%s%s %s' % (self.name, self._format_labels(key), value)
+                for key, value in values]
+
+
+class Histogram(_Metric):
+    """Counts observed values in buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names,
+                 buckets=LATENCY_BUCKETS):
+        _Metric.__init__(self, name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            numbers = self._values.get(key)
+            if not numbers:
+                # One count per bucket, one for +Inf, then the sum.
+                numbers = [0] * (len(self.buckets) + 1) + [0.0]
+                self._values[key] = numbers
+            numbers[i] += 1
+            numbers[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes how long a with block takes."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def render(self):
+        with self._lock:
+            values = sorted((key, list(numbers))
+                            for key, numbers in self._values.items())
+        lines = []
+        for key, numbers in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), numbers[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name, self._format_labels(key, [('le', str(bound))]),
+                    cumulative))
+            labels = self._format_labels(key)
+            lines.append('%s_sum%s %r' % (self.name, labels, numbers[-1]))
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+class Registry(object):
+    """Holds metrics, and renders them for scraping."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, label_names=()):
+        metric = Counter(name, help_text, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, measure, label_names=()):
+        metric = Gauge(name, help_text, label_names, measure)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, label_names=(),
+                  buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help_text))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REQUESTS = REGISTRY.counter(
+    'shout_http_requests_total', 'HTTP requests by endpoint and status code.',
+    ['endpoint', 'code'])
+REQUEST_SECONDS = REGISTRY.histogram(
+    'shout_http_request_seconds', 'HTTP request latency by endpoint.',
+    ['endpoint'])
+RPC_SECONDS = REGISTRY.histogram(
+    'shout_rpc_seconds', 'Datastore and Pub/Sub call latency by method.',
+    ['service', 'method'])
+RPC_ERRORS = REGISTRY.counter(
+    'shout_rpc_errors_total', 'Datastore and Pub/Sub calls that raised.',
+    ['service', 'method'])
+POLL_ITERATIONS = REGISTRY.counter(
+    'shout_poll_iterations_total',
+    'Status lookups made while waiting for a status to change.')
+POLL_WAIT_SECONDS = REGISTRY.histogram(
+    'shout_poll_wait_seconds',
+    'Time spent waiting between status lookups.')
+POLL_RECHECKS = REGISTRY.counter(
+    'shout_poll_rechecks_total',
+    'Status lookups made without a signal, by poll schedule and by whether '
+    'they found a change.', ['schedule', 'result'])
+STATUS_CACHE_LOOKUPS = REGISTRY.counter(
+    'shout_status_cache_lookups_total',
+    'Current status lookups answered by the status cache, by hit or miss.',
+    ['result'])
+RESULT_CACHE_LOOKUPS = REGISTRY.counter(
+    'shout_result_cache_lookups_total',
+    'Shouts answered by the result cache, by hit or miss.', ['result'])
+FLIGHTS = REGISTRY.counter(
+    'shout_flights_total',
+    'Shouts that led a flight, joined one, or were published alone.',
+    ['role'])
+ADMISSIONS = REGISTRY.counter(
+    'shout_admissions_total',
+    'Shouts admitted, or turned away and why.', ['result'])
+SHARD_MESSAGES = REGISTRY.counter(
+    'shout_shard_messages_total',
+    'Shout requests published to and finished from each shard and lane.',
+    ['shard', 'lane', 'event'])
+CONNECTION_LOOKUPS = REGISTRY.counter(
+    'shout_pubsub_connection_lookups_total',
+    'Pub/Sub connections reused from the pool (hit) or created (miss).',
+    ['result'])
+STATUS_DELIVERY_SECONDS = REGISTRY.histogram(
+    'shout_status_delivery_seconds',
+    'Time from a status being written to it being returned to a browser.',
+    ['status'])
+
+
+@contextlib.contextmanager
+def rpc_timer(service, method):
+    """Records the latency of a call to another service in a with block."""
+    start = time.time()
+    try:
+        yield
+    except:
+        RPC_ERRORS.inc(service=service, method=method)
+        raise
+    finally:
+        RPC_SECONDS.observe(time.time() - start, service=service,
+                            method=method)
+
+
+class _TimedFuture(object):
+    """Wraps a future, and records the latency of its call when its result
+    is first waited for.
+    """
+
+    def __init__(self, future, service, method, start):
+        self._future = future
+        self._service = service
+        self._method = method
+        self._start = start
+        self._recorded = False
+
+    def get_result(self):
+        try:
+            return self._future.get_result()
+        except:
+            if not self._recorded:
+                RPC_ERRORS.inc(service=self._service, method=self._method)
+            raise
+        finally:
+            if not self._recorded:
+                self._recorded = True
+                RPC_SECONDS.observe(time.time() - self._start,
+                                    service=self._service,
+                                    method=self._method)
+
+    def __getattr__(self, name):
+        return getattr(self._future, name)
+
+
+class _Instrumented(object):
+    """Wraps an object, and times calls to some of its methods."""
+
+    def __init__(self, wrapped, service, method_names):
+        self._wrapped = wrapped
+        self._service = service
+        self._method_names = frozenset(method_names)
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped, name)
+        if name not in self._method_names:
+            return attr
+
+        if name.endswith('_async'):
+            @functools.wraps(attr)
+            def timed_async(*args, **kwargs):
+                start = time.time()
+                try:
+                    result = attr(*args, **kwargs)
+                except:
+                    RPC_ERRORS.inc(service=self._service, method=name)
+                    raise
+                if isinstance(result, list):
+                    return [_TimedFuture(future, self._service, name, start)
+                            for future in result]
+                return _TimedFuture(result, self._service, name, start)
+            return timed_async
+
+        @functools.wraps(attr)
+        def timed(*args, **kwargs):
+            with rpc_timer(self._service, name):
+                return attr(*args, **kwargs)
+        return timed
+
+
+def instrument(wrapped, service, method_names):
+    """Returns a proxy for wrapped that records the latency of every call
+    to the methods named in method_names.
+
+    A method whose name ends in _async returns a future, or a list of them.
+    Its call is timed until its result is first waited for.
+    """
+    return _Instrumented(wrapped, service, method_names)
+
+
+def instrument_app(app):
+    """Records the latency of every request to a flask app, and serves the
+    metrics at /metrics.
+
+    The metrics say how busy the app is, and which endpoints it has, so
+    app.yaml must keep /metrics for admins.
+    """
+    @app.before_request
+    def start_timer():
+        flask.g.metrics_start = time.time()
+
+    @app.after_request
+    def record_code(response):
+        flask.g.metrics_code = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_request(exception):
+        start = getattr(flask.g, 'metrics_start', None)
+        if start is None:
+            return
+        rule = flask.request.url_rule
+        endpoint = rule.rule if rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.time() - start, endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint,
+                     code=getattr(flask.g, 'metrics_code', 500))
+
+    @app.route('/metrics')
+    def metrics():
+        return flask.Response(REGISTRY.render(),
+                              mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,89 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+
+import metrics
+
+
+class SlowFuture(object):
+    """Takes seconds to get its result."""
+
+    def __init__(self, seconds, error=None):
+        self.seconds = seconds
+        self.error = error
+
+    def get_result(self):
+        time.sleep(self.seconds)
+        if self.error:
+            raise self.error
+        return 'done'
+
+
+class Store(object):
+    def put_async(self, seconds, error=None):
+        return SlowFuture(seconds, error)
+
+    def put_multi_async(self, seconds):
+        return [SlowFuture(seconds), SlowFuture(seconds)]
+
+
+class InstrumentTest(unittest.TestCase):
+    def setUp(self):
+        self.store = metrics.instrument(Store(), 'test',
+                                        ['put_async', 'put_multi_async'])
+
+    def observed(self, method):
+        """Returns the (count, sum) of the latencies recorded for method."""
+        numbers = metrics.RPC_SECONDS._values.get(('test', method))
+        if not numbers:
+            return 0, 0.0
+        return sum(numbers[:-1]), numbers[-1]
+
+    def test_times_async_calls_until_their_result(self):
+        count, total = self.observed('put_async')
+        future = self.store.put_async(0.05)
+        self.assertEqual(count, self.observed('put_async')[0])
+        self.assertEqual('done', future.get_result())
+        self.assertEqual('done', future.get_result())
+        new_count, new_total = self.observed('put_async')
+        self.assertEqual(count + 1, new_count)
+        self.assertGreaterEqual(new_total - total, 0.05)
+
+    def test_times_each_future_of_a_list(self):
+        count, _ = self.observed('put_multi_async')
+        for future in self.store.put_multi_async(0):
+            future.get_result()
+        self.assertEqual(count + 2, self.observed('put_multi_async')[0])
+
+    def test_counts_errors(self):
+        errors = metrics.RPC_ERRORS._values.get(('test', 'put_async'), 0)
+        future = self.store.put_async(0, ValueError())
+        self.assertRaises(ValueError, future.get_result)
+        self.assertEqual(errors + 1,
+                         metrics.RPC_ERRORS._values[('test', 'put_async')])
+
+
+class GaugeTest(unittest.TestCase):
+    def test_measured_when_rendered(self):
+        values = [({'kind': 'a'}, 1)]
+        gauge = metrics.Gauge('g', 'A gauge.', ['kind'], lambda: values)
+        self.assertEqual(['g{kind="a"} 1'], gauge.render())
+        values.append(({'kind': 'b'}, 2))
+        self.assertEqual(['g{kind="a"} 1', 'g{kind="b"} 2'], gauge.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
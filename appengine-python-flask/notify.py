@@ -0,0 +1,204 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Wakes up requests that are waiting for something to change.
+
+Every key has a version.  signal() changes the version.  A waiter reads the
+version *before* it looks at the thing it's waiting on, then calls wait() with
+that version.  So a signal that lands between the look and the wait is never
+lost: wait() sees the version already changed and returns immediately.
+"""
+import itertools
+import threading
+import time
+
+from google.appengine.api import memcache
+
+import metrics
+
+
+class LocalBackend(object):
+    """Keeps versions in memory and wakes waiters with condition variables.
+
+    Only wakes waiters in the same process, so it's meant for tests and
+    single-instance deployments.
+    """
+
+    # Forget keys that haven't been touched in this many seconds.
+    MAX_AGE_SECONDS = 300
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = {}
+        # Versions are unique across keys, so a forgotten and re-created key
+        # can never come back with a version a waiter is holding.
+        self._counter = itertools.count(1)
+        self._next_prune = time.time() + self.MAX_AGE_SECONDS
+
+    def version(self, key):
+        with self._lock:
+            slot = self._slots.get(key)
+            return slot.version if slot else 0
+
+    def signal(self, key):
+        with self._lock:
+            slot = self._slot(key)
+            slot.version = next(self._counter)
+            for condition in slot.watchers:
+                condition.notify()
+            self._prune()
+
+    def versions(self, keys):
+        with self._lock:
+            return dict((key, self._slots[key].version
+                         if key in self._slots else 0) for key in keys)
+
+    def wait(self, key, version, timeout):
+        return self.wait_any({key: version}, timeout)
+
+    def wait_any(self, versions, timeout):
+        deadline = time.time() + timeout
+        with self._lock:
+            # One condition, watching every key.
+            condition = threading.Condition(self._lock)
+            slots = [(self._slot(key), version)
+                     for key, version in versions.iteritems()]
+            for slot, version in slots:
+                slot.watchers.add(condition)
+            try:
+                while all(slot.version == version for slot, version in slots):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    condition.wait(remaining)
+                return True
+            finally:
+                now = time.time()
+                for slot, version in slots:
+                    slot.watchers.discard(condition)
+                    slot.touched = now
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if not slot:
+            slot = self._slots[key] = _Slot()
+        return slot
+
+    def _prune(self):
+        now = time.time()
+        if now < self._next_prune:
+            return
+        self._next_prune = now + self.MAX_AGE_SECONDS
+        too_old = now - self.MAX_AGE_SECONDS
+        for key, slot in self._slots.items():
+            if not slot.watchers and slot.touched < too_old:
+                del self._slots[key]
+
+
+class _Slot(object):
+    def __init__(self):
+        self.version = 0
+        # The conditions of the threads waiting on this key.
+        self.watchers = set()
+        self.touched = time.time()
+
+
+class MemcacheBackend(object):
+    """Keeps versions in memcache, so a signal on one instance wakes waiters
+    on every instance.
+
+    Memcache can't push, so waiters check the version every poll_seconds.
+    That's a cheap memcache get instead of a datastore query.  Waiters on the
+    instance that sent the signal wake up immediately.
+    If memcache evicts a version, waiters wake up early, which is harmless.
+    """
+
+    def __init__(self, poll_seconds=0.25, namespace='notify'):
+        self._poll_seconds = poll_seconds
+        self._namespace = namespace
+        self._local = LocalBackend()
+
+    def version(self, key):
+        with metrics.rpc_timer('notify', 'version'):
+            return memcache.get(key, namespace=self._namespace) or 0
+
+    def signal(self, key):
+        with metrics.rpc_timer('notify', 'signal'):
+            memcache.incr(key, namespace=self._namespace, initial_value=0)
+        self._local.signal(key)
+
+    def versions(self, keys):
+        with metrics.rpc_timer('notify', 'versions'):
+            found = memcache.get_multi(list(keys), namespace=self._namespace)
+        return dict((key, found.get(key) or 0) for key in keys)
+
+    def wait(self, key, version, timeout):
+        return self.wait_any({key: version}, timeout)
+
+    def wait_any(self, versions, timeout):
+        deadline = time.time() + timeout
+        local_versions = self._local.versions(versions)
+        while self.versions(versions) == versions:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if self._local.wait_any(local_versions,
+                                    min(remaining, self._poll_seconds)):
+                local_versions = self._local.versions(versions)
+        return True
+
+
+class NotificationHub(object):
+    """Lets one request wake up others waiting on the same key.
+
+    Usage:
+      version = hub.version(key)
+      if not look_for_change():
+          hub.wait(key, version, timeout)
+    and somewhere else, after making a change:
+      hub.signal(key)
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def version(self, key):
+        """Returns the current version of key."""
+        return self._backend.version(key)
+
+    def signal(self, key):
+        """Wakes up everyone waiting on key."""
+        self._backend.signal(key)
+
+    def wait(self, key, version, timeout):
+        """Waits up to timeout seconds for key's version to change.
+
+        Returns:
+          True if the version changed, False if we timed out.
+        """
+        return self._backend.wait(key, version, timeout)
+
+    def versions(self, keys):
+        """Returns a dict mapping each of keys to its current version."""
+        return self._backend.versions(keys)
+
+    def wait_any(self, versions, timeout):
+        """Waits up to timeout seconds for any key's version to change.
+
+        Args:
+          versions: dict, maps keys to the versions returned by versions().
+        Returns:
+          True if a version changed, False if we timed out.
+        """
+        return self._backend.wait_any(versions, timeout)
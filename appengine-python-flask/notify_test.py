@@ -0,0 +1,124 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Needs the App Engine SDK on PYTHONPATH, for memcache."""
+import threading
+import time
+import unittest
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext import testbed
+    import notify
+except ImportError:
+    testbed = None
+
+
+def signal_later(hub, key, seconds=0.05):
+    thread = threading.Timer(seconds, hub.signal, [key])
+    thread.start()
+    return thread
+
+
+@unittest.skipIf(testbed is None, 'needs the App Engine SDK on PYTHONPATH')
+class LocalBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = notify.LocalBackend()
+        self.hub = notify.NotificationHub(self.backend)
+
+    def test_signal_wakes_waiter(self):
+        version = self.hub.version('a')
+        signal_later(self.hub, 'a')
+        start = time.time()
+        self.assertTrue(self.hub.wait('a', version, 5))
+        self.assertLess(time.time() - start, 1)
+
+    def test_signal_before_wait_is_not_lost(self):
+        version = self.hub.version('a')
+        self.hub.signal('a')
+        start = time.time()
+        self.assertTrue(self.hub.wait('a', version, 5))
+        self.assertLess(time.time() - start, 1)
+
+    def test_times_out(self):
+        self.assertFalse(self.hub.wait('a', self.hub.version('a'), 0.05))
+
+    def test_other_keys_dont_wake(self):
+        version = self.hub.version('a')
+        signal_later(self.hub, 'b').join()
+        self.assertFalse(self.hub.wait('a', version, 0.05))
+
+    def test_wait_any(self):
+        versions = self.hub.versions(['a', 'b'])
+        self.assertEqual({'a': 0, 'b': 0}, versions)
+        signal_later(self.hub, 'b')
+        self.assertTrue(self.hub.wait_any(versions, 5))
+
+    def test_prune_keeps_watched_keys(self):
+        version = self.hub.version('watched')
+        self.hub.signal('idle')
+        idle_version = self.hub.version('idle')
+        self.assertTrue(idle_version)
+        waiter = threading.Thread(target=self.hub.wait,
+                                  args=('watched', version, 5))
+        waiter.start()
+        try:
+            time.sleep(0.05)
+            self.backend.MAX_AGE_SECONDS = 0
+            self.backend._next_prune = 0
+            for slot in self.backend._slots.values():
+                slot.touched -= 1
+            self.hub.signal('other')
+            self.assertNotIn('idle', self.backend._slots)
+            self.assertIn('watched', self.backend._slots)
+        finally:
+            self.hub.signal('watched')
+            waiter.join()
+        # A pruned key comes back with a version no waiter has seen.
+        self.hub.signal('idle')
+        self.assertNotEqual(idle_version, self.hub.version('idle'))
+
+
+@unittest.skipIf(testbed is None, 'needs the App Engine SDK on PYTHONPATH')
+class MemcacheBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.bed = testbed.Testbed()
+        self.bed.activate()
+        self.bed.init_memcache_stub()
+        self.hub = notify.NotificationHub(
+            notify.MemcacheBackend(poll_seconds=0.01))
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def test_signal_changes_version(self):
+        version = self.hub.version('a')
+        self.hub.signal('a')
+        self.assertNotEqual(version, self.hub.version('a'))
+        self.assertTrue(self.hub.wait('a', version, 0))
+
+    def test_sees_signals_from_other_instances(self):
+        version = self.hub.version('a')
+        other = notify.NotificationHub(notify.MemcacheBackend())
+        other.signal('a')
+        self.assertTrue(self.hub.wait('a', version, 5))
+
+    def test_times_out(self):
+        versions = self.hub.versions(['a', 'b'])
+        self.assertFalse(self.hub.wait_any(versions, 0.05))
+
+
+if __name__ == '__main__':
+    unittest.main()
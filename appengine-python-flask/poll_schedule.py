@@ -0,0 +1,210 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Decides when a long poll re-checks the status log without a signal.
+
+A signal from the notification hub wakes a poll as soon as a status is
+written.  But signals can be late or lost, so a poll also re-checks the
+status log now and then.  A schedule decides when.  Each poll asks its
+schedule to start() a plan, then asks the plan how long to wait before
+each re-check.
+
+BackoffSchedule waits 0.1 seconds, then doubles the wait after every
+re-check that wasn't signaled.  AdaptiveSchedule learns how long shouts of
+each size take to finish, and re-checks around when the shout is likely to
+finish, instead of often at first and rarely later.
+"""
+import bisect
+import collections
+import logging
+import threading
+import time
+
+import metrics
+
+
+class BackoffSchedule(object):
+    """Re-checks after first_seconds, doubling the wait up to max_seconds."""
+
+    name = 'backoff'
+
+    def __init__(self, first_seconds=0.1, max_seconds=15):
+        self.first_seconds = first_seconds
+        self.max_seconds = max_seconds
+        self._hits = _HitRate(self.name)
+
+    def start(self, submitted=None, size=None, deadline=None):
+        """Returns a plan for one poll.
+
+        Args:
+          submitted: float, when the shout was submitted, in seconds since
+            the epoch.  None if unknown.
+          size: int, the length of the text being shouted.  None if unknown.
+          deadline: float, when the worker gives up on the shout, in seconds
+            since the epoch.  None if unknown.
+        """
+        return _BackoffPlan(self.first_seconds, self.max_seconds)
+
+    def observe_completion(self, size, seconds):
+        """Learns that a shout of size took seconds to finish."""
+        pass
+
+    def record_check(self, changed):
+        """Counts a re-check that wasn't signaled, and whether it found the
+        status changed.
+        """
+        self._hits.record(changed)
+
+
+class _BackoffPlan(object):
+    def __init__(self, first_seconds, max_seconds):
+        self._first_seconds = first_seconds
+        self._max_seconds = max_seconds
+        self._wait = first_seconds
+
+    def next_wait(self):
+        """Returns how many seconds to wait for a signal before re-checking.
+        """
+        wait = self._wait
+        self._wait = min(self._max_seconds, self._wait * 2)
+        return wait
+
+    def signaled(self):
+        """The last wait ended with a signal."""
+        # The query is eventually consistent, so the new status may take a
+        # moment to show up.
+        self._wait = self._first_seconds
+
+
+class AdaptiveSchedule(BackoffSchedule):
+    """Re-checks at the quantiles of recent completion times of shouts of
+    about the same size.
+
+    Shouting takes time proportional to len * log(len) of the text, so
+    completion times are grouped by the bit length of the text's length.
+    Until a group has min_samples completion times, or when the submit time
+    isn't known, acts like BackoffSchedule.  After the last quantile, it
+    backs off from max_seconds / 4.
+    """
+
+    name = 'adaptive'
+
+    QUANTILES = (0.1, 0.5, 0.75, 0.9, 0.99)
+
+    def __init__(self, first_seconds=0.1, max_seconds=15, max_samples=200,
+                 min_samples=20):
+        BackoffSchedule.__init__(self, first_seconds, max_seconds)
+        self._max_samples = max_samples
+        self._min_samples = min_samples
+        self._lock = threading.Lock()
+        # Maps a size group to a deque of recent completion times.
+        self._samples = {}
+
+    def start(self, submitted=None, size=None, deadline=None):
+        checkpoints = []
+        if submitted is not None:
+            checkpoints = [submitted + seconds
+                           for seconds in self._quantiles(size)]
+            if checkpoints and deadline is not None:
+                # The worker reports the shout fatal once it's too late.
+                checkpoints.append(deadline + self.first_seconds)
+        if not checkpoints:
+            return _BackoffPlan(self.first_seconds, self.max_seconds)
+        return _AdaptivePlan(sorted(checkpoints), self.first_seconds,
+                             self.max_seconds)
+
+    def observe_completion(self, size, seconds):
+        if size is None or seconds < 0:
+            return
+        with self._lock:
+            samples = self._samples.get(_group(size))
+            if samples is None:
+                samples = self._samples[_group(size)] = collections.deque(
+                    maxlen=self._max_samples)
+            samples.append(seconds)
+
+    def _quantiles(self, size):
+        if size is None:
+            return []
+        with self._lock:
+            samples = sorted(self._samples.get(_group(size), ()))
+        if len(samples) < self._min_samples:
+            return []
+        return [samples[int(q * (len(samples) - 1))] for q in self.QUANTILES]
+
+
+class _AdaptivePlan(object):
+    def __init__(self, checkpoints, first_seconds, max_seconds):
+        self._checkpoints = checkpoints
+        self._first_seconds = first_seconds
+        self._backoff = _BackoffPlan(max_seconds / 4.0, max_seconds)
+        self._max_seconds = max_seconds
+
+    def next_wait(self):
+        now = time.time()
+        i = bisect.bisect_right(self._checkpoints, now)
+        if i < len(self._checkpoints):
+            return max(self._first_seconds,
+                       min(self._max_seconds, self._checkpoints[i] - now))
+        return self._backoff.next_wait()
+
+    def signaled(self):
+        # Something happened, so look again soon, like _BackoffPlan does.
+        # The checkpoints still stand for the statuses to come.
+        self._checkpoints.insert(
+            bisect.bisect(self._checkpoints, time.time()),
+            time.time() + self._first_seconds)
+
+
+def _group(size):
+    """Returns the completion time group for a text of length size."""
+    return size.bit_length()
+
+
+class _HitRate(object):
+    """Counts re-checks, and logs how many found a change now and then."""
+
+    LOG_EVERY = 1000
+
+    def __init__(self, name):
+        self._name = name
+        self._lock = threading.Lock()
+        self._checks = 0
+        self._hits = 0
+
+    def record(self, changed):
+        metrics.POLL_RECHECKS.inc(schedule=self._name,
+                                  result='hit' if changed else 'miss')
+        with self._lock:
+            self._checks += 1
+            self._hits += 1 if changed else 0
+            if self._checks < self.LOG_EVERY:
+                return
+            checks, hits = self._checks, self._hits
+            self._checks = self._hits = 0
+        logging.info('%s poll schedule: %d of %d re-checks found a change '
+                     '(%.1f%%).', self._name, hits, checks,
+                     100.0 * hits / checks)
+
+
+def new_schedule(name, max_seconds=15):
+    """Returns the schedule named name.  'backoff' means BackoffSchedule.
+    Anything else means AdaptiveSchedule.
+
+    Args:
+      max_seconds: float, the longest a plan may wait before re-checking.
+    """
+    if name == BackoffSchedule.name:
+        return BackoffSchedule(max_seconds=max_seconds)
+    return AdaptiveSchedule(max_seconds=max_seconds)
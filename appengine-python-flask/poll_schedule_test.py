@@ -0,0 +1,111 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import poll_schedule
+
+
+class FakeTime(object):
+    """Stands in for the time module, so tests needn't sleep."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class BackoffScheduleTest(unittest.TestCase):
+    def test_doubles_until_signaled(self):
+        plan = poll_schedule.BackoffSchedule(0.1, 0.5).start()
+        self.assertEqual([0.1, 0.2, 0.4, 0.5, 0.5],
+                         [plan.next_wait() for i in range(5)])
+        plan.signaled()
+        self.assertEqual(0.1, plan.next_wait())
+
+
+class AdaptiveScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeTime()
+        self.real_time, poll_schedule.time = poll_schedule.time, self.clock
+        self.schedule = poll_schedule.AdaptiveSchedule(
+            first_seconds=0.1, max_seconds=8, min_samples=10)
+
+    def tearDown(self):
+        poll_schedule.time = self.real_time
+
+    def observe(self, size, seconds):
+        for s in seconds:
+            self.schedule.observe_completion(size, s)
+
+    def test_backs_off_until_it_has_learned(self):
+        self.observe(100, range(9))
+        plan = self.schedule.start(self.clock.now, 100)
+        self.assertEqual([0.1, 0.2], [plan.next_wait(), plan.next_wait()])
+        # Nor without the submit time.
+        self.observe(100, [9])
+        plan = self.schedule.start(None, 100)
+        self.assertEqual(0.1, plan.next_wait())
+
+    def test_checks_at_the_quantiles(self):
+        # Shouts of this size took 1 to 10 seconds.
+        self.observe(100, range(1, 11))
+        submitted = self.clock.now
+        plan = self.schedule.start(submitted, 100, deadline=submitted + 30)
+        checks = []
+        for i in range(8):
+            self.clock.now += plan.next_wait()
+            checks.append(round(self.clock.now - submitted, 6))
+        # The quantiles, no more than max_seconds apart, then just after the
+        # deadline, then backing off from a quarter of max_seconds.
+        self.assertEqual([1, 5, 7, 9, 17, 25, 30.1, 32.1], checks)
+
+    def test_waits_no_longer_than_max_seconds(self):
+        self.observe(100, [60] * 10)
+        plan = self.schedule.start(self.clock.now, 100)
+        self.assertEqual(8, plan.next_wait())
+
+    def test_looks_again_soon_after_a_signal(self):
+        self.observe(100, [5] * 10)
+        plan = self.schedule.start(self.clock.now, 100)
+        plan.signaled()
+        self.assertAlmostEqual(0.1, plan.next_wait())
+        self.clock.now += 0.1
+        self.assertAlmostEqual(4.9, plan.next_wait())
+
+    def test_sizes_are_learned_apart(self):
+        self.observe(100, [5] * 10)
+        self.assertEqual(0.1, self.schedule.start(self.clock.now, 5000)
+                         .next_wait())
+
+    def test_ignores_impossible_samples(self):
+        self.observe(100, [-1] * 10)
+        self.observe(None, [5] * 10)
+        self.assertEqual(0.1, self.schedule.start(self.clock.now, 100)
+                         .next_wait())
+
+
+class NewScheduleTest(unittest.TestCase):
+    def test_names(self):
+        self.assertIsInstance(poll_schedule.new_schedule('backoff'),
+                              poll_schedule.BackoffSchedule)
+        self.assertNotIsInstance(poll_schedule.new_schedule('backoff'),
+                                 poll_schedule.AdaptiveSchedule)
+        self.assertEqual(4, poll_schedule.new_schedule('adaptive', 4)
+                         .max_seconds)
+
+
+if __name__ == '__main__':
+    unittest.main()
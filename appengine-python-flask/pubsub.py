@@ -15,10 +15,20 @@
 import httplib2
 import httplib
 import base64
+import contextlib
+import logging
+import os
+import Queue
+import re
 import socket
 import threading
+import time
+import uuid
+import zlib
 import discovery_doc
+import metrics
 from apiclient import discovery
+from apiclient import errors
 from oauth2client import client as oauth2client
 
 
@@ -39,36 +49,832 @@ def create_pubsub_client(disdoc, http=None):
     return discovery.build_from_document(disdoc, http=http)
 
 
+class ClientFactory(object):
+    """Shares one pubsub service object and a pool of connections across
+    every thread in the process.  Thread-safe.
+
+    Building a service object means fetching credentials and parsing the
+    discovery doc, so we do it once.  httplib2.Http is not thread-safe, so
+    each request borrows an Http from the pool, and returns it afterwards
+    so the next request can reuse its keep-alive connection.  Every Http is
+    authorized with the same credentials, so an access token is refreshed
+    once for the whole process.
+    """
+
+    def __init__(self, disdoc=None, max_connections=10, timeout=45):
+        """Creates a client factory.
+
+        Args:
+          disdoc: string, the pubsub discovery doc.  By default, it's
+            loaded by discovery_doc.get_discovery_doc() when first needed.
+          max_connections: int, most Http objects to lend out at once.
+            Requests wait for one to be returned when they're all in use.
+            See add_connections().
+          timeout: int, seconds before a request times out.
+        """
+        self._disdoc = disdoc
+        self._timeout = timeout
+        self._lock = threading.RLock()
+        self._credentials = None
+        self._service = None
+        self._pool = Queue.LifoQueue()
+        # Never more than max_connections Http objects lent out.
+        self._slots = threading.Condition(threading.Lock())
+        self._max_connections = max_connections
+        self._lent = 0
+        self._hits = 0
+        self._misses = 0
+
+    def service(self):
+        """Returns the service object.  Execute its requests with an Http
+        from http().
+        """
+        with self._lock:
+            if not self._service:
+                disdoc = self._disdoc or discovery_doc.get_discovery_doc(
+                    'pubsub', 'v1')
+                self._service = discovery.build_from_document(
+                    disdoc, http=self._new_http())
+            return self._service
+
+    def add_connections(self, count):
+        """Raises the most Http objects lent out at once by count, or lowers
+        it if count is negative.
+
+        A MessageStream holds a connection for each of its pulls for as long
+        as a pull waits for messages, so it adds that many for its lifetime.
+        Otherwise, a worker's pulls would take every connection, and its
+        acks and deadline extensions would wait until the messages were
+        redelivered.
+        """
+        with self._slots:
+            self._max_connections += count
+            self._slots.notify_all()
+
+    @contextlib.contextmanager
+    def http(self):
+        """Lends out an authorized Http for the duration of a with block."""
+        self._acquire()
+        try:
+            http = self._pool.get_nowait()
+            hit = True
+        except Queue.Empty:
+            try:
+                http = self._new_http()
+            except:
+                self._release()
+                raise
+            hit = False
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+        metrics.CONNECTION_LOOKUPS.inc(result='hit' if hit else 'miss')
+        try:
+            yield http
+        except:
+            # The connection may be broken.  Don't lend it out again.
+            self._release()
+            raise
+        self._pool.put(http)
+        self._release()
+
+    def stats(self):
+        """Returns a dict of connection pool statistics."""
+        with self._slots:
+            lent, max_connections = self._lent, self._max_connections
+        return {'hits': self._hits, 'misses': self._misses,
+                'idle': self._pool.qsize(), 'lent': lent,
+                'max': max_connections}
+
+    def _acquire(self):
+        with self._slots:
+            while self._lent >= self._max_connections:
+                self._slots.wait()
+            self._lent += 1
+
+    def _release(self):
+        with self._slots:
+            self._lent -= 1
+            self._slots.notify()
+
+    def _new_http(self):
+        with self._lock:
+            if not self._credentials:
+                credentials = (
+                    oauth2client.GoogleCredentials.get_application_default())
+                if credentials.create_scoped_required():
+                    credentials = credentials.create_scoped(PUBSUB_SCOPES)
+                self._credentials = credentials
+        http = httplib2.Http(timeout=self._timeout)
+        return self._credentials.authorize(http)
+
+
+def make_message(data, attributes, codec=None):
+    """Returns a pubsub message with data encoded the way the API wants.
+
+    If codec is a PayloadCodec, data is compressed or stored out of band
+    first, as the codec sees fit.
+    """
+    if codec:
+        data, attributes = codec.encode(data, attributes)
+    return {'data': base64.b64encode(data), 'attributes': attributes}
+
+
+class PayloadError(Exception):
+    """A message's payload could not be decoded."""
+    pass
+
+
+class FileBlobStore(object):
+    """Keeps message bodies too big to send inline as files in a directory.
+
+    A stand-in for a real blob store, like Cloud Storage, for tests and for
+    publishers and workers on one machine, like with pubsub_emulator.  Not
+    for App Engine, whose file system is read-only and not shared with the
+    workers.  Nothing deletes old blobs, so clean the directory out now and
+    then.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def put(self, data):
+        """Stores data.  Returns the name to get it back with."""
+        name = uuid.uuid4().hex
+        path = os.path.join(self._directory, name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+        return name
+
+    def get(self, name):
+        # The name comes from a message, so don't let it leave the directory.
+        if not re.match(r'^[0-9a-f]{32}$', name):
+            raise PayloadError('Bad blob name.')
+        try:
+            with open(os.path.join(self._directory, name), 'rb') as f:
+                return f.read()
+        except IOError as e:
+            raise PayloadError('Blob %s is missing: %s' % (name, e))
+
+
+class PayloadCodec(object):
+    """Compresses big message bodies, and moves huge ones out of band.
+
+    The codecs applied to a message are listed, in order, in its 'codec'
+    attribute, so a reader can undo them without knowing the settings of
+    the writer.  Messages without the attribute are passed through, so a
+    reader with a PayloadCodec can read what old publishers wrote.  But a
+    reader without one, like the C# worker, takes encoded data for the
+    text, so only encode messages for readers that can decode them.
+    """
+
+    ATTRIBUTE = 'codec'
+
+    def __init__(self, compress_bytes=None, blob_store=None,
+                 blob_bytes=1000000):
+        """Args:
+          compress_bytes: int, compress bodies bigger than this.  None, the
+            default, to never compress.
+          blob_store: where to keep bodies bigger than blob_bytes, after
+            compression.  Like FileBlobStore.  None to always send bodies
+            inline.
+          blob_bytes: int.
+        """
+        self._compress_bytes = compress_bytes
+        self._blob_store = blob_store
+        self._blob_bytes = blob_bytes
+
+    def encode(self, data, attributes):
+        """Returns a tuple of (encoded data, attributes)."""
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        codecs = []
+        if (self._compress_bytes is not None and
+                len(data) > self._compress_bytes):
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                codecs.append('zlib')
+        if self._blob_store and len(data) > self._blob_bytes:
+            data = self._blob_store.put(data)
+            codecs.append('blob')
+        if codecs:
+            attributes = dict(attributes or {})
+            attributes[self.ATTRIBUTE] = ','.join(codecs)
+        return data, attributes
+
+    def decode(self, data, attributes):
+        """Undoes encode().  Returns the original data, as bytes.
+
+        Raises:
+          PayloadError if the data can't be decoded.
+        """
+        codecs = (attributes or {}).get(self.ATTRIBUTE)
+        if not codecs:
+            return data
+        for codec in reversed(codecs.split(',')):
+            if codec == 'zlib':
+                try:
+                    data = zlib.decompress(data)
+                except zlib.error as e:
+                    raise PayloadError('Bad compressed data: %s' % e)
+            elif codec == 'blob' and self._blob_store:
+                data = self._blob_store.get(data)
+            else:
+                raise PayloadError('Can\'t decode %s.' % codec)
+        return data
+
+
+class PublishTimeout(Exception):
+    pass
+
+
+class AlreadyExists(Exception):
+    """The topic or subscription being created already exists."""
+    pass
+
+
+class PublishFuture(object):
+    """The eventual message id of a message queued with BatchPublisher.
+
+    A minimal stand-in for concurrent.futures.Future, which python 2.7 lacks.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._message_id = None
+        self._exception = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Returns the message id.  Raises the error if publishing failed."""
+        if not self._event.wait(timeout):
+            raise PublishTimeout()
+        if self._exception:
+            raise self._exception
+        return self._message_id
+
+    def exception(self, timeout=None):
+        """Returns the error raised while publishing, or None."""
+        if not self._event.wait(timeout):
+            raise PublishTimeout()
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Calls fn(self) once the message has been published or has failed.
+
+        If that already happened, calls fn immediately.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, message_id=None, exception=None):
+        with self._lock:
+            self._message_id = message_id
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.exception('PublishFuture callback failed.')
+
+
+class _Batch(object):
+    """Messages waiting to be published to one topic."""
+
+    def __init__(self):
+        self.messages = []
+        self.futures = []
+        self.size = 0
+
+
+class BatchPublisher(object):
+    """Collects messages per topic and publishes them in batches.  Thread-safe.
+
+    A batch is flushed when it holds max_messages messages, when its encoded
+    size would exceed max_bytes, or max_latency seconds after its first message
+    arrived, whichever comes first.  Full batches are published by the thread
+    that filled them.  The latency flush runs on a short-lived timer thread
+    started when the batch opens, so it ends within max_latency seconds of the
+    request that opened the batch.
+    """
+
+    def __init__(self, pubsub, max_messages=100, max_bytes=1000000,
+                 max_latency=0.05):
+        """Creates a batch publisher.
+
+        Args:
+          pubsub: the PubSub used to send batches.
+          max_messages: int, most messages in one publish request.  The API
+            accepts at most 1000.
+          max_bytes: int, most bytes of encoded data in one publish request.
+            The API accepts at most 10MB.
+          max_latency: float, most seconds a message waits in a batch.
+        """
+        self._pubsub = pubsub
+        self._max_messages = max_messages
+        self._max_bytes = max_bytes
+        self._max_latency = max_latency
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    def publish(self, topic, data, attributes, codec=None):
+        """Queues a message for publishing.  Returns a PublishFuture.
+
+        codec is passed to make_message().
+        """
+        message = make_message(data, attributes, codec)
+        size = len(message['data']) + sum(
+            len(key) + len(value)
+            for key, value in message['attributes'].iteritems())
+        future = PublishFuture()
+        ready = []
+        with self._lock:
+            batch = self._batches.get(topic)
+            if batch and batch.size + size > self._max_bytes:
+                ready.append(self._batches.pop(topic))
+                batch = None
+            if not batch:
+                batch = self._batches[topic] = _Batch()
+                timer = threading.Timer(self._max_latency, self._flush_batch,
+                                        [topic, batch])
+                timer.daemon = True
+                timer.start()
+            batch.messages.append(message)
+            batch.futures.append(future)
+            batch.size += size
+            if len(batch.messages) >= self._max_messages:
+                ready.append(self._batches.pop(topic))
+        for full_batch in ready:
+            self._send(topic, full_batch)
+        return future
+
+    def flush(self):
+        """Publishes all pending batches now."""
+        with self._lock:
+            batches, self._batches = self._batches, {}
+        for topic, batch in batches.iteritems():
+            self._send(topic, batch)
+
+    def _flush_batch(self, topic, batch):
+        """Called by the timer.  Publishes batch if nobody else has yet."""
+        with self._lock:
+            if self._batches.get(topic) is not batch:
+                return
+            del self._batches[topic]
+        self._send(topic, batch)
+
+    def _send(self, topic, batch):
+        try:
+            message_ids = self._pubsub.publish_messages(topic, batch.messages)
+        except Exception as e:
+            logging.exception('Failed to publish %d messages to %s.',
+                              len(batch.messages), topic)
+            for future in batch.futures:
+                future._finish(exception=e)
+            return
+        for future, message_id in zip(batch.futures, message_ids):
+            future._finish(message_id=message_id)
+
+
+class _PendingAcks(object):
+    """Ack ids waiting to be sent for one subscription."""
+
+    def __init__(self):
+        self.acks = []
+        # Maps a deadline in seconds to the ack ids that should get it.
+        self.deadlines = {}
+
+
+class AckManager(object):
+    """Batches acknowledge and modifyAckDeadline calls.  Thread-safe.
+
+    Gathers ack ids from many threads and sends them with one request per
+    subscription, once max_ids are waiting or max_latency seconds after the
+    first one arrived.  Also keeps messages that are still in progress from
+    being redelivered: lease() them when they're pulled, and the manager
+    extends their ack deadlines in batches until they're acked or released.
+
+    Sends from a background thread that runs between start() and stop(), so
+    it's meant for workers, not App Engine request handlers.
+    """
+
+    def __init__(self, pubsub, max_ids=1000, max_latency=0.1,
+                 ack_deadline_seconds=15, lease_margin_seconds=5):
+        """Creates an ack manager.
+
+        Args:
+          pubsub: the PubSub used to send requests.
+          max_ids: int, most ack ids sent with one request.
+          max_latency: float, most seconds an ack id waits to be sent.
+          ack_deadline_seconds: int, the deadline leases are extended to.
+          lease_margin_seconds: int, extend leases this long before they
+            expire.
+        """
+        self._pubsub = pubsub
+        self._max_ids = max_ids
+        self._max_latency = max_latency
+        self._ack_deadline_seconds = ack_deadline_seconds
+        self._lease_margin_seconds = lease_margin_seconds
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._pending_count = 0
+        self._first_pending_time = None
+        # Maps subscription to {ack_id: when its deadline expires}.
+        self._leases = {}
+        self._next_lease_check = 0
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """Starts the background thread that sends requests."""
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Sends everything that's waiting and stops the background thread."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def ack(self, subscription, ack_id):
+        """Queues an acknowledgement.  Also releases the lease."""
+        with self._condition:
+            self._drop_lease(subscription, ack_id)
+            self._pending_for(subscription).acks.append(ack_id)
+            self._added()
+
+    def nack(self, subscription, ack_id):
+        """Asks pubsub to redeliver a message right away."""
+        self.modify_ack_deadline(subscription, ack_id, 0)
+
+    def modify_ack_deadline(self, subscription, ack_id, ack_deadline_seconds):
+        """Queues a new deadline for a message.  Also releases the lease."""
+        with self._condition:
+            self._drop_lease(subscription, ack_id)
+            self._pending_for(subscription).deadlines.setdefault(
+                ack_deadline_seconds, []).append(ack_id)
+            self._added()
+
+    def lease(self, subscription, ack_id):
+        """Keeps extending a message's deadline until it's acked or released.
+
+        Call this when the message is pulled.
+        """
+        with self._condition:
+            self._leases.setdefault(subscription, {})[ack_id] = (
+                time.time() + self._ack_deadline_seconds)
+
+    def release(self, subscription, ack_id):
+        """Stops extending a message's deadline, so it will be redelivered
+        when the deadline passes.
+        """
+        with self._condition:
+            self._drop_lease(subscription, ack_id)
+
+    def _pending_for(self, subscription):
+        pending = self._pending.get(subscription)
+        if not pending:
+            pending = self._pending[subscription] = _PendingAcks()
+        return pending
+
+    def _drop_lease(self, subscription, ack_id):
+        self._leases.get(subscription, {}).pop(ack_id, None)
+
+    def _added(self):
+        self._pending_count += 1
+        if self._first_pending_time is None:
+            self._first_pending_time = time.time()
+            self._condition.notify()
+        elif self._pending_count >= self._max_ids:
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    now = time.time()
+                    wake_time = self._next_lease_check
+                    if self._first_pending_time is not None:
+                        wake_time = min(wake_time, self._first_pending_time +
+                                        self._max_latency)
+                    if (now >= wake_time or
+                            self._pending_count >= self._max_ids):
+                        break
+                    self._condition.wait(wake_time - now)
+                if time.time() >= self._next_lease_check:
+                    self._extend_leases()
+                pending, self._pending = self._pending, {}
+                self._pending_count = 0
+                self._first_pending_time = None
+                stopping = self._stopping
+            self._send(pending)
+            if stopping:
+                return
+
+    def _extend_leases(self):
+        """Queues new deadlines for leases that will expire soon."""
+        now = time.time()
+        self._next_lease_check = now + 1
+        expires_soon = now + self._lease_margin_seconds
+        new_expiration = now + self._ack_deadline_seconds
+        for subscription, leases in self._leases.iteritems():
+            for ack_id, expiration in leases.iteritems():
+                if expiration <= expires_soon:
+                    leases[ack_id] = new_expiration
+                    self._pending_for(subscription).deadlines.setdefault(
+                        self._ack_deadline_seconds, []).append(ack_id)
+
+    def _send(self, pending):
+        for subscription, acks in pending.iteritems():
+            for i in range(0, len(acks.acks), self._max_ids):
+                try:
+                    self._pubsub.acknowledge(
+                        subscription, acks.acks[i:i + self._max_ids])
+                except Exception:
+                    # The messages will be redelivered, and processed again.
+                    logging.exception('Failed to acknowledge messages.')
+            for seconds, ack_ids in acks.deadlines.iteritems():
+                for i in range(0, len(ack_ids), self._max_ids):
+                    try:
+                        self._pubsub.modify_ack_deadline(
+                            subscription, ack_ids[i:i + self._max_ids],
+                            seconds)
+                    except Exception:
+                        logging.exception('Failed to modify ack deadlines.')
+
+
+class MessageStream(object):
+    """Yields messages from several pulls kept in flight at once.
+
+    Each pull thread pulls whenever there's room under the flow control
+    limits, so the consumer sees a steady flow of messages instead of waiting
+    on one blocking pull at a time.  Every message yielded is leased with an
+    AckManager, which keeps extending its deadline until the consumer calls
+    ack(), nack() or release().  Those calls also make room for more messages.
+
+    Each pull gets a connection of its own from the PubSub's ClientFactory,
+    so however many streams a process opens, they leave the factory's
+    connections for acks and deadline extensions.
+
+    Yields the same dicts as PubSub.pull().  Thread-safe, except that only one
+    thread should iterate.
+    """
+
+    def __init__(self, pubsub, subscription, pulls=3, max_messages=100,
+                 max_outstanding_messages=1000,
+                 max_outstanding_bytes=100 * 1024 * 1024, ack_manager=None):
+        """Starts pulling.
+
+        Args:
+          pubsub: the PubSub to pull from.
+          subscription: string, the subscription to pull from.
+          pulls: int, how many pulls to keep in flight.
+          max_messages: int, most messages to pull with one request.
+          max_outstanding_messages: int, stop pulling when this many messages
+            have been pulled but not yet acked, nacked or released.
+          max_outstanding_bytes: int, stop pulling when the data of those
+            messages adds up to this many bytes.
+          ack_manager: the AckManager to lease messages with.  By default,
+            the stream starts and stops its own.
+        """
+        self._pubsub = pubsub
+        self._subscription = subscription
+        self._max_messages = max_messages
+        self._max_outstanding_messages = max_outstanding_messages
+        self._max_outstanding_bytes = max_outstanding_bytes
+        self._own_ack_manager = ack_manager is None
+        self._ack_manager = ack_manager or AckManager(pubsub)
+        if self._own_ack_manager:
+            self._ack_manager.start()
+        self._received = Queue.Queue()
+        self._condition = threading.Condition()
+        # Maps the ack id of each outstanding message to its size.
+        self._outstanding = {}
+        self._outstanding_bytes = 0
+        # How many messages the pulls in flight may still bring.
+        self._reserved = 0
+        self._closed = False
+        self._connections = pulls
+        pubsub.client_factory().add_connections(pulls)
+        self._threads = []
+        for i in range(pulls):
+            thread = threading.Thread(target=self._pull_loop)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __iter__(self):
+        while not self._closed:
+            try:
+                yield self._received.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+
+    def ack(self, message):
+        """Acknowledges a message, so it won't be delivered again."""
+        self._ack_manager.ack(self._subscription, message['ackId'])
+        self._done(message)
+
+    def nack(self, message):
+        """Asks for a message to be redelivered right away."""
+        self._ack_manager.nack(self._subscription, message['ackId'])
+        self._done(message)
+
+    def release(self, message):
+        """Stops extending a message's deadline, so it will be redelivered
+        when the deadline passes.
+        """
+        self._ack_manager.release(self._subscription, message['ackId'])
+        self._done(message)
+
+    def close(self):
+        """Stops pulling and ends the iteration.
+
+        Messages pulled but not yet yielded are released.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._pubsub.client_factory().add_connections(-self._connections)
+        self._connections = 0
+        while True:
+            try:
+                self.release(self._received.get_nowait())
+            except Queue.Empty:
+                break
+        if self._own_ack_manager:
+            self._ack_manager.stop()
+
+    def _done(self, message):
+        with self._condition:
+            size = self._outstanding.pop(message['ackId'], None)
+            if size is not None:
+                self._outstanding_bytes -= size
+                self._condition.notify()
+
+    def _room(self):
+        """Reserves room for a pull, waiting for some if needed.
+
+        The room reserved counts against the limits until _unreserve()
+        gives it back, so pulls in flight together can't overshoot them.
+
+        Returns:
+          int, how many messages we may pull, or 0 once closed.
+        """
+        with self._condition:
+            while not self._closed and (
+                    len(self._outstanding) + self._reserved >=
+                    self._max_outstanding_messages
+                    or self._outstanding_bytes >= self._max_outstanding_bytes):
+                self._condition.wait(1)
+            if self._closed:
+                return 0
+            room = min(self._max_messages, self._max_outstanding_messages -
+                       len(self._outstanding) - self._reserved)
+            self._reserved += room
+            return room
+
+    def _unreserve(self, room):
+        """Gives back room reserved by _room().  Call with the lock held."""
+        self._reserved -= room
+        self._condition.notify()
+
+    def _pull_loop(self):
+        while True:
+            room = self._room()
+            if not room:
+                return
+            try:
+                messages = self._pubsub.pull(self._subscription, room)
+            except Exception:
+                logging.exception('Pull from %s failed.', self._subscription)
+                with self._condition:
+                    self._unreserve(room)
+                time.sleep(1)
+                continue
+            with self._condition:
+                self._unreserve(room)
+                for message in messages:
+                    size = len(message['message'].get('data', ''))
+                    self._outstanding[message['ackId']] = size
+                    self._outstanding_bytes += size
+            for message in messages:
+                self._ack_manager.lease(self._subscription, message['ackId'])
+                self._received.put(message)
+
+
 class PubSub(object):
     """A thin wrapper around the REST pubsub API.  Thread-safe and cheap.
 
     Takes care of threading issues and authentication.
     """
 
-    _thread_local = threading.local()
-    _discovery_doc = discovery_doc.retrieve_discovery_doc('pubsub', 'v1')
+    # One ClientFactory, shared by every PubSub in the process.
+    _factory = None
+    _factory_lock = threading.Lock()
+    # One BatchPublisher per class and project, shared by every PubSub in
+    # the process.
+    _batch_publishers = {}
+    _batch_publishers_lock = threading.Lock()
 
-    def __init__(self, project_name):
+    def __init__(self, project_name, codec=None):
+        """Args:
+          project_name: string, the Google Cloud project id.
+          codec: the PayloadCodec for published and pulled messages.  By
+            default, nothing is compressed or stored out of band, but
+            compressed messages can still be pulled.
+        """
         self.project_name = project_name
+        self.codec = codec or PayloadCodec(compress_bytes=None)
+
+    @classmethod
+    def client_factory(cls):
+        """Returns the ClientFactory shared by every PubSub."""
+        with cls._factory_lock:
+            if not cls._factory:
+                cls._factory = ClientFactory()
+            return cls._factory
+
+    def _topics(self):
+        return self.client_factory().service().projects().topics()
 
-    def _client(self):
-        client = getattr(self._thread_local, 'client', None)
-        if not client:
-            client = self._thread_local.client = create_pubsub_client(
-                self._discovery_doc)
-        return client
+    def _subscriptions(self):
+        return self.client_factory().service().projects().subscriptions()
+
+    def _execute(self, request):
+        method = getattr(request, 'methodId', 'unknown')
+        with metrics.rpc_timer('pubsub', method):
+            with self.client_factory().http() as http:
+                return request.execute(http=http, num_retries=3)
+
+    def _create(self, request):
+        try:
+            self._execute(request)
+        except errors.HttpError as e:
+            if e.resp.status == httplib.CONFLICT:
+                raise AlreadyExists(request.uri)
+            raise
 
     def create_topic(self, new_unique_name):
-        self._client().projects().topics().create(
-            name=self._make_topic_path(new_unique_name), body={}).execute(
-            num_retries=3)
+        """Raises AlreadyExists if the topic already exists."""
+        self._create(self._topics().create(
+            name=self._make_topic_path(new_unique_name), body={}))
 
     def publish(self, topic, data, attributes):
-        body = {'messages': [{'data': base64.b64encode(data),
-                              'attributes': attributes}]}
-        self._client().projects().topics().publish(
-            topic=self._make_topic_path(topic), body=body).execute(
-            num_retries=3)
+        """Publishes one message right now.  Returns its message id."""
+        return self.publish_messages(
+            topic, [make_message(data, attributes, self.codec)])[0]
+
+    def publish_messages(self, topic, messages):
+        """Publishes a list of messages built by make_message() in one request.
+
+        Returns:
+          The list of message ids, in the same order as messages.
+        """
+        body = {'messages': messages}
+        resp = self._execute(self._topics().publish(
+            topic=self._make_topic_path(topic), body=body))
+        return resp.get('messageIds', [])
+
+    def publish_async(self, topic, data, attributes):
+        """Queues one message to be published in a batch with others.
+
+        Returns:
+          A PublishFuture that will hold the message id.
+        """
+        return self._batch_publisher().publish(topic, data, attributes,
+                                               self.codec)
+
+    def _batch_publisher(self):
+        # Subclasses, like pubsub_emulator.LocalPubSub, get their own.
+        key = (type(self), self.project_name)
+        with self._batch_publishers_lock:
+            publisher = self._batch_publishers.get(key)
+            if not publisher:
+                publisher = self._batch_publishers[key] = (
+                    BatchPublisher(type(self)(self.project_name)))
+        return publisher
 
     def _make_subscription_path(self, subscription):
         return 'projects/%s/subscriptions/%s' % (self.project_name,
@@ -78,42 +884,102 @@ class PubSub(object):
         return 'projects/%s/topics/%s' % (self.project_name, topic)
 
     def subscribe(self, topic, new_unique_name, push_config=None):
+        """Raises AlreadyExists if the subscription already exists."""
         body = {'topic': self._make_topic_path(topic), 'ackDeadlineSeconds': 15,
                 'pushConfig': push_config}
-        self._client().projects().subscriptions().create(
+        self._create(self._subscriptions().create(
             name=self._make_subscription_path(new_unique_name),
-            body=body).execute(num_retries=3)
+            body=body))
 
     def pull(self, subscription, max_messages):
+        """Waits for up to max_messages messages to arrive.
+
+        Returns:
+          A list of received messages, with their data decoded.  Empty if
+          the pull timed out.  See stream() for a steadier flow of messages.
+        """
         body = {
             'returnImmediately': False,
             'maxMessages': max_messages,
         }
         try:
-            resp = self._client().projects().subscriptions().pull(
+            resp = self._execute(self._subscriptions().pull(
                 subscription=self._make_subscription_path(subscription),
-                body=body).execute(num_retries=3)
+                body=body))
         except socket.timeout:
             return []
         except httplib.HTTPException:
             return []
-        messages = resp.get('receivedMessages')
+        messages = resp.get('receivedMessages', [])
         for message in messages:
             data = base64.b64decode(message['message'].get('data', ''))
             message['message']['data'] = data
+        return self._decode_payloads(messages)
+
+    def _decode_payloads(self, messages):
+        """Undoes what the publisher's PayloadCodec did to each message.
+
+        A message that can't be decoded keeps its raw data, and gets a
+        'payloadError' member explaining why, so the reader can give up on
+        it instead of failing the whole pull.
+        """
+        for message in messages:
+            body = message['message']
+            try:
+                body['data'] = self.codec.decode(body['data'],
+                                                 body.get('attributes'))
+            except PayloadError as e:
+                logging.error('Failed to decode message %s: %s',
+                              body.get('messageId'), e)
+                body['payloadError'] = str(e)
         return messages
 
-    def acknowledge(self, subscription, ack_id):
-        body = {'ackIds': [ack_id]}
-        self._client().projects().subscriptions().acknowledge(
+    def stream(self, subscription, **kwargs):
+        """Returns a MessageStream that pulls from subscription.
+
+        Takes the same keyword arguments as MessageStream.
+        """
+        return MessageStream(self, subscription, **kwargs)
+
+    def acknowledge(self, subscription, ack_ids):
+        """Acknowledges one ack id, or a list of them."""
+        if isinstance(ack_ids, basestring):
+            ack_ids = [ack_ids]
+        body = {'ackIds': list(ack_ids)}
+        self._execute(self._subscriptions().acknowledge(
+            subscription=self._make_subscription_path(subscription),
+            body=body))
+
+    def modify_ack_deadline(self, subscription, ack_ids, ack_deadline_seconds):
+        """Sets the ack deadline of a list of ack ids.
+
+        A deadline of 0 asks pubsub to redeliver the messages right away.
+        """
+        body = {'ackIds': list(ack_ids),
+                'ackDeadlineSeconds': ack_deadline_seconds}
+        self._execute(self._subscriptions().modifyAckDeadline(
             subscription=self._make_subscription_path(subscription),
-            body=body).execute(num_retries=3)
+            body=body))
 
     def delete_subscription(self, subscription):
-        self._client().projects().subscriptions().delete(
-            subscription=self._make_subscription_path(subscription)
-        ).execute(num_retries=3)
+        self._execute(self._subscriptions().delete(
+            subscription=self._make_subscription_path(subscription)))
 
     def delete_topic(self, topic):
-        self._client().projects().topics().delete(
-            topic=self._make_topic_path(topic)).execute(num_retries=3)
+        self._execute(self._topics().delete(
+            topic=self._make_topic_path(topic)))
+
+
+def _connection_pool_stats():
+    factory = PubSub._factory
+    if not factory:
+        return []
+    stats = factory.stats()
+    # Hits and misses only go up, so they're counted by CONNECTION_LOOKUPS.
+    return [({'stat': name}, stats[name]) for name in ('idle', 'lent', 'max')]
+
+
+CONNECTION_POOL = metrics.REGISTRY.gauge(
+    'shout_pubsub_connection_pool',
+    'Pub/Sub connections idle, lent out, and allowed at most.',
+    _connection_pool_stats, ['stat'])
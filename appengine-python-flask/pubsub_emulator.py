@@ -0,0 +1,241 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pub/Sub in memory, for running the whole pipeline on one machine.
+
+LocalPubSub is a drop-in replacement for pubsub.PubSub.  Topics,
+subscriptions and messages live in an Emulator shared by every LocalPubSub
+in the process, so the web app and the workers must run in the same
+process.  Like the real service:
+  - every subscription gets its own copy of each message published to its
+    topic after it was created,
+  - pull() blocks until messages arrive, or returns nothing after a while,
+  - each delivery gets a new ack id, and a message that isn't acknowledged
+    before its ack deadline is delivered again.
+"""
+import base64
+import collections
+import datetime
+import itertools
+import threading
+import time
+
+import pubsub
+
+
+class NotFound(Exception):
+    """The topic or subscription doesn't exist."""
+    pass
+
+
+class AlreadyExists(pubsub.AlreadyExists):
+    """The topic or subscription already exists."""
+    pass
+
+
+class _Subscription(object):
+    def __init__(self, topic, ack_deadline_seconds):
+        self.topic = topic
+        self.ack_deadline_seconds = ack_deadline_seconds
+        # Messages waiting to be pulled.
+        self.ready = collections.deque()
+        # Maps the ack id of each delivered message to a list of
+        # [message, deadline].
+        self.leased = {}
+
+
+class Emulator(object):
+    """Holds topics, subscriptions and messages.  Thread-safe.
+
+    Names are full paths, like projects/p/topics/t.
+    """
+
+    def __init__(self, pull_timeout_seconds=1):
+        """Args:
+          pull_timeout_seconds: float, how long pull() waits for messages
+            before returning none.
+        """
+        self._pull_timeout_seconds = pull_timeout_seconds
+        self._condition = threading.Condition()
+        # Maps each topic name to the set of its subscription names.
+        self._topics = {}
+        self._subscriptions = {}
+        self._ids = itertools.count(1)
+
+    def create_topic(self, topic):
+        with self._condition:
+            if topic in self._topics:
+                raise AlreadyExists(topic)
+            self._topics[topic] = set()
+
+    def delete_topic(self, topic):
+        with self._condition:
+            if self._topics.pop(topic, None) is None:
+                raise NotFound(topic)
+
+    def create_subscription(self, topic, subscription, ack_deadline_seconds):
+        with self._condition:
+            if subscription in self._subscriptions:
+                raise AlreadyExists(subscription)
+            if topic not in self._topics:
+                raise NotFound(topic)
+            self._topics[topic].add(subscription)
+            self._subscriptions[subscription] = _Subscription(
+                topic, ack_deadline_seconds)
+
+    def delete_subscription(self, subscription):
+        with self._condition:
+            sub = self._subscriptions.pop(subscription, None)
+            if sub is None:
+                raise NotFound(subscription)
+            if sub.topic in self._topics:
+                self._topics[sub.topic].discard(subscription)
+
+    def publish(self, topic, messages):
+        """Publishes messages built by pubsub.make_message().
+
+        Returns:
+          The list of message ids.
+        """
+        with self._condition:
+            if topic not in self._topics:
+                raise NotFound(topic)
+            publish_time = datetime.datetime.utcnow().isoformat() + 'Z'
+            message_ids = []
+            for message in messages:
+                message = dict(message, messageId=str(next(self._ids)),
+                               publishTime=publish_time)
+                message_ids.append(message['messageId'])
+                for name in self._topics[topic]:
+                    self._subscriptions[name].ready.append(message)
+            self._condition.notify_all()
+            return message_ids
+
+    def pull(self, subscription, max_messages):
+        """Waits for up to max_messages messages to arrive.
+
+        Returns:
+          A list of received messages, like the pull API returns, except
+          that their data is already decoded.  Empty if none arrived before
+          the pull timed out.
+        """
+        deadline = time.time() + self._pull_timeout_seconds
+        with self._condition:
+            while True:
+                sub = self._subscription(subscription)
+                now = time.time()
+                next_expiry = self._expire(sub, now)
+                if sub.ready:
+                    break
+                wait = deadline - now
+                if wait <= 0:
+                    return []
+                if next_expiry is not None:
+                    wait = min(wait, next_expiry - now)
+                self._condition.wait(wait)
+            received = []
+            while sub.ready and len(received) < max_messages:
+                message = sub.ready.popleft()
+                ack_id = str(next(self._ids))
+                sub.leased[ack_id] = [
+                    message, now + sub.ack_deadline_seconds]
+                message = dict(message)
+                message['data'] = base64.b64decode(message.get('data', ''))
+                received.append({'ackId': ack_id, 'message': message})
+            return received
+
+    def acknowledge(self, subscription, ack_ids):
+        with self._condition:
+            sub = self._subscription(subscription)
+            for ack_id in ack_ids:
+                # Like the real service, ignore ack ids that expired.
+                sub.leased.pop(ack_id, None)
+
+    def modify_ack_deadline(self, subscription, ack_ids, ack_deadline_seconds):
+        with self._condition:
+            sub = self._subscription(subscription)
+            deadline = time.time() + ack_deadline_seconds
+            for ack_id in ack_ids:
+                lease = sub.leased.get(ack_id)
+                if lease:
+                    lease[1] = deadline
+            if ack_deadline_seconds <= 0:
+                self._expire(sub, deadline)
+                self._condition.notify_all()
+
+    def _subscription(self, subscription):
+        sub = self._subscriptions.get(subscription)
+        if sub is None:
+            raise NotFound(subscription)
+        return sub
+
+    @staticmethod
+    def _expire(sub, now):
+        """Puts messages whose deadline passed back on the ready queue.
+
+        Returns:
+          When the next lease expires, or None if nothing is leased.
+        """
+        next_expiry = None
+        for ack_id, (message, deadline) in sub.leased.items():
+            if deadline <= now:
+                del sub.leased[ack_id]
+                sub.ready.append(message)
+            elif next_expiry is None or deadline < next_expiry:
+                next_expiry = deadline
+        return next_expiry
+
+
+class LocalPubSub(pubsub.PubSub):
+    """A pubsub.PubSub that talks to the Emulator instead of the network.
+
+    Everything built on the primitives, like publish_async() and stream(),
+    works unchanged.
+    """
+
+    # One Emulator, shared by every LocalPubSub in the process.
+    emulator = Emulator()
+
+    def create_topic(self, new_unique_name):
+        self.emulator.create_topic(self._make_topic_path(new_unique_name))
+
+    def publish_messages(self, topic, messages):
+        return self.emulator.publish(self._make_topic_path(topic), messages)
+
+    def subscribe(self, topic, new_unique_name, push_config=None):
+        self.emulator.create_subscription(
+            self._make_topic_path(topic),
+            self._make_subscription_path(new_unique_name), 15)
+
+    def pull(self, subscription, max_messages):
+        return self._decode_payloads(self.emulator.pull(
+            self._make_subscription_path(subscription), max_messages))
+
+    def acknowledge(self, subscription, ack_ids):
+        if isinstance(ack_ids, basestring):
+            ack_ids = [ack_ids]
+        self.emulator.acknowledge(self._make_subscription_path(subscription),
+                                  ack_ids)
+
+    def modify_ack_deadline(self, subscription, ack_ids, ack_deadline_seconds):
+        self.emulator.modify_ack_deadline(
+            self._make_subscription_path(subscription), ack_ids,
+            ack_deadline_seconds)
+
+    def delete_subscription(self, subscription):
+        self.emulator.delete_subscription(
+            self._make_subscription_path(subscription))
+
+    def delete_topic(self, topic):
+        self.emulator.delete_topic(self._make_topic_path(topic))
@@ -0,0 +1,86 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+
+import pubsub
+import pubsub_emulator
+
+TOPIC = 'projects/p/topics/t'
+SUBSCRIPTION = 'projects/p/subscriptions/s'
+
+
+class EmulatorTest(unittest.TestCase):
+    def setUp(self):
+        self.emulator = pubsub_emulator.Emulator(pull_timeout_seconds=0.05)
+        self.emulator.create_topic(TOPIC)
+        self.emulator.create_subscription(TOPIC, SUBSCRIPTION, 0.2)
+
+    def publish(self, data):
+        self.emulator.publish(TOPIC, [pubsub.make_message(data, {})])
+
+    def test_pull_and_ack(self):
+        self.publish('hello')
+        received = self.emulator.pull(SUBSCRIPTION, 10)
+        self.assertEqual(['hello'], [r['message']['data'] for r in received])
+        self.emulator.acknowledge(SUBSCRIPTION, [received[0]['ackId']])
+        time.sleep(0.3)
+        self.assertEqual([], self.emulator.pull(SUBSCRIPTION, 10))
+
+    def test_redelivers_after_ack_deadline(self):
+        self.publish('hello')
+        first = self.emulator.pull(SUBSCRIPTION, 10)
+        self.assertEqual([], self.emulator.pull(SUBSCRIPTION, 10))
+        time.sleep(0.3)
+        second = self.emulator.pull(SUBSCRIPTION, 10)
+        self.assertEqual(['hello'], [r['message']['data'] for r in second])
+        self.assertNotEqual(first[0]['ackId'], second[0]['ackId'])
+        # The first delivery's ack id expired, so acking it does nothing.
+        self.emulator.acknowledge(SUBSCRIPTION, [first[0]['ackId']])
+        time.sleep(0.3)
+        self.assertEqual(1, len(self.emulator.pull(SUBSCRIPTION, 10)))
+
+    def test_zero_deadline_redelivers_now(self):
+        self.publish('hello')
+        first = self.emulator.pull(SUBSCRIPTION, 10)
+        self.emulator.modify_ack_deadline(SUBSCRIPTION, [first[0]['ackId']],
+                                          0)
+        self.assertEqual(1, len(self.emulator.pull(SUBSCRIPTION, 10)))
+
+    def test_extending_the_deadline_delays_redelivery(self):
+        self.publish('hello')
+        first = self.emulator.pull(SUBSCRIPTION, 10)
+        self.emulator.modify_ack_deadline(SUBSCRIPTION, [first[0]['ackId']],
+                                          10)
+        time.sleep(0.3)
+        self.assertEqual([], self.emulator.pull(SUBSCRIPTION, 10))
+
+    def test_each_subscription_gets_a_copy(self):
+        other = 'projects/p/subscriptions/other'
+        self.emulator.create_subscription(TOPIC, other, 10)
+        self.publish('hello')
+        self.assertEqual(1, len(self.emulator.pull(SUBSCRIPTION, 10)))
+        self.assertEqual(1, len(self.emulator.pull(other, 10)))
+
+    def test_already_exists(self):
+        self.assertRaises(pubsub.AlreadyExists, self.emulator.create_topic,
+                          TOPIC)
+        self.assertRaises(pubsub.AlreadyExists,
+                          self.emulator.create_subscription, TOPIC,
+                          SUBSCRIPTION, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
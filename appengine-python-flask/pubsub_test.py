@@ -0,0 +1,233 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import metrics
+import pubsub
+
+
+class ClientFactoryTest(unittest.TestCase):
+    def setUp(self):
+        self.factory = pubsub.ClientFactory(max_connections=1)
+        # Stands in for an authorized Http.
+        self.factory._new_http = object
+
+    def test_reuses_connections(self):
+        with self.factory.http() as first:
+            pass
+        with self.factory.http() as second:
+            self.assertIs(first, second)
+        self.assertEqual({'hits': 1, 'misses': 1, 'idle': 1, 'lent': 0,
+                          'max': 1}, self.factory.stats())
+
+    def test_add_connections(self):
+        self.factory.add_connections(1)
+        with self.factory.http() as first:
+            # Would wait forever with one connection.
+            with self.factory.http() as second:
+                self.assertIsNot(first, second)
+        self.factory.add_connections(-1)
+        self.assertEqual(2, self.factory.stats()['idle'])
+
+    def test_gauge(self):
+        real_factory, pubsub.PubSub._factory = (pubsub.PubSub._factory,
+                                                self.factory)
+        try:
+            with self.factory.http():
+                lines = pubsub.CONNECTION_POOL.render()
+        finally:
+            pubsub.PubSub._factory = real_factory
+        self.assertIn('shout_pubsub_connection_pool{stat="lent"} 1', lines)
+        self.assertIn('shout_pubsub_connection_pool{stat="max"} 1', lines)
+        self.assertFalse([line for line in lines if 'hits' in line])
+
+    def test_lookups_counted(self):
+        def lookups(result):
+            return metrics.CONNECTION_LOOKUPS._values.get((result,), 0)
+        hits, misses = lookups('hit'), lookups('miss')
+        with self.factory.http():
+            pass
+        with self.factory.http():
+            pass
+        self.assertEqual((hits + 1, misses + 1),
+                         (lookups('hit'), lookups('miss')))
+
+
+class PayloadCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.blobs = pubsub.FileBlobStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_small_data_passes_through(self):
+        codec = pubsub.PayloadCodec(blob_store=self.blobs)
+        self.assertEqual(('hello', {'a': 'b'}),
+                         codec.encode('hello', {'a': 'b'}))
+        self.assertEqual('hello', codec.decode('hello', {'a': 'b'}))
+
+    def test_compresses(self):
+        codec = pubsub.PayloadCodec(compress_bytes=10)
+        text = u'hello \xe9 ' * 100
+        data, attributes = codec.encode(text, {})
+        self.assertEqual('zlib', attributes['codec'])
+        self.assertLess(len(data), len(text))
+        self.assertEqual(text.encode('utf-8'), codec.decode(data, attributes))
+
+    def test_compression_is_opt_in(self):
+        codec = pubsub.PayloadCodec()
+        text = 'hello' * 1000
+        self.assertEqual((text, {}), codec.encode(text, {}))
+
+    def test_keeps_incompressible_data(self):
+        codec = pubsub.PayloadCodec(compress_bytes=10)
+        data = ''.join(chr(i) for i in range(256))
+        self.assertEqual((data, {}), codec.encode(data, {}))
+
+    def test_moves_huge_data_out_of_band(self):
+        codec = pubsub.PayloadCodec(compress_bytes=10, blob_store=self.blobs,
+                                    blob_bytes=10)
+        text = ''.join(chr(i) for i in range(256)) * 10
+        data, attributes = codec.encode(text, None)
+        self.assertEqual('zlib,blob', attributes['codec'])
+        self.assertEqual(text, codec.decode(data, attributes))
+
+    def test_bad_payloads(self):
+        codec = pubsub.PayloadCodec()
+        self.assertRaises(pubsub.PayloadError, codec.decode, 'nonsense',
+                          {'codec': 'zlib'})
+        # Without a blob store, a blob can't be fetched.
+        self.assertRaises(pubsub.PayloadError, codec.decode, 'x' * 32,
+                          {'codec': 'blob'})
+        self.assertRaises(pubsub.PayloadError, codec.decode, 'x',
+                          {'codec': 'rot13'})
+        # Blob names can't wander out of the directory.
+        codec = pubsub.PayloadCodec(blob_store=self.blobs)
+        self.assertRaises(pubsub.PayloadError, codec.decode, '../passwd',
+                          {'codec': 'blob'})
+
+
+class FakeAckManager(object):
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda subscription, ack_id: self.calls.append((name, ack_id))
+
+
+class GatedPubSub(object):
+    """Holds every pull until the gate opens, then fills it."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.requests = []
+        self.factory = pubsub.ClientFactory(max_connections=0)
+
+    def client_factory(self):
+        return self.factory
+
+    def pull(self, subscription, max_messages):
+        start = sum(self.requests)
+        self.requests.append(max_messages)
+        self.gate.wait()
+        return [{'ackId': str(start + i), 'message': {'data': 'x'}}
+                for i in range(max_messages)]
+
+
+class MessageStreamTest(unittest.TestCase):
+    def test_pulls_in_flight_share_the_room(self):
+        fake = GatedPubSub()
+        stream = pubsub.MessageStream(
+            fake, 'subscription', pulls=3, max_messages=10,
+            max_outstanding_messages=15, ack_manager=FakeAckManager())
+        try:
+            time.sleep(0.2)
+            # The third pull waits for room instead of asking for more.
+            self.assertEqual([5, 10], sorted(fake.requests))
+            fake.gate.set()
+            time.sleep(0.2)
+            self.assertEqual(15, len(stream._outstanding))
+            self.assertEqual(2, len(fake.requests))
+            # Finishing a message makes room for one more.
+            stream.ack(next(iter(stream)))
+            time.sleep(0.2)
+            self.assertEqual([1, 5, 10], sorted(fake.requests))
+        finally:
+            fake.gate.set()
+            stream.close()
+
+
+class RecordingPubSub(object):
+    """Records the acknowledge and modify_ack_deadline requests sent."""
+
+    def __init__(self):
+        self.acks = []
+        self.deadlines = []
+
+    def acknowledge(self, subscription, ack_ids):
+        self.acks.append((subscription, list(ack_ids)))
+
+    def modify_ack_deadline(self, subscription, ack_ids, seconds):
+        self.deadlines.append((subscription, list(ack_ids), seconds))
+
+
+class AckManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.pubsub = RecordingPubSub()
+
+    def test_batches_acks(self):
+        manager = pubsub.AckManager(self.pubsub, max_ids=2, max_latency=10)
+        manager.start()
+        for i in range(5):
+            manager.ack('s', str(i))
+        manager.stop()
+        self.assertEqual(map(str, range(5)), sorted(
+            ack_id for _, ack_ids in self.pubsub.acks for ack_id in ack_ids))
+        self.assertTrue(all(0 < len(ack_ids) <= 2
+                            for _, ack_ids in self.pubsub.acks))
+
+    def test_sends_after_max_latency(self):
+        manager = pubsub.AckManager(self.pubsub, max_latency=0.05)
+        manager.start()
+        try:
+            manager.ack('s', 'a')
+            manager.nack('t', 'b')
+            time.sleep(0.5)
+            self.assertEqual([('s', ['a'])], self.pubsub.acks)
+            self.assertEqual([('t', ['b'], 0)], self.pubsub.deadlines)
+        finally:
+            manager.stop()
+
+    def test_extends_leases(self):
+        manager = pubsub.AckManager(self.pubsub, ack_deadline_seconds=10,
+                                    lease_margin_seconds=10)
+        manager.lease('s', 'leased')
+        manager.lease('s', 'acked')
+        manager.ack('s', 'acked')
+        manager.lease('s', 'released')
+        manager.release('s', 'released')
+        manager.start()
+        manager.stop()
+        self.assertEqual([('s', ['leased'], 10)], self.pubsub.deadlines)
+        self.assertEqual([('s', ['acked'])], self.pubsub.acks)
+
+
+if __name__ == '__main__':
+    unittest.main()
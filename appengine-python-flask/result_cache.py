@@ -0,0 +1,162 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Remembers the results of shouting, and shouts each text once at a time.
+
+Shouting is deterministic, apart from the errors the workers inject, so a
+text always shouts the same result.  ResultCache remembers successful
+results by a hash of the text, so /shout can answer a text it has seen
+before without a worker.
+
+Flights coalesce concurrent shouts of the same text.  The first becomes the
+leader of a flight, and is published as usual, with the flight id in its
+postStatusUrl.  Shouts of the same text that arrive while it's in flight
+join the flight instead of being published, and every status the workers
+report for the leader is copied to them.  Once the leader's status is
+final, the flight lands, and nobody can join it any more.
+
+Both are shared by every user, so a user can tell from how fast a shout
+returns whether someone else shouted the same text lately.  See the
+README.
+"""
+import collections
+import hashlib
+import uuid
+
+import metrics
+
+# landed: bool, whether the flight has landed.
+# text_key: string, the text_key() of the text being shouted.
+# followers: tuple of the combined ids of the shouts that joined.
+Flight = collections.namedtuple('Flight', ['landed', 'text_key', 'followers'])
+
+
+def text_key(text):
+    """Returns the key of a shout text in ResultCache and Flights."""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha256(text).hexdigest()
+
+
+class ResultCache(object):
+    """Remembers successful results in a cache in this instance, in front of
+    an optional shared cache.  Both must look like status_cache.LruCache.
+    """
+
+    def __init__(self, local, shared=None, max_result_bytes=10000):
+        """Args:
+          max_result_bytes: int, results longer than this aren't worth the
+            space.
+        """
+        self._local = local
+        self._shared = shared
+        self._max_result_bytes = max_result_bytes
+
+    def get(self, key):
+        """Returns the result for the text with key, or None."""
+        result, _ = self._local.gets(key)
+        if result is None and self._shared:
+            result, _ = self._shared.gets(key)
+            if result is not None:
+                self._local.add(key, result)
+        metrics.RESULT_CACHE_LOOKUPS.inc(
+            result='miss' if result is None else 'hit')
+        return result
+
+    def put(self, key, result):
+        """Remembers the result of a successful shout."""
+        if result is None or len(result) > self._max_result_bytes:
+            return
+        # The same text always has the same result, so there's never a
+        # different one to replace.
+        self._local.add(key, result)
+        if self._shared:
+            self._shared.add(key, result)
+
+
+class Flights(object):
+    """Tracks the flights in the air, in a cache that looks like
+    status_cache.LruCache.  Its entries must outlive the longest flight.
+
+    The cache maps each text_key() to the id of its flight, and each flight
+    id to a Flight.
+    """
+
+    # Give up on joining or landing after this many tries.
+    MAX_CAS_ATTEMPTS = 5
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def join(self, key, combined_shout_id):
+        """Joins the flight of the text with key, or starts one.
+
+        Returns:
+          A tuple (flight_id, leader).  If leader is True, the caller must
+          publish the shout request, with flight_id in its postStatusUrl.
+          flight_id is None when the shout couldn't join or start a flight,
+          so it must be published alone.  If leader is False, the shout
+          joined a flight, and its statuses will be copied from the leader.
+        """
+        for i in range(self.MAX_CAS_ATTEMPTS):
+            flight_id, _ = self._cache.gets(key)
+            if flight_id is None:
+                flight_id = uuid.uuid4().hex
+                # The flight must exist before anyone can find it by key.
+                if not self._cache.add(_flight_key(flight_id),
+                                       Flight(False, key, ())):
+                    continue
+                if self._cache.add(key, flight_id):
+                    metrics.FLIGHTS.inc(role='leader')
+                    return flight_id, True
+                # Another shout of the same text started a flight first.
+                self._cache.delete(_flight_key(flight_id))
+                continue
+            flight, token = self._cache.gets(_flight_key(flight_id))
+            if flight is None or flight.landed:
+                # It landed just now, or the cache forgot it.
+                break
+            if self._cache.cas(_flight_key(flight_id), flight._replace(
+                    followers=flight.followers + (combined_shout_id,)), token):
+                metrics.FLIGHTS.inc(role='follower')
+                return flight_id, False
+        metrics.FLIGHTS.inc(role='alone')
+        return None, True
+
+    def get(self, flight_id):
+        """Returns the Flight with flight_id, or None if it's forgotten."""
+        flight, _ = self._cache.gets(_flight_key(flight_id))
+        return flight
+
+    def land(self, flight_id):
+        """Lands a flight, so nobody else can join it.
+
+        Returns:
+          The combined ids of the shouts that joined the flight.  Empty if
+          it already landed, so each follower gets the final status once.
+        """
+        for i in range(self.MAX_CAS_ATTEMPTS):
+            flight, token = self._cache.gets(_flight_key(flight_id))
+            if flight is None or flight.landed:
+                return ()
+            if self._cache.cas(_flight_key(flight_id),
+                               flight._replace(landed=True), token):
+                self._cache.delete(flight.text_key)
+                return flight.followers
+        # The followers will time out, like shouts whose message was lost.
+        return ()
+
+
+def _flight_key(flight_id):
+    return 'flight-' + flight_id
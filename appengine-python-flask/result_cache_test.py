@@ -0,0 +1,122 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Needs the App Engine SDK on PYTHONPATH, for status_cache."""
+import unittest
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext import testbed
+    import result_cache
+    import status_cache
+except ImportError:
+    testbed = None
+
+
+class FakeTime(object):
+    """Stands in for the time module, so tests needn't sleep."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@unittest.skipIf(testbed is None, 'needs the App Engine SDK on PYTHONPATH')
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.local = status_cache.LruCache()
+        self.shared = status_cache.LruCache()
+        self.results = result_cache.ResultCache(self.local, self.shared,
+                                                max_result_bytes=10)
+
+    def test_text_key(self):
+        self.assertEqual(result_cache.text_key(u'\xe9'),
+                         result_cache.text_key('\xc3\xa9'))
+        self.assertNotEqual(result_cache.text_key('a'),
+                            result_cache.text_key('A'))
+
+    def test_remembers_results(self):
+        self.assertIsNone(self.results.get('key'))
+        self.results.put('key', 'HELLO')
+        self.assertEqual('HELLO', self.results.get('key'))
+        self.assertEqual('HELLO', self.shared.gets('key')[0])
+
+    def test_shared_hit_fills_local(self):
+        self.shared.add('key', 'HELLO')
+        self.assertEqual('HELLO', self.results.get('key'))
+        self.assertEqual('HELLO', self.local.gets('key')[0])
+
+    def test_skips_big_results(self):
+        self.results.put('key', 'X' * 11)
+        self.results.put('none', None)
+        self.assertIsNone(self.results.get('key'))
+        self.assertIsNone(self.results.get('none'))
+
+
+@unittest.skipIf(testbed is None, 'needs the App Engine SDK on PYTHONPATH')
+class FlightsTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeTime()
+        self.real_time, status_cache.time = status_cache.time, self.clock
+        self.flights = result_cache.Flights(
+            status_cache.LruCache(ttl_seconds=60))
+
+    def tearDown(self):
+        status_cache.time = self.real_time
+
+    def test_join_and_land(self):
+        flight_id, leader = self.flights.join('key', 'b-1')
+        self.assertTrue(flight_id)
+        self.assertTrue(leader)
+        self.assertEqual((flight_id, False), self.flights.join('key', 'b-2'))
+        self.assertEqual((flight_id, False), self.flights.join('key', 'b-3'))
+        flight = self.flights.get(flight_id)
+        self.assertEqual(('key', ('b-2', 'b-3')),
+                         (flight.text_key, flight.followers))
+        self.assertEqual(('b-2', 'b-3'), self.flights.land(flight_id))
+        # Each follower gets the final status once.
+        self.assertEqual((), self.flights.land(flight_id))
+        # The next shout of the text starts a new flight.
+        new_flight_id, leader = self.flights.join('key', 'b-4')
+        self.assertTrue(leader)
+        self.assertNotEqual(flight_id, new_flight_id)
+
+    def test_texts_fly_apart(self):
+        first, _ = self.flights.join('key', 'b-1')
+        second, leader = self.flights.join('other key', 'b-2')
+        self.assertTrue(leader)
+        self.assertNotEqual(first, second)
+
+    def test_expired_flight(self):
+        flight_id, _ = self.flights.join('key', 'b-1')
+        self.clock.now += 61
+        self.assertIsNone(self.flights.get(flight_id))
+        self.assertEqual((), self.flights.land(flight_id))
+        new_flight_id, leader = self.flights.join('key', 'b-2')
+        self.assertTrue(leader)
+        self.assertNotEqual(flight_id, new_flight_id)
+
+    def test_forgotten_flight_shouts_alone(self):
+        cache = status_cache.LruCache()
+        flights = result_cache.Flights(cache)
+        flight_id, _ = flights.join('key', 'b-1')
+        cache.delete(result_cache._flight_key(flight_id))
+        self.assertEqual((None, True), flights.join('key', 'b-2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
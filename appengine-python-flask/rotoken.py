@@ -12,6 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hmac
+import threading
+import time
+
 from google.appengine.ext import ndb
 
 
@@ -20,19 +24,36 @@ class Rotoken(object):
 
     Keeps a list of security tokens in datastore.  Periodically,
     a token is added to the list and an old one is dropped (rotated.)
+
+    The list is also cached in process memory for cache_seconds.  Another
+    instance may rotate in a new token while our copy is cached, so
+    is_valid() re-reads datastore before rejecting a token.
     """
 
-    def __init__(self, datastore_key='SINGLETON', max_tokens=3):
+    def __init__(self, datastore_key='SINGLETON', max_tokens=3,
+                 rotation_seconds=3600, cache_seconds=300):
         """Creates a rotating token manager.
 
         Args:
           datastore_key: the key that will be used to store the list.
           max_tokens: how many tokens should we keep around?
+          rotation_seconds: how often rotate_token() gets called.
+          cache_seconds: how long to keep our copy of the list.  Never longer
+            than rotation_seconds, so we never hand out a token that's been
+            rotated out of the list.
         """
         self._key = ndb.Key(RotokenRecord, datastore_key)
         self._max_tokens = max_tokens
+        self._cache_seconds = min(cache_seconds, rotation_seconds)
+        self._lock = threading.Lock()
+        # A tuple of (tokens, expiration time), replaced all at once.
+        self._cache = None
+
+    def invalidate(self):
+        """Forgets our cached copy of the list."""
+        with self._lock:
+            self._cache = None
 
-    @ndb.transactional
     def init(self, first_token):
         """Creates the first token in the datastore.
 
@@ -40,14 +61,23 @@ class Rotoken(object):
         Args:
           first_token: string, the token to insert into the list.
         """
+        self._init(first_token)
+        self.invalidate()
+
+    @ndb.transactional
+    def _init(self, first_token):
         record = self._key.get()
         if not record:
             record = RotokenRecord(key=self._key, tokens=[first_token])
         record.put()
 
-    @ndb.transactional
     def rotate_token(self, token):
         """Rotates in a new token and drops an old token."""
+        self._rotate_token(token)
+        self.invalidate()
+
+    @ndb.transactional
+    def _rotate_token(self, token):
         record = self._key.get()
         record.tokens.insert(0, token)
         del record.tokens[self._max_tokens:]
@@ -56,11 +86,42 @@ class Rotoken(object):
     def get_tokens(self):
         """Returns the list of tokens.
 
-        Because this is a key.get() and not a query, and because the value
-        rarely changes, most of the time this call will be satisfied from
-        memcache.
+        Most of the time this call will be satisfied from our cached copy.
+        Otherwise, because this is a key.get() and not a query, and because
+        the value rarely changes, it will be satisfied from memcache.
         """
-        return self._key.get().tokens
+        cache = self._cache
+        if cache and time.time() < cache[1]:
+            return list(cache[0])
+        return list(self._refresh())
+
+    def is_valid(self, token):
+        """Returns True if token is in the list.
+
+        Compares in constant time, so an attacker can't learn a token by
+        timing our responses.
+        """
+        if not token:
+            return False
+        if isinstance(token, unicode):
+            token = token.encode('utf-8')
+        if self._contains(self.get_tokens(), token):
+            return True
+        # Maybe another instance rotated in a token we haven't seen yet.
+        return self._contains(self._refresh(), token)
+
+    def _refresh(self):
+        tokens = tuple(self._key.get().tokens)
+        with self._lock:
+            self._cache = (tokens, time.time() + self._cache_seconds)
+        return tokens
+
+    @staticmethod
+    def _contains(tokens, token):
+        found = False
+        for candidate in tokens:
+            found |= hmac.compare_digest(candidate.encode('utf-8'), token)
+        return found
 
 
 class RotokenRecord(ndb.Model):
@@ -0,0 +1,87 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Needs the App Engine SDK on PYTHONPATH, for the datastore."""
+import unittest
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+    import rotoken
+except ImportError:
+    testbed = None
+
+
+class FakeTime(object):
+    """Stands in for the time module, so tests needn't sleep."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@unittest.skipIf(testbed is None, 'needs the App Engine SDK on PYTHONPATH')
+class RotokenTest(unittest.TestCase):
+    def setUp(self):
+        self.bed = testbed.Testbed()
+        self.bed.activate()
+        self.bed.init_datastore_v3_stub()
+        self.bed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        self.clock = FakeTime()
+        self.real_time, rotoken.time = rotoken.time, self.clock
+        self.purse = rotoken.Rotoken(max_tokens=2, cache_seconds=60)
+        self.purse.init('first')
+        # Another instance, sharing the datastore.
+        self.other = rotoken.Rotoken(max_tokens=2, cache_seconds=60)
+
+    def tearDown(self):
+        rotoken.time = self.real_time
+        self.bed.deactivate()
+
+    def test_rotates(self):
+        self.purse.rotate_token('second')
+        self.purse.rotate_token('third')
+        self.assertEqual(['third', 'second'], self.purse.get_tokens())
+        self.assertTrue(self.purse.is_valid(u'second'))
+        self.assertFalse(self.purse.is_valid('first'))
+        self.assertFalse(self.purse.is_valid(''))
+
+    def test_caches_until_expired(self):
+        self.assertEqual(['first'], self.purse.get_tokens())
+        self.other.rotate_token('second')
+        self.assertEqual(['first'], self.purse.get_tokens())
+        self.clock.now += 61
+        self.assertEqual(['second', 'first'], self.purse.get_tokens())
+
+    def test_accepts_a_token_rotated_in_elsewhere(self):
+        self.purse.get_tokens()
+        self.other.rotate_token('second')
+        self.assertTrue(self.purse.is_valid('second'))
+        self.assertEqual(['second', 'first'], self.purse.get_tokens())
+
+    def test_cache_never_outlives_a_rotation(self):
+        purse = rotoken.Rotoken(rotation_seconds=10, cache_seconds=60)
+        purse.get_tokens()
+        self.other.rotate_token('second')
+        self.clock.now += 11
+        self.assertEqual(['second', 'first'], purse.get_tokens())
+
+
+if __name__ == '__main__':
+    unittest.main()
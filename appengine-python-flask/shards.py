@@ -0,0 +1,68 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Splits shout requests across several topic and subscription pairs.
+
+One subscription's backlog and ack traffic limit how many workers can
+share it.  With N shards, main.py publishes each shout request to one of N
+topics, picked by a hash of the browser id, and each worker pulls from the
+subscriptions of the shards it's assigned.  Shard 0 keeps the original
+names, so a single shard is the original setup, and the C# workers, which
+only know the original subscription, serve shard 0.
+
+Changing N is safe in either direction, because a shout request carries
+everything the worker needs, wherever it lands:
+  - To add shards, visit /init after raising SHOUT_SHARDS, so the new
+    topics exist before anything is published to them, and start workers
+    for the new shards.
+  - To remove shards, lower SHOUT_SHARDS, and keep the workers of the
+    removed shards running until /shards shows their backlog is empty.
+Imports nothing from App Engine, so workers can use it too.
+"""
+import zlib
+
+TOPIC = 'shout-requests'
+SUBSCRIPTION = 'shout-request-workers'
+
+
+def topic_name(shard, base=TOPIC):
+    """Returns the name of a shard's topic."""
+    return base if shard == 0 else '%s-%d' % (base, shard)
+
+
+def subscription_name(shard, base=SUBSCRIPTION):
+    """Returns the name of a shard's subscription."""
+    return base if shard == 0 else '%s-%d' % (base, shard)
+
+
+def shard_for(browser_id, shard_count):
+    """Returns the shard for a browser's shout requests.
+
+    crc32 instead of hash(), because every instance must agree.  The id is
+    hashed as UTF-8, so a unicode id from a form and the same id as a str
+    land on the same shard.  crc32 may be negative, so it's masked to its
+    unsigned value first.
+    """
+    if isinstance(browser_id, unicode):
+        browser_id = browser_id.encode('utf-8')
+    return (zlib.crc32(browser_id) & 0xffffffff) % shard_count
+
+
+def parse_shards(text):
+    """Parses a list of shards like '0,2-4' into [0, 2, 3, 4]."""
+    shards = []
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        shards.extend(range(int(first), int(last or first) + 1))
+    return shards
@@ -0,0 +1,50 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import zlib
+
+import shards
+
+
+class ShardsTest(unittest.TestCase):
+    def test_names(self):
+        self.assertEqual(shards.TOPIC, shards.topic_name(0))
+        self.assertEqual(shards.SUBSCRIPTION + '-3',
+                         shards.subscription_name(3))
+
+    def test_shard_for_agrees_on_str_and_unicode(self):
+        for browser_id in ('abc', u'\xe9t\xe9', u'\u4f60\u597d'):
+            utf8 = (browser_id.encode('utf-8')
+                    if isinstance(browser_id, unicode) else browser_id)
+            for count in (1, 7, 64):
+                shard = shards.shard_for(browser_id, count)
+                self.assertEqual(shard, shards.shard_for(utf8, count))
+                self.assertTrue(0 <= shard < count)
+
+    def test_shard_for_masks_negative_crcs(self):
+        # crc32 is signed in Python 2.
+        browser_id = next(str(i) for i in range(100)
+                          if zlib.crc32(str(i)) < 0)
+        self.assertEqual(
+            (zlib.crc32(browser_id) + 2 ** 32) % 10,
+            shards.shard_for(browser_id, 10))
+
+    def test_parse_shards(self):
+        self.assertEqual([0], shards.parse_shards('0'))
+        self.assertEqual([0, 2, 3, 4], shards.parse_shards('0, 2-4'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how long it takes a new instance to import main.py.
+
+Imports main against the App Engine testbed stubs, and records:
+  - how long each module took to import, with and without the modules it
+    imported in turn, and
+  - how long each call made by main's module-level code took, like building
+    the Rotoken or the Jinja environment.
+Each run happens in a fresh python process, so every import is cold.  The
+report is JSON, so it can be saved and compared between releases.
+
+--defer replaces a module with a stand-in that imports it on first use, to
+measure what deferring the import would save.
+
+Usage:
+  PYTHONPATH=$PYTHONPATH:lib python startup_benchmark.py --runs 5 \\
+      --defer apiclient.discovery --output startup.json
+The App Engine SDK must be on PYTHONPATH.
+"""
+import __builtin__
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stands in for a module until one of its attributes is used."""
+
+    def __init__(self, name):
+        types.ModuleType.__init__(self, name)
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            del sys.modules[self.__name__]
+            module = self.__dict__['_module'] = __import__(
+                self.__name__, fromlist=['*'])
+            sys.modules[self.__name__] = module
+        return getattr(module, attr)
+
+
+class ImportTimer(object):
+    """Records how long each module takes to import the first time."""
+
+    def __init__(self):
+        self.imports = {}
+        self._stack = []
+        self._original_import = None
+
+    def install(self):
+        self._original_import = __builtin__.__import__
+        __builtin__.__import__ = self._import
+
+    def uninstall(self):
+        __builtin__.__import__ = self._original_import
+
+    def _import(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return self._original_import(name, *args, **kwargs)
+        self._stack.append(0.0)
+        start = time.time()
+        try:
+            return self._original_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            if name not in self.imports:
+                self.imports[name] = {'cumulative': elapsed,
+                                      'self': elapsed - nested}
+
+
+class InitializerTimer(object):
+    """Records how long each call made directly by a module's top level
+    code takes.
+    """
+
+    def __init__(self, module_name):
+        self.calls = []
+        self._module_name = module_name
+        self._starts = {}
+
+    def install(self):
+        sys.setprofile(self._profile)
+
+    def uninstall(self):
+        sys.setprofile(None)
+
+    def _profile(self, frame, event, arg):
+        if event in ('call', 'return'):
+            if frame.f_code is ImportTimer._import.__func__.__code__:
+                return  # Imports are timed by ImportTimer.
+            caller = frame.f_back
+            name = frame.f_code.co_name
+        elif event in ('c_call', 'c_return', 'c_exception'):
+            caller = frame
+            name = getattr(arg, '__name__', repr(arg))
+        else:
+            return
+        if (not caller or caller.f_code.co_name != '<module>' or
+                caller.f_globals.get('__name__') != self._module_name):
+            return
+        key = (id(caller), caller.f_lineno)
+        if event in ('call', 'c_call'):
+            self._starts[key] = time.time()
+        elif key in self._starts:
+            self.calls.append({
+                'line': caller.f_lineno,
+                'call': name,
+                'seconds': time.time() - self._starts.pop(key),
+            })
+
+
+def activate_testbed():
+    """Installs local stand-ins for the App Engine APIs main.py uses."""
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(overwrite=True, app_id='startup-benchmark',
+                  CURRENT_VERSION_ID='benchmark.1')
+    bed.init_app_identity_stub()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_modules_stub()
+    bed.init_taskqueue_stub()
+    bed.init_urlfetch_stub()
+    return bed
+
+
+def measure(defer):
+    """Imports main once, and returns a dict of what we measured."""
+    setup_start = time.time()
+    bed = activate_testbed()
+    setup_seconds = time.time() - setup_start
+    for name in defer:
+        sys.modules[name] = LazyModule(name)
+    imports = ImportTimer()
+    initializers = InitializerTimer('main')
+    start = time.time()
+    imports.install()
+    initializers.install()
+    try:
+        __import__('main')
+    finally:
+        initializers.uninstall()
+        imports.uninstall()
+    total = time.time() - start
+    bed.deactivate()
+    return {
+        'total_seconds': total,
+        'testbed_seconds': setup_seconds,
+        'imports': imports.imports,
+        'initializers': initializers.calls,
+    }
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarize(runs, defer):
+    """Combines runs into one report, taking the median of each number."""
+    imports = {}
+    for run in runs:
+        for name, times in run['imports'].iteritems():
+            imports.setdefault(name, []).append(times)
+    initializers = {}
+    for run in runs:
+        for call in run['initializers']:
+            key = (call['line'], call['call'])
+            initializers.setdefault(key, []).append(call['seconds'])
+    return {
+        'python': sys.version,
+        'runs': len(runs),
+        'deferred': defer,
+        'total_seconds': median([run['total_seconds'] for run in runs]),
+        'testbed_seconds': median([run['testbed_seconds'] for run in runs]),
+        'imports': sorted(
+            [{'module': name,
+              'cumulative_seconds': median([t['cumulative'] for t in times]),
+              'self_seconds': median([t['self'] for t in times])}
+             for name, times in imports.iteritems()],
+            key=lambda entry: -entry['cumulative_seconds']),
+        'initializers': sorted(
+            [{'line': line, 'call': call, 'seconds': median(seconds)}
+             for (line, call), seconds in initializers.iteritems()],
+            key=lambda entry: entry['line']),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures how long it takes to import main.py.')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='How many fresh processes to measure.')
+    parser.add_argument('--defer', action='append', default=[],
+                        metavar='MODULE',
+                        help='Import MODULE on first use.  May be repeated.')
+    parser.add_argument('--output', help='Write the report here.  '
+                        'Defaults to stdout.')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    here = os.path.dirname(os.path.abspath(__file__))
+    if args.child:
+        sys.path.insert(0, here)
+        json.dump(measure(args.defer), sys.stdout)
+        return
+    runs = []
+    for i in range(args.runs):
+        command = [sys.executable, os.path.abspath(__file__), '--child']
+        for name in args.defer:
+            command.extend(['--defer', name])
+        runs.append(json.loads(subprocess.check_output(command, cwd=here)))
+    report = json.dumps(summarize(runs, args.defer), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print report
+
+
+if __name__ == '__main__':
+    main()
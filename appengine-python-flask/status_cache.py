@@ -0,0 +1,244 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caches the current status of each shout in front of a StatusStore.
+
+Most status lookups made while long polling find nothing new, so answering
+them from a cache saves a datastore query each.  Writes go through to the
+store, then update the cache with compare-and-set, so a lower priority
+status never replaces a higher one, however the writes interleave.
+Entries expire after a while, so a cache that somehow went stale heals
+itself.
+"""
+import collections
+import datetime
+import itertools
+import threading
+import time
+
+from google.appengine.api import memcache
+
+import metrics
+import status_store
+
+
+class LruCache(object):
+    """Keeps entries in process memory, and forgets the least recently used
+    when full.  For tests and single-instance deployments.
+    """
+
+    def __init__(self, max_entries=10000, ttl_seconds=120):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # Maps each key to a tuple of (value, expiry, cas token).
+        self._entries = collections.OrderedDict()
+        self._tokens = itertools.count(1)
+
+    def gets(self, key):
+        """Returns a tuple of (value, cas token).  value is None on a miss."""
+        with self._lock:
+            entry = self._get(key)
+            return (entry[0], entry[2]) if entry else (None, None)
+
+    def get_multi(self, keys):
+        with self._lock:
+            found = {}
+            for key in keys:
+                entry = self._get(key)
+                if entry:
+                    found[key] = entry[0]
+            return found
+
+    def add(self, key, value):
+        """Stores value unless key is already present.  Returns True if it
+        was stored.
+        """
+        with self._lock:
+            if self._get(key):
+                return False
+            self._set(key, value)
+            return True
+
+    def cas(self, key, value, token):
+        """Stores value if key hasn't changed since gets() returned token.
+        Returns True if it was stored.
+        """
+        with self._lock:
+            entry = self._get(key)
+            if not entry or entry[2] != token:
+                return False
+            self._set(key, value)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry and entry[1] > time.time():
+            # Move it to the most recently used end.
+            self._entries[key] = entry
+            return entry
+        return None
+
+    def _set(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = (value, time.time() + self._ttl_seconds,
+                              next(self._tokens))
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+class MemcacheCache(object):
+    """Keeps entries in memcache, so every instance shares them."""
+
+    def __init__(self, namespace='status', ttl_seconds=120):
+        self._namespace = namespace
+        self._ttl_seconds = ttl_seconds
+
+    def gets(self, key):
+        # A Client remembers the cas ids of what it got, so the Client
+        # itself is the cas token.
+        client = memcache.Client()
+        with metrics.rpc_timer('memcache', 'gets'):
+            value = client.gets(key, namespace=self._namespace)
+        return value, client
+
+    def get_multi(self, keys):
+        with metrics.rpc_timer('memcache', 'get_multi'):
+            return memcache.get_multi(list(keys), namespace=self._namespace)
+
+    def add(self, key, value):
+        with metrics.rpc_timer('memcache', 'add'):
+            return memcache.add(key, value, time=self._ttl_seconds,
+                                namespace=self._namespace)
+
+    def cas(self, key, value, token):
+        with metrics.rpc_timer('memcache', 'cas'):
+            return token.cas(key, value, time=self._ttl_seconds,
+                             namespace=self._namespace)
+
+    def delete(self, key):
+        with metrics.rpc_timer('memcache', 'delete'):
+            memcache.delete(key, namespace=self._namespace)
+
+
+class CachingStatusStore(status_store.StatusStore):
+    """Wraps a StatusStore with a cache of each shout's current status.
+
+    The cache must look like LruCache.
+    """
+
+    # Give up on updating an entry after this many tries, and delete it.
+    MAX_CAS_ATTEMPTS = 5
+
+    def __init__(self, store, cache):
+        self._store = store
+        self._cache = cache
+
+    def put_multi_async(self, records):
+        futures = self._store.put_multi_async(records)
+        return [_CachingFuture(future, self, record)
+                for future, record in zip(futures, records)]
+
+    def get_current(self, combined_shout_id):
+        value, token = self._cache.gets(combined_shout_id)
+        if value:
+            metrics.STATUS_CACHE_LOOKUPS.inc(result='hit')
+            return _to_record(combined_shout_id, value)
+        metrics.STATUS_CACHE_LOOKUPS.inc(result='miss')
+        record = self._store.get_current(combined_shout_id)
+        if record:
+            self._cache.add(combined_shout_id, _to_value(record))
+        return record
+
+    def get_current_multi(self, combined_shout_ids):
+        keys = list(combined_shout_ids)
+        current = dict((key, _to_record(key, value)) for key, value
+                       in self._cache.get_multi(keys).iteritems())
+        misses = [key for key in keys if key not in current]
+        metrics.STATUS_CACHE_LOOKUPS.inc(len(current), result='hit')
+        metrics.STATUS_CACHE_LOOKUPS.inc(len(misses), result='miss')
+        if misses:
+            for key, record in self._store.get_current_multi(
+                    misses).iteritems():
+                if record:
+                    self._cache.add(key, _to_value(record))
+                current[key] = record
+        return current
+
+    def get_submitted(self, combined_shout_id):
+        return self._store.get_submitted(combined_shout_id)
+
+    def purge(self, too_old, cursor=None, time_budget_seconds=None):
+        return self._store.purge(too_old, cursor, time_budget_seconds)
+
+    def update_cache(self, record):
+        """Puts record in the cache, unless the cache holds a higher priority
+        status for the same shout.  Call after record was stored.
+        """
+        key = record.combined_shout_id
+        value = _to_value(record)
+        if value[4] is None:
+            # Datastore sets the timestamp on its own copy of the record.
+            value = value[:4] + (datetime.datetime.utcnow(),)
+        # A new shout has nothing better in the store.
+        checked_store = value[0] == status_store.STATUSES[0]
+        for i in range(self.MAX_CAS_ATTEMPTS):
+            cached, token = self._cache.gets(key)
+            if cached is None:
+                if not checked_store:
+                    # The entry expired or was evicted, and the store may
+                    # hold something better than record.
+                    checked_store = True
+                    current = self._store.get_current(key)
+                    if current and current.status > value[0]:
+                        value = _to_value(current)
+                if self._cache.add(key, value):
+                    return
+            elif cached[0] > value[0] or self._cache.cas(key, value, token):
+                return
+        # Maybe memcache is down.  Don't leave a stale entry behind.
+        self._cache.delete(key)
+
+
+class _CachingFuture(object):
+    """Updates the cache once a write to the store finishes."""
+
+    def __init__(self, future, store, record):
+        self._future = future
+        self._store = store
+        self._record = record
+        self._cached = False
+
+    def get_result(self):
+        result = self._future.get_result()
+        if not self._cached:
+            self._cached = True
+            self._store.update_cache(self._record)
+        return result
+
+
+def _to_value(record):
+    """Returns what we keep in the cache for a StatusRecord or entity."""
+    return (record.status, record.error, record.result, record.host,
+            record.timestamp)
+
+
+def _to_record(combined_shout_id, value):
+    status, error, result, host, timestamp = value
+    return status_store.StatusRecord(combined_shout_id, status, error, result,
+                                     host, timestamp)
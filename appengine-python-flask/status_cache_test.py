@@ -0,0 +1,189 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Needs the App Engine SDK on PYTHONPATH, for memcache."""
+import unittest
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext import testbed
+    import status_cache
+    import status_store
+except ImportError:
+    testbed = None
+
+
+def record(shout_id, status, result=None):
+    return status_store.StatusRecord(
+        shout_id, status_store.STATUS_MAP[status], result=result)
+
+
+class CountingStore(status_store.MemoryStatusStore):
+    """Counts the lookups that reach the store."""
+
+    def __init__(self):
+        super(CountingStore, self).__init__()
+        self.lookups = 0
+
+    def get_current(self, combined_shout_id):
+        self.lookups += 1
+        return super(CountingStore, self).get_current(combined_shout_id)
+
+    def get_current_multi(self, combined_shout_ids):
+        self.lookups += 1
+        return super(CountingStore, self).get_current_multi(
+            combined_shout_ids)
+
+    def purge(self, too_old, cursor=None, time_budget_seconds=None):
+        self.purged = (too_old, cursor, time_budget_seconds)
+        return 2, 'next'
+
+
+@unittest.skipIf(testbed is None, 'needs the App Engine SDK on PYTHONPATH')
+class LruCacheTest(unittest.TestCase):
+    def test_cas(self):
+        cache = status_cache.LruCache()
+        self.assertEqual((None, None), cache.gets('a'))
+        self.assertTrue(cache.add('a', 1))
+        self.assertFalse(cache.add('a', 2))
+        value, token = cache.gets('a')
+        self.assertEqual(1, value)
+        self.assertTrue(cache.cas('a', 3, token))
+        # The token went stale when 'a' changed.
+        self.assertFalse(cache.cas('a', 4, token))
+        self.assertEqual({'a': 3}, cache.get_multi(['a', 'b']))
+
+    def test_forgets_least_recently_used(self):
+        cache = status_cache.LruCache(max_entries=2)
+        cache.add('a', 1)
+        cache.add('b', 2)
+        cache.gets('a')
+        cache.add('c', 3)
+        self.assertEqual({'a': 1, 'c': 3}, cache.get_multi('abc'))
+
+    def test_expires(self):
+        cache = status_cache.LruCache(ttl_seconds=-1)
+        cache.add('a', 1)
+        self.assertEqual((None, None), cache.gets('a'))
+
+
+class RacingCache(status_cache.LruCache):
+    """Lets another writer sneak in between gets() and cas(), the first
+    races times.
+    """
+
+    def __init__(self, races):
+        super(RacingCache, self).__init__()
+        self.races = races
+        self.cas_calls = 0
+
+    def cas(self, key, value, token):
+        self.cas_calls += 1
+        if self.races:
+            self.races -= 1
+            other = status_cache._to_value(record(key, 'shouting'))
+            super(RacingCache, self).cas(key, other, token)
+        return super(RacingCache, self).cas(key, value, token)
+
+
+@unittest.skipIf(testbed is None, 'needs the App Engine SDK on PYTHONPATH')
+class CachingStatusStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = CountingStore()
+
+    def caching_store(self, cache=None):
+        return status_cache.CachingStatusStore(
+            self.store, cache or status_cache.LruCache())
+
+    def test_answers_from_the_cache(self):
+        store = self.caching_store()
+        store.put_async(record('a', 'new')).get_result()
+        self.assertEqual('new', store.get_current('a').status_name)
+        self.assertEqual('new',
+                         store.get_current_multi(['a'])['a'].status_name)
+        self.assertEqual(0, self.store.lookups)
+        self.assertIsNone(store.get_current('b'))
+        self.assertEqual(1, self.store.lookups)
+
+    def test_fills_the_cache_on_a_miss(self):
+        self.store.put_async(record('a', 'shouting')).get_result()
+        store = self.caching_store()
+        self.assertEqual({'a': 'shouting', 'b': None}, dict(
+            (key, value and value.status_name) for key, value
+            in store.get_current_multi(['a', 'b']).iteritems()))
+        store.get_current('a')
+        self.assertEqual(1, self.store.lookups)
+
+    def test_never_replaces_a_higher_priority(self):
+        store = self.caching_store()
+        store.put_async(record('a', 'success', 'A')).get_result()
+        store.put_async(record('a', 'shouting')).get_result()
+        self.assertEqual('A', store.get_current('a').result)
+
+    def test_checks_the_store_when_the_entry_is_gone(self):
+        self.store.put_async(record('a', 'success', 'A')).get_result()
+        store = self.caching_store()
+        # Written by a worker that doesn't know about success yet.
+        store.put_async(record('a', 'shouting')).get_result()
+        self.assertEqual('A', store.get_current('a').result)
+
+    def test_retries_a_lost_race(self):
+        cache = RacingCache(races=2)
+        store = self.caching_store(cache)
+        store.put_async(record('a', 'new')).get_result()
+        store.put_async(record('a', 'success', 'A')).get_result()
+        self.assertEqual(3, cache.cas_calls)
+        self.assertEqual('A', store.get_current('a').result)
+
+    def test_deletes_the_entry_after_too_many_races(self):
+        cache = RacingCache(races=100)
+        store = self.caching_store(cache)
+        store.put_async(record('a', 'new')).get_result()
+        store.put_async(record('a', 'success', 'A')).get_result()
+        self.assertEqual(store.MAX_CAS_ATTEMPTS, cache.cas_calls)
+        self.assertEqual((None, None), cache.gets('a'))
+        # The next lookup reads the store.
+        self.assertEqual('A', store.get_current('a').result)
+
+    def test_purge_continues_with_the_store_cursor(self):
+        store = self.caching_store()
+        self.assertEqual((2, 'next'), store.purge('too old', 'cursor', 60))
+        self.assertEqual(('too old', 'cursor', 60), self.store.purged)
+
+
+@unittest.skipIf(testbed is None, 'needs the App Engine SDK on PYTHONPATH')
+class MemcacheCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.bed = testbed.Testbed()
+        self.bed.activate()
+        self.bed.init_memcache_stub()
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def test_cas(self):
+        cache = status_cache.MemcacheCache()
+        self.assertTrue(cache.add('a', 1))
+        value, token = cache.gets('a')
+        _, other_token = cache.gets('a')
+        self.assertTrue(cache.cas('a', 2, other_token))
+        self.assertFalse(cache.cas('a', 3, token))
+        self.assertEqual({'a': 2}, cache.get_multi(['a']))
+        cache.delete('a')
+        self.assertIsNone(cache.gets('a')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Storage for the status log of shout requests.
+
+main.py talks to a StatusStore instead of datastore, so the request path can
+be run and measured on one machine without App Engine.  The datastore
+implementation, NdbStatusStore, lives in main.py next to the ShoutStatusLog
+model.  This module holds the interface and the local implementations, and
+imports nothing from App Engine.
+"""
+import datetime
+import heapq
+import itertools
+import threading
+
+# Note how the status codes (a, b, c, d, e) rank the statuses by priority.
+STATUSES = ('a-new', 'b-shouting', 'c-error', 'd-fatal', 'e-success')
+STATUS_MAP = dict((status.split('-')[1], status) for status in STATUSES)
+
+
+class StatusRecord(object):
+    """One entry in the status log.  Has the same attributes as
+    main.ShoutStatusLog.
+    """
+
+    def __init__(self, combined_shout_id, status, error=None, result=None,
+                 host=None, timestamp=None):
+        self.combined_shout_id = combined_shout_id
+        self.status = status
+        self.error = error
+        self.result = result
+        self.host = host
+        self.timestamp = timestamp
+
+    @property
+    def status_name(self):
+        """Strips the status code and returns the status name."""
+        return self.status.split('-')[1] if self.status else ''
+
+
+class DoneFuture(object):
+    """A future whose result is already known.  Looks like an ndb.Future."""
+
+    def __init__(self, result=None):
+        self._result = result
+
+    def get_result(self):
+        return self._result
+
+
+class StatusStore(object):
+    """The status log of shout requests.  Implementations are thread-safe."""
+
+    def put_async(self, record):
+        """Appends a StatusRecord to the log.
+
+        Returns:
+          A future.  Call get_result() to wait for the write.
+        """
+        return self.put_multi_async([record])[0]
+
+    def put_multi_async(self, records):
+        """Appends StatusRecords to the log.  Returns a list of futures."""
+        raise NotImplementedError()
+
+    def get_current(self, combined_shout_id):
+        """Returns the highest priority StatusRecord for a shout, or None."""
+        raise NotImplementedError()
+
+    def get_current_multi(self, combined_shout_ids):
+        """Looks up the current status of many shouts at once.
+
+        Returns:
+          A dict mapping each combined shout id to its highest priority
+          StatusRecord, or None.
+        """
+        return dict((combined_shout_id, self.get_current(combined_shout_id))
+                    for combined_shout_id in combined_shout_ids)
+
+    def get_submitted(self, combined_shout_id):
+        """Returns when a shout's new status was written, as a UTC
+        datetime.datetime, or None if the log doesn't have one.
+        """
+        raise NotImplementedError()
+
+    def purge(self, too_old, cursor=None, time_budget_seconds=None):
+        """Removes records written before too_old.
+
+        Args:
+          too_old: datetime.datetime, in UTC.
+          cursor: string, returned by an earlier call that ran out of time.
+          time_budget_seconds: float, stop after about this long.
+        Returns:
+          A tuple of (number of records removed, cursor).  cursor is None
+          when there's nothing left to purge.
+        """
+        raise NotImplementedError()
+
+
+class MemoryStatusStore(StatusStore):
+    """Keeps the status log in memory, in a heap per shout."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heaps = {}
+        # Breaks ties between equal statuses in favor of the latest.
+        self._counter = itertools.count()
+        self._rank = dict((status, i) for i, status in enumerate(STATUSES))
+
+    def put_multi_async(self, records):
+        futures = []
+        with self._lock:
+            for record in records:
+                if record.timestamp is None:
+                    record.timestamp = datetime.datetime.utcnow()
+                heap = self._heaps.setdefault(record.combined_shout_id, [])
+                heapq.heappush(heap, (-self._rank[record.status],
+                                      -next(self._counter), record))
+                futures.append(DoneFuture())
+        return futures
+
+    def get_current(self, combined_shout_id):
+        with self._lock:
+            heap = self._heaps.get(combined_shout_id)
+            return heap[0][2] if heap else None
+
+    def get_current_multi(self, combined_shout_ids):
+        with self._lock:
+            return dict((combined_shout_id,
+                         self._heaps[combined_shout_id][0][2]
+                         if self._heaps.get(combined_shout_id) else None)
+                        for combined_shout_id in combined_shout_ids)
+
+    def get_submitted(self, combined_shout_id):
+        with self._lock:
+            times = [entry[2].timestamp
+                     for entry in self._heaps.get(combined_shout_id, ())
+                     if entry[2].status == STATUSES[0]]
+        return min(times) if times else None
+
+    def purge(self, too_old, cursor=None, time_budget_seconds=None):
+        deleted = 0
+        with self._lock:
+            for combined_shout_id, heap in self._heaps.items():
+                keep = [entry for entry in heap
+                        if entry[2].timestamp >= too_old]
+                deleted += len(heap) - len(keep)
+                if keep:
+                    heapq.heapify(keep)
+                    self._heaps[combined_shout_id] = keep
+                else:
+                    del self._heaps[combined_shout_id]
+        return deleted, None
+
+
+class SqliteStatusStore(StatusStore):
+    """Keeps the status log in a SQLite database.
+
+    Indexed on (shout_id, status DESC), like the datastore index in
+    index.yaml.
+    """
+
+    def __init__(self, path=':memory:'):
+        # App Engine doesn't have sqlite3, so only import it when needed.
+        import sqlite3
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   detect_types=sqlite3.PARSE_DECLTYPES)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS status_log ('
+            'shout_id TEXT NOT NULL, status TEXT, timestamp TIMESTAMP, '
+            'error TEXT, result TEXT, host TEXT)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS status_log_shout_id_status '
+            'ON status_log (shout_id, status DESC)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS status_log_timestamp '
+            'ON status_log (timestamp)')
+        self._db.commit()
+
+    def put_multi_async(self, records):
+        with self._lock:
+            for record in records:
+                if record.timestamp is None:
+                    record.timestamp = datetime.datetime.utcnow()
+            self._db.executemany(
+                'INSERT INTO status_log VALUES (?, ?, ?, ?, ?, ?)',
+                [(r.combined_shout_id, r.status, r.timestamp, r.error,
+                  r.result, r.host) for r in records])
+            self._db.commit()
+        return [DoneFuture() for record in records]
+
+    def get_current(self, combined_shout_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT shout_id, status, error, result, host, timestamp '
+                'FROM status_log WHERE shout_id = ? '
+                'ORDER BY status DESC, rowid DESC LIMIT 1',
+                (combined_shout_id,)).fetchone()
+        return StatusRecord(*row) if row else None
+
+    def get_current_multi(self, combined_shout_ids):
+        combined_shout_ids = list(combined_shout_ids)
+        current = dict.fromkeys(combined_shout_ids)
+        if not combined_shout_ids:
+            return current
+        # Rows come back best first, so keep the first row for each shout.
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT shout_id, status, error, result, host, timestamp '
+                'FROM status_log WHERE shout_id IN (%s) '
+                'ORDER BY shout_id, status DESC, rowid DESC' %
+                ','.join('?' * len(combined_shout_ids)),
+                combined_shout_ids).fetchall()
+        for row in rows:
+            if current[row[0]] is None:
+                current[row[0]] = StatusRecord(*row)
+        return current
+
+    def get_submitted(self, combined_shout_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT timestamp FROM status_log '
+                'WHERE shout_id = ? AND status = ? '
+                'ORDER BY timestamp LIMIT 1',
+                (combined_shout_id, STATUSES[0])).fetchone()
+        return row[0] if row else None
+
+    def purge(self, too_old, cursor=None, time_budget_seconds=None):
+        with self._lock:
+            deleted = self._db.execute(
+                'DELETE FROM status_log WHERE timestamp < ?',
+                (too_old,)).rowcount
+            self._db.commit()
+        return deleted, None
@@ -0,0 +1,94 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+import status_store
+
+STATUS_MAP = status_store.STATUS_MAP
+
+
+def record(shout_id, status, result=None, timestamp=None):
+    return status_store.StatusRecord(shout_id, STATUS_MAP[status],
+                                     result=result, timestamp=timestamp)
+
+
+class MemoryStatusStoreTest(unittest.TestCase):
+    def new_store(self):
+        return status_store.MemoryStatusStore()
+
+    def setUp(self):
+        self.store = self.new_store()
+
+    def test_highest_priority_wins(self):
+        for status in ('new', 'success', 'shouting', 'error'):
+            self.store.put_async(record('a', status, status)).get_result()
+        current = self.store.get_current('a')
+        self.assertEqual('success', current.status_name)
+        self.assertIsNotNone(current.timestamp)
+        self.assertIsNone(self.store.get_current('b'))
+
+    def test_latest_of_equal_statuses_wins(self):
+        futures = self.store.put_multi_async(
+            [record('a', 'shouting', 'first'),
+             record('a', 'shouting', 'second')])
+        for future in futures:
+            future.get_result()
+        self.assertEqual('second', self.store.get_current('a').result)
+
+    def test_get_current_multi(self):
+        self.store.put_multi_async([record('a', 'new'),
+                                    record('b', 'shouting')])
+        current = self.store.get_current_multi(['a', 'b', 'c'])
+        self.assertEqual(('new', 'shouting', None), (
+            current['a'].status_name, current['b'].status_name,
+            current['c']))
+        self.assertEqual({}, self.store.get_current_multi([]))
+
+    def test_get_submitted(self):
+        now = datetime.datetime.utcnow()
+        later = now + datetime.timedelta(seconds=5)
+        self.store.put_multi_async([
+            record('a', 'shouting', timestamp=later),
+            record('a', 'new', timestamp=now),
+            record('a', 'new', timestamp=later),
+            record('b', 'success', 'B', timestamp=later),
+        ])
+        self.assertEqual(now, self.store.get_submitted('a'))
+        self.assertIsNone(self.store.get_submitted('b'))
+        self.assertIsNone(self.store.get_submitted('c'))
+
+    def test_purge(self):
+        now = datetime.datetime.utcnow()
+        old = now - datetime.timedelta(days=2)
+        self.store.put_multi_async([
+            record('a', 'new', timestamp=old),
+            record('a', 'success', 'A', timestamp=now),
+            record('b', 'new', timestamp=old),
+        ])
+        self.assertEqual(
+            (2, None),
+            self.store.purge(now - datetime.timedelta(days=1)))
+        self.assertEqual('A', self.store.get_current('a').result)
+        self.assertIsNone(self.store.get_current('b'))
+
+
+class SqliteStatusStoreTest(MemoryStatusStoreTest):
+    def new_store(self):
+        return status_store.SqliteStatusStore()
+
+
+if __name__ == '__main__':
+    unittest.main()
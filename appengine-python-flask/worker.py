@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A shout worker in pure python, for running on Linux.
+
+Does the same job as the C# ShoutLib.Shouter: pulls shout request messages
+from the subscription, shouts the text, and posts the status back to
+App Engine.  Unlike Shouter, it keeps many messages in flight at once.  The
+work is split into stages connected by queues:
+
+  pull threads:  a pubsub.MessageStream that keeps several pulls of up to
+                 max_messages in flight, while fewer than max_outstanding
+                 messages are in progress.
+  shout threads:  a fixed pool that shouts each message and posts its status.
+                  With several subscriptions, a FairQueue decides which
+                  subscription's message to shout next.
+  status thread:  posts statuses back to App Engine in batches.
+  ack thread:  a pubsub.AckManager that acknowledges finished messages in
+               batches, and extends the ack deadline of messages still in
+               progress.
+
+Usage:
+  python worker.py --project YOUR-PROJECT-ID
+"""
+import argparse
+import collections
+import json
+import logging
+import math
+import Queue
+import random
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+import lanes
+import pubsub
+import shards
+
+SUBSCRIPTION = shards.SUBSCRIPTION
+
+
+class FatalError(Exception):
+    """The shout request can never succeed.  Don't retry it."""
+    pass
+
+
+class ShoutError(Exception):
+    """The shout request failed this time.  It may succeed if retried."""
+    pass
+
+
+class Stopped(Exception):
+    """The worker is stopping.  Another worker should take the request."""
+    pass
+
+
+def shout_string(text, throw_if_aborted, rand=random):
+    """Converts text to uppercase, taking an extra long time.
+
+    Behaves like ShoutLib.Shouter.ShoutString(), including its simulated
+    errors, so the two workers can serve the same app.
+    """
+    upper_text = text.upper()
+    # Pretend like we're working hard.  Time is a function of the number of
+    # letters in the word.
+    work_deadline = time.time() + shout_seconds(len(upper_text))
+    while work_deadline > time.time():
+        throw_if_aborted()
+        time.sleep(min(1, work_deadline - time.time()))
+    if 'CHICKEN' in upper_text:
+        raise FatalError('Oh no!  Not chickens!')
+    if 'CORN' in upper_text and rand.randint(0, 2) > 0:
+        raise ShoutError("I don't like corn flakes.")
+    if 'COW' in upper_text:
+        raise ShoutError('Mooooooo.')
+    return upper_text
+
+
+def shout_seconds(length):
+    """Returns how long shout_string() works on a text of length length."""
+    return length * int(math.log(length)) if length else 0
+
+
+def post_status(attributes, status, result=None):
+    """Posts a status back to App Engine, like Shouter.PublishStatus()."""
+    form = {
+        'status': status,
+        'token': attributes['postStatusToken'],
+        'host': socket.gethostname(),
+    }
+    if result is not None:
+        form['result'] = result.encode('utf-8')
+    response = urllib2.urlopen(attributes['postStatusUrl'],
+                               urllib.urlencode(form), timeout=30)
+    if response.getcode() != 200:
+        raise FatalError('Posting status returned %d.' % response.getcode())
+
+
+class StatusPoster(object):
+    """Posts statuses back to App Engine in batches.  Thread-safe.
+
+    Uses /post_shout_status_batch when the message names it, and falls back
+    to one /post_shout_status request per status otherwise.
+    """
+
+    def __init__(self, max_statuses=100, max_latency=0.1):
+        self._max_statuses = max_statuses
+        self._max_latency = max_latency
+        self._queue = Queue.Queue()
+        self._host = socket.gethostname()
+
+    def post(self, attributes, status, result=None, callback=None):
+        """Queues a status.  Calls callback(error) once it's posted.
+
+        error is None when the status was posted.
+        """
+        self._queue.put((attributes, status, result, callback))
+
+    def run(self, stop_event):
+        """Posts queued statuses until stop_event is set."""
+        while not stop_event.is_set() or not self._queue.empty():
+            try:
+                batch = [self._queue.get(timeout=0.5)]
+            except Queue.Empty:
+                continue
+            flush_time = time.time() + self._max_latency
+            while len(batch) < self._max_statuses:
+                remaining = flush_time - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+            self._send(batch)
+
+    def _send(self, batch):
+        groups = {}
+        for item in batch:
+            attributes = item[0]
+            key = (attributes.get('postStatusBatchUrl'),
+                   attributes['postStatusToken'])
+            groups.setdefault(key, []).append(item)
+        for (batch_url, token), items in groups.iteritems():
+            if batch_url:
+                self._send_batch(batch_url, token, items)
+            else:
+                for item in items:
+                    self._send_one(item)
+
+    def _send_batch(self, batch_url, token, items):
+        records = []
+        for attributes, status, result, callback in items:
+            query = urlparse.parse_qs(
+                urlparse.urlparse(attributes['postStatusUrl']).query)
+            record = {
+                'browserId': query['browserId'][0],
+                'shoutId': query['shoutId'][0],
+                'status': status,
+                'result': result,
+                'host': self._host,
+            }
+            for name in ('shard', 'lane', 'flightId'):
+                if name in query:
+                    record[name] = query[name][0]
+            records.append(record)
+        try:
+            response = urllib2.urlopen(batch_url, urllib.urlencode({
+                'token': token,
+                'statuses': json.dumps(records),
+            }), timeout=30)
+            results = json.load(response)['results']
+        except Exception as e:
+            logging.exception('Failed to post %d statuses.', len(items))
+            results = [{'error': str(e)}] * len(items)
+        if len(results) != len(items):
+            # Which result goes with which status is anyone's guess.
+            logging.error('Posted %d statuses, but got %d results.',
+                          len(items), len(results))
+            results = [{'error': 'No result for this status.'}] * len(items)
+        for item, result in zip(items, results):
+            self._done(item[3], result.get('error'))
+
+    def _send_one(self, item):
+        attributes, status, result, callback = item
+        try:
+            post_status(attributes, status, result)
+        except Exception as e:
+            logging.exception('Failed to post status.')
+            self._done(callback, str(e) or e.__class__.__name__)
+        else:
+            self._done(callback, None)
+
+    @staticmethod
+    def _done(callback, error):
+        if callback:
+            try:
+                callback(error)
+            except Exception:
+                logging.exception('Status callback failed.')
+
+
+class FairQueue(object):
+    """Several queues that hand out their items in proportion to weights.
+
+    Weighted fair queueing by cost: taking an item adds its cost divided by
+    its queue's weight to the queue's virtual time, and get() takes from the
+    nonempty queue with the smallest virtual time.  So a queue with weight 4
+    gets 4 times the shouting time of a queue with weight 1 while both have
+    work, and either gets all of it while the other is empty.  A queue that
+    was empty can't save up time to spend in a burst later.  Thread-safe.
+    """
+
+    def __init__(self, weights):
+        self._condition = threading.Condition()
+        self._weights = list(weights)
+        self._queues = [collections.deque() for weight in self._weights]
+        self._times = [0.0] * len(self._weights)
+        # The virtual time of the last item taken.
+        self._now = 0.0
+
+    def put(self, index, item, cost=1):
+        """Adds item, which takes about cost to process, to queue index."""
+        with self._condition:
+            queue = self._queues[index]
+            if not queue:
+                self._times[index] = max(self._times[index], self._now)
+            queue.append((item, cost))
+            self._condition.notify()
+
+    def get(self, timeout):
+        """Returns the next item.  Raises Queue.Empty if none arrives before
+        timeout seconds pass.
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                ready = [i for i, queue in enumerate(self._queues) if queue]
+                if ready:
+                    break
+                wait = deadline - time.time()
+                if wait <= 0:
+                    raise Queue.Empty()
+                self._condition.wait(wait)
+            index = min(ready, key=self._times.__getitem__)
+            item, cost = self._queues[index].popleft()
+            self._now = self._times[index]
+            self._times[index] += float(cost) / self._weights[index]
+            return item
+
+
+class Worker(object):
+    """Pulls, shouts and acknowledges shout request messages concurrently."""
+
+    def __init__(self, ps, subscription=SUBSCRIPTION, threads=8,
+                 max_messages=100, max_outstanding=None,
+                 ack_batch_size=1000, ack_latency=0.1,
+                 ack_deadline_seconds=15, shout=shout_string, weights=None):
+        """Creates a worker.
+
+        Args:
+          ps: the pubsub.PubSub to pull from.
+          subscription: string, the subscription to pull from, or a list of
+            subscriptions to pull from at once.
+          threads: int, how many messages to shout at once.
+          max_messages: int, most messages to pull with one request.
+          max_outstanding: int, most messages pulled but not yet finished,
+            per subscription.  Defaults to enough to keep every thread busy
+            while the next pull is in flight.
+          ack_batch_size: int, most ack ids to send with one request.
+          ack_latency: float, most seconds an ack waits to be sent.
+          ack_deadline_seconds: int, the subscription's ack deadline.
+          shout: the function that does the work.  See shout_string().
+          weights: list of ints, one per subscription.  While several
+            subscriptions have messages waiting, each gets shouting time in
+            proportion to its weight.  Defaults to equal weights.
+        """
+        self._pubsub = ps
+        if isinstance(subscription, basestring):
+            subscription = [subscription]
+        self._subscriptions = list(subscription)
+        self._threads = threads
+        self._max_messages = max_messages
+        self._max_outstanding = max_outstanding or threads + max_messages
+        self._shout = shout
+        self._stop = threading.Event()
+        self._work = FairQueue(weights or [1] * len(self._subscriptions))
+        self._acks = pubsub.AckManager(
+            ps, max_ids=ack_batch_size, max_latency=ack_latency,
+            ack_deadline_seconds=ack_deadline_seconds)
+        self._statuses = StatusPoster()
+
+    def run(self):
+        """Runs until stop() is called."""
+        self._acks.start()
+        streams = [self._pubsub.stream(
+            subscription, max_messages=self._max_messages,
+            max_outstanding_messages=self._max_outstanding,
+            ack_manager=self._acks) for subscription in self._subscriptions]
+        threads = [self._start(self._dispatch_loop, i, stream)
+                   for i, stream in enumerate(streams)]
+        threads.append(self._start(self._statuses.run, self._stop))
+        threads.extend(self._start(self._shout_loop)
+                       for i in range(self._threads))
+        try:
+            while not self._stop.is_set():
+                self._stop.wait(1)
+        finally:
+            self.stop()
+            for stream in streams:
+                stream.close()
+            for thread in threads:
+                thread.join()
+            # Hand back what no shout thread got to.
+            while True:
+                try:
+                    stream, message = self._work.get(timeout=0)
+                except Queue.Empty:
+                    break
+                stream.nack(message)
+            self._acks.stop()
+
+    def stop(self):
+        self._stop.set()
+
+    @staticmethod
+    def _start(target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _dispatch_loop(self, index, stream):
+        for message in stream:
+            cost = shout_seconds(len(message['message'].get('data') or ''))
+            self._work.put(index, (stream, message), max(1, cost))
+
+    def _shout_loop(self):
+        while not self._stop.is_set():
+            try:
+                stream, message = self._work.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            try:
+                self._process(stream, message)
+            except Exception:
+                logging.exception('Unexpected error while shouting.')
+                self._finish(stream, message, ack=False)
+
+    def _process(self, stream, message):
+        attributes = message['message'].get('attributes', {})
+        try:
+            attributes['postStatusUrl']
+            attributes['postStatusToken']
+            deadline = long(attributes['deadline'])
+        except (KeyError, ValueError):
+            logging.warning('Bad shout request message attributes.')
+            self._finish(stream, message, ack=True)
+            return
+        if 'payloadError' in message['message']:
+            # Pulling it again won't help.
+            self._finish(stream, message, ack=True)
+            self._statuses.post(attributes, 'fatal',
+                                message['message']['payloadError'])
+            return
+
+        def throw_if_aborted():
+            if self._stop.is_set():
+                raise Stopped()
+            if deadline < time.time():
+                raise FatalError('Request timed out.')
+
+        self._statuses.post(attributes, 'shouting')
+        try:
+            text = message['message']['data'].decode('utf-8')
+            result = self._shout(text, throw_if_aborted)
+        except FatalError as e:
+            logging.error('Fatal error while shouting: %s', e)
+            self._finish(stream, message, ack=True)
+            self._statuses.post(attributes, 'fatal', str(e))
+        except Stopped:
+            # Not the shout's fault, so don't report an error.  Let another
+            # worker have it right away.
+            stream.nack(message)
+        except Exception as e:
+            # Leave the message in the subscription so it's retried.
+            logging.error('Error while shouting: %s', e)
+            self._statuses.post(attributes, 'error', str(e))
+            self._finish(stream, message, ack=False)
+        else:
+            # Only acknowledge once the browser can see the result.
+            self._statuses.post(
+                attributes, 'success', result,
+                lambda error: self._finish(stream, message, ack=error is None))
+
+    @staticmethod
+    def _finish(stream, message, ack):
+        """Stops extending the lease, and acks the message if ack is True.
+
+        Otherwise, pubsub redelivers the message when its deadline passes.
+        """
+        if ack:
+            stream.ack(message)
+        else:
+            stream.release(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--project', required=True,
+                        help='The Google Cloud project id.')
+    parser.add_argument('--subscription', default=SUBSCRIPTION)
+    parser.add_argument('--shards', default='0',
+                        help='The shards to pull from, like 0,2-4.  Shard 0 '
+                        'is --subscription itself.')
+    parser.add_argument('--lanes', default='',
+                        help='The lanes to pull from, weighted, like '
+                        'short:1000:30:4,long::90:1.  The same as the app\'s '
+                        'SHOUT_LANES.  See lanes.py.')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='How many messages to shout at once.')
+    parser.add_argument('--max-messages', type=int, default=100,
+                        help='Most messages to pull with one request.')
+    parser.add_argument('--blob-dir',
+                        help='Where the app stores shout texts too big to '
+                        'send inline.  Its SHOUT_BLOB_DIR.  Only when the '
+                        'app runs on this machine.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    codec = None
+    if args.blob_dir:
+        codec = pubsub.PayloadCodec(
+            blob_store=pubsub.FileBlobStore(args.blob_dir))
+    subscriptions = []
+    weights = []
+    all_lanes = lanes.parse_lanes(args.lanes)
+    for lane in all_lanes:
+        for shard in shards.parse_shards(args.shards):
+            subscriptions.append(lanes.subscription_name(
+                all_lanes, lane, shard, args.subscription))
+            weights.append(lane.weight)
+    worker = Worker(pubsub.PubSub(args.project, codec), subscriptions,
+                    threads=args.threads, max_messages=args.max_messages,
+                    weights=weights)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import Queue
+import StringIO
+import unittest
+import urllib2
+
+import worker
+
+
+class FairQueueTest(unittest.TestCase):
+    def test_shares_by_weight(self):
+        queue = worker.FairQueue([4, 1])
+        for i in range(100):
+            queue.put(0, 'short')
+            queue.put(1, 'long')
+        taken = [queue.get(0) for i in range(50)]
+        self.assertEqual(40, taken.count('short'))
+        self.assertEqual(10, taken.count('long'))
+
+    def test_shares_by_cost(self):
+        queue = worker.FairQueue([1, 1])
+        for i in range(100):
+            queue.put(0, 'short', cost=1)
+            queue.put(1, 'long', cost=10)
+        taken = [queue.get(0) for i in range(55)]
+        self.assertEqual(50, taken.count('short'))
+        self.assertEqual(5, taken.count('long'))
+
+    def test_idle_queue_saves_nothing(self):
+        queue = worker.FairQueue([1, 1])
+        for i in range(20):
+            queue.put(0, 'a')
+        for i in range(20):
+            queue.get(0)
+        for i in range(10):
+            queue.put(0, 'a')
+            queue.put(1, 'b')
+        # b was idle while a worked, but doesn't get to catch up.
+        taken = [queue.get(0) for i in range(10)]
+        for i in range(0, 10, 2):
+            self.assertEqual(['a', 'b'], sorted(taken[i:i + 2]))
+
+    def test_get_times_out(self):
+        queue = worker.FairQueue([1])
+        self.assertRaises(Queue.Empty, queue.get, 0.01)
+
+
+class FakeStream(object):
+    def __init__(self):
+        self.finished = []
+
+    def ack(self, message):
+        self.finished.append('ack')
+
+    def nack(self, message):
+        self.finished.append('nack')
+
+    def release(self, message):
+        self.finished.append('release')
+
+
+def shout_message(text='hello'):
+    url = 'http://app/post_shout_status?browserId=b&shoutId=%s' % text
+    return {'ackId': text, 'message': {'data': text, 'attributes': {
+        'postStatusUrl': url,
+        'postStatusBatchUrl': 'http://app/post_shout_status_batch',
+        'postStatusToken': 'token',
+        'deadline': '9999999999',
+    }}}
+
+
+class StatusPosterTest(unittest.TestCase):
+    def setUp(self):
+        self.real_urlopen = urllib2.urlopen
+        self.results = []
+        urllib2.urlopen = lambda url, data, timeout: StringIO.StringIO(
+            json.dumps({'results': self.results}))
+
+    def tearDown(self):
+        urllib2.urlopen = self.real_urlopen
+
+    def post(self, texts):
+        """Posts a batch of statuses, and returns the error of each."""
+        errors = {}
+        poster = worker.StatusPoster()
+        batch = []
+        for text in texts:
+            callback = lambda error, text=text: errors.update({text: error})
+            batch.append((shout_message(text)['message']['attributes'],
+                          'success', text.upper(), callback))
+        poster._send(batch)
+        return [errors[text] for text in texts]
+
+    def test_matches_results(self):
+        self.results = [{}, {'error': 'Nope.'}]
+        self.assertEqual([None, 'Nope.'], self.post(['a', 'b']))
+
+    def test_too_few_results(self):
+        self.results = [{}]
+        errors = self.post(['a', 'b'])
+        self.assertTrue(all(errors), errors)
+
+
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.worker = worker.Worker(None)
+        self.posted = []
+        self.worker._statuses.post = (
+            lambda attributes, status, result=None, callback=None:
+            self.posted.append(status))
+
+    def test_stopping_hands_back_the_shout(self):
+        def shout(text, throw_if_aborted):
+            self.worker.stop()
+            throw_if_aborted()
+        self.worker._shout = shout
+        stream = FakeStream()
+        self.worker._process(stream, shout_message())
+        self.assertEqual(['nack'], stream.finished)
+        self.assertEqual(['shouting'], self.posted)
+
+    def test_retryable_error(self):
+        def shout(text, throw_if_aborted):
+            raise worker.ShoutError('Mooooooo.')
+        self.worker._shout = shout
+        stream = FakeStream()
+        self.worker._process(stream, shout_message())
+        self.assertEqual(['release'], stream.finished)
+        self.assertEqual(['shouting', 'error'], self.posted)
+
+
+if __name__ == '__main__':
+    unittest.main()
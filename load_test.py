@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Load tests the JSON API with many simulated browsers at once.
+
+Each browser is an api_test.BrowserState running on its own thread: it
+connects, then shouts one word after another, following nextLinks until
+each shout finishes, and retryLinks when the app is too busy to take it.
+Reports, as JSON:
+  - throughput, in finished shouts per second,
+  - p50/p95/p99 time from submitting a shout to seeing its result,
+  - how many long-poll round trips each shout took, and
+  - how many times each shout was turned away and tried again.
+
+Runs against a deployed app with --host, or against main.py served on this
+machine with --local.  --local keeps the status log in memory, emulates
+Pub/Sub with pubsub_emulator, and runs worker.Worker in the same process,
+with a shout that takes --work-seconds.  The result cache is off unless
+--result-cache says otherwise, because there are only a few words to shout,
+and remembered results would leave the workers idle.  The App Engine SDK
+and the app's lib directory must be on PYTHONPATH for --local.
+
+Usage:
+  python load_test.py --host https://1-dot-your-project-id.appspot.com \\
+      --browsers 100 --shouts 10
+  SDK=/path/to/google_appengine
+  PYTHONPATH=$PYTHONPATH:$SDK:appengine-python-flask/lib python load_test.py \\
+      --local --browsers 1000 --shouts 5 --output load.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import api_test
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'appengine-python-flask')
+WORDS = ('hello', 'jeff', 'cow', 'corn', 'chicken', 'pubsub', 'engine')
+
+
+class ShoutResult(object):
+    """What happened to one shout."""
+
+    def __init__(self, seconds, round_trips, status, error=None, retries=0):
+        self.seconds = seconds
+        self.round_trips = round_trips
+        self.retries = retries
+        self.status = status
+        self.error = error
+
+
+def simulated_shout(work_seconds):
+    """Returns a shout function for worker.Worker that takes work_seconds.
+
+    Fails on chickens, like worker.shout_string(), but never at random.
+    """
+    import worker
+
+    def shout(text, throw_if_aborted):
+        deadline = time.time() + work_seconds
+        while deadline > time.time():
+            throw_if_aborted()
+            time.sleep(min(1, deadline - time.time()))
+        if 'CHICKEN' in text.upper():
+            raise worker.FatalError('Oh no!  Not chickens!')
+        return text.upper()
+    return shout
+
+
+def serve_locally(workers, work_seconds, result_cache='none'):
+    """Serves main.py on a free local port, with the status log in memory and
+    Pub/Sub emulated, and runs a worker.Worker in this process.
+
+    Args:
+      result_cache: string, what main.py's SHOUT_RESULT_CACHE says.
+
+    Returns:
+      The url of the server.
+    """
+    os.environ['SHOUT_STATUS_STORE'] = 'memory'
+    os.environ['SHOUT_NOTIFY_BACKEND'] = 'local'
+    os.environ['SHOUT_PUBSUB'] = 'local'
+    os.environ['SHOUT_STATUS_CACHE'] = 'local'
+    os.environ['SHOUT_RESULT_CACHE'] = result_cache
+    sys.path.insert(0, APP_DIR)
+    import dev_appserver
+    # Puts the libraries bundled with the SDK, like yaml, on sys.path.
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(overwrite=True, app_id='load-test',
+                  CURRENT_VERSION_ID='load-test.1')
+    bed.init_app_identity_stub()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_modules_stub()
+    bed.init_taskqueue_stub()
+    import main
+    import werkzeug.serving
+    import worker
+    main.app.config['DEBUG'] = False
+    main.purse.init(main.new_random_id())
+    ps = main.new_pubsub()
+    ps.create_topic(main.TOPIC)
+    ps.subscribe(main.TOPIC, main.SUBSCRIPTION)
+    shouter = worker.Worker(ps, main.SUBSCRIPTION, threads=workers,
+                            shout=simulated_shout(work_seconds))
+    thread = threading.Thread(target=shouter.run)
+    thread.daemon = True
+    thread.start()
+    server = werkzeug.serving.make_server('127.0.0.1', 0, main.app,
+                                          threaded=True)
+    # The default backlog is too short for a thousand browsers connecting
+    # at once.
+    server.socket.listen(1024)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d' % server.server_port
+
+
+def run_browser(host, shouts, words, results, rand):
+    """Runs one simulated browser.  Appends a ShoutResult per shout to
+    results.
+    """
+    try:
+        state = api_test.BrowserState(host, verbose=False)
+    except Exception as e:
+        results.append(ShoutResult(0, 0, 'connect-failed', str(e)))
+        return
+    with state:
+        for i in range(shouts):
+            start = time.time()
+            try:
+                state.shout(rand.choice(words))
+                status, error = 'success', None
+            except api_test.Failure as e:
+                status, error = e.status, None
+            except Exception as e:
+                status, error = 'http-error', str(e)
+            results.append(ShoutResult(time.time() - start,
+                                       state.round_trips, status, error,
+                                       state.retries))
+
+
+def percentile(values, fraction):
+    """Returns the value that fraction of sorted values are at or below."""
+    if not values:
+        return None
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def summarize(results, elapsed, browsers):
+    seconds = sorted(r.seconds for r in results
+                     if r.status in ('success', 'fatal'))
+    round_trips = [r.round_trips for r in results]
+    retries = [r.retries for r in results]
+    statuses = {}
+    for result in results:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+    errors = sorted(set(r.error for r in results if r.error))
+    return {
+        'browsers': browsers,
+        'shouts': len(results),
+        'elapsed_seconds': elapsed,
+        'shouts_per_second': len(results) / elapsed if elapsed else 0,
+        'statuses': statuses,
+        'time_to_result_seconds': {
+            'p50': percentile(seconds, 0.50),
+            'p95': percentile(seconds, 0.95),
+            'p99': percentile(seconds, 0.99),
+            'max': seconds[-1] if seconds else None,
+        },
+        'round_trips_per_shout': {
+            'mean': (float(sum(round_trips)) / len(round_trips)
+                     if round_trips else None),
+            'max': max(round_trips) if round_trips else None,
+        },
+        'retries_per_shout': {
+            'mean': (float(sum(retries)) / len(retries)
+                     if retries else None),
+            'max': max(retries) if retries else None,
+        },
+        # A few examples are enough to see what went wrong.
+        'errors': errors[:10],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load tests the JSON API with many simulated browsers.')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--host', help='The deployed app, like '
+                        'https://1-dot-your-project-id.appspot.com')
+    target.add_argument('--local', action='store_true',
+                        help='Serve main.py and run a worker locally, with '
+                        'the status log in memory and Pub/Sub emulated.')
+    parser.add_argument('--browsers', type=int, default=100,
+                        help='How many browsers shout at once.')
+    parser.add_argument('--shouts', type=int, default=5,
+                        help='How many shouts each browser sends, one after '
+                        'another.')
+    parser.add_argument('--words', default=','.join(WORDS),
+                        help='Comma separated words to shout, chosen at '
+                        'random.')
+    parser.add_argument('--workers', type=int, default=64,
+                        help='With --local, how many shouts the worker works '
+                        'on at once.')
+    parser.add_argument('--work-seconds', type=float, default=0.5,
+                        help='With --local, how long the worker takes to '
+                        'shout.')
+    parser.add_argument('--result-cache', default='none',
+                        choices=('none', 'local', 'memcache'),
+                        help='With --local, where to remember results.  Off '
+                        'by default, so every shout reaches the worker.')
+    parser.add_argument('--seed', type=int, help='Seeds the word choice.')
+    parser.add_argument('--output', help='Write the report here.  '
+                        'Defaults to stdout.')
+    args = parser.parse_args()
+    if args.local:
+        host = serve_locally(args.workers, args.work_seconds,
+                             args.result_cache)
+    else:
+        host = args.host
+    words = args.words.split(',')
+    rand = random.Random(args.seed)
+    # list.append() is atomic, so the browsers can share one list.
+    results = []
+    # Every browser runs on its own thread, and mostly waits on the network.
+    threading.stack_size(256 * 1024)
+    threads = [threading.Thread(
+        target=run_browser,
+        args=(host, args.shouts, words, results,
+              random.Random(rand.random())))
+        for i in range(args.browsers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    report = json.dumps(summarize(results, elapsed, args.browsers),
+                        indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print report
+
+
+if __name__ == '__main__':
+    main()